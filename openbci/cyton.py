@@ -29,10 +29,26 @@ import threading
 import sys
 import pdb
 import glob
+import fnmatch
+import re
+from collections import deque
+
+from serial.tools import list_ports
+
+from openbci.utils.acquisition import AcquisitionThread, SampleQueue
+from openbci.utils.cache import DeviceCache
+from openbci.utils.capture import RawCapture
+from openbci.utils.constants import Constants
+from openbci.utils.gaps import SampleGapDetector
+from openbci.utils.journal import CYTON_COMMAND_LENGTHS, CommandJournal
+from openbci.utils.parse import OpenBCISample as ParsedSample, PacketFramer, ParseRaw
+from openbci.utils.time_sync import ClockSync
+from openbci.utils.watchdog import ConnectionWatchdog
 
 SAMPLE_RATE = 250.0  # Hz
 START_BYTE = 0xA0  # start of data packet
 END_BYTE = 0xC0  # end of data packet
+START_TO_END_BYTES = 33  # size of a data packet
 ADS1299_Vref = 4.5  # reference voltage for ADC in ADS1299.  set by its hardware
 ADS1299_gain = 24.0  # assumed gain setting for ADS1299.  set by its Arduino code
 scale_fac_uVolts_per_count = ADS1299_Vref / \
@@ -69,11 +85,28 @@ class OpenBCICyton(object):
       baud: The baud of the serial connection.
       daisy: Enable or disable daisy module and 16 chans readings
       aux, impedance: unused, for compatibility with ganglion API
+      chunk_size: number of bytes requested from the serial port per read. 0 reads
+        whatever is waiting (at least one packet worth of bytes).
+      fast_connect: instead of fixed sleeps, reset the board and go on as soon as it is
+        ready, i.e. once its message ends with '$$$', or after `connect_timeout` seconds.
+        The time it took is kept in `time_to_ready`.
+      resync: after a corrupt packet, look for the next packet within its bytes instead of
+        skipping them all, see PacketFramer. `bytes_skipped` and `frames_recovered` count
+        what happened.
+      fill_gaps: None, Constants.GAP_FILL_NAN or Constants.GAP_FILL_INTERPOLATE, insert
+        placeholders for the samples lost according to the sample counter. Lost samples are
+        counted by `gap_detector` in any case.
+
+    While streaming, `watchdog` reconnects to the board when its thresholds are crossed,
+    e.g. set `watchdog.stall_timeout` to detect a stall without waiting for the serial timeout.
     """
 
     def __init__(self, port=None, baud=115200, filter_data=True, scaled_output=True,
-                 daisy=False, aux=False, impedance=False, log=True, timeout=None):
+                 daisy=False, aux=False, impedance=False, log=True, timeout=None,
+                 chunk_size=0, fast_connect=False, connect_timeout=3, resync=False,
+                 fill_gaps=None):
         self.log = log  # print_incoming_text needs log
+        self.log_packet_count = 0  # so does warn
         self.streaming = False
         self.baudrate = baud
         self.timeout = timeout
@@ -83,22 +116,30 @@ class OpenBCICyton(object):
         # might be handy to know API
         self.board_type = "cyton"
         print("Connecting to V3 at port %s" % (port))
-        if port == "loop://":
-            # For testing purposes
+        start_time = timeit.default_timer()
+        if "://" in port:
+            # For testing purposes, e.g. loop:// or socket://
             self.ser = serial.serial_for_url(port, baudrate=baud, timeout=timeout)
         else:
             self.ser = serial.Serial(port=port, baudrate=baud, timeout=timeout)
 
         print("Serial established...")
 
-        time.sleep(2)
-        # Initialize 32-bit board, doesn't affect 8bit board
-        self.ser.write(b'v')
+        self.time_to_ready = None
+        if fast_connect:
+            if self.wait_for_ready(connect_timeout):
+                self.time_to_ready = timeit.default_timer() - start_time
+                print("Board ready in %.3f s" % self.time_to_ready)
+        else:
+            time.sleep(2)
+            # Initialize 32-bit board, doesn't affect 8bit board
+            self.ser.write(b'v')
 
-        # wait for device to be ready
-        time.sleep(1)
-        if port != "loop://":
-            self.print_incoming_text()
+            # wait for device to be ready
+            time.sleep(1)
+            if port != "loop://":
+                self.print_incoming_text()
+            self.time_to_ready = timeit.default_timer() - start_time
 
         self.streaming = False
         self.filtering_data = filter_data
@@ -109,17 +150,52 @@ class OpenBCICyton(object):
         self.aux_channels_per_sample = 3
         self.imp_channels_per_sample = 0  # impedance check not supported at the moment
         self.read_state = 0
+        # raw serial bytes are split into packets here, partial packets wait for the next read
+        self.chunk_size = chunk_size
+        self._framer = PacketFramer(packet_size=START_TO_END_BYTES, resync=resync)
+        self._pending_samples = deque()
+        # set when streaming with a dedicated acquisition thread
+        self.sample_queue = None
+        self._parser = ParseRaw(gains=[ADS1299_gain] * self.eeg_channels_per_sample,
+                                micro_volts=True, scaled_output=scaled_output)
+        # board clock -> host clock, for the timestamps of time synced packets
+        self.time_sync = ClockSync()
+        self._parser.raw_data_to_sample.time_sync = self.time_sync
         self.daisy = daisy
-        self.last_odd_sample = OpenBCISample(-1, [], [])  # used for daisy
-        self.log_packet_count = 0
+        # daisy: even sample waiting for its odd counterpart, number of samples without one
+        self._daisy_lower = None
+        self.daisy_unpaired = 0
+        self.gap_detector = SampleGapDetector(fill=fill_gaps)
+        # raw bytes recording, see start_capture()
+        self.capture = None
+        self.capture_only = False
+        # settings sent to the board, sent again after a reconnection
+        self.journal = CommandJournal(CYTON_COMMAND_LENGTHS)
+        self.time_to_reconnect = None
         self.attempt_reconnect = False
         self.last_reconnect = 0
         self.reconnect_freq = 5
         self.packets_dropped = 0
+        # set by the watchdog, the reading thread then reconnects between two reads
+        self._reconnect_requested = False
+        self._read_cancelled = False
+        # a reconnection and stop() do not interleave
+        self._streaming_lock = threading.Lock()
+        # one thread per board checking the stream, see check_connection()
+        self.watchdog = ConnectionWatchdog(self._connection_lost,
+                                           is_active=lambda: self.streaming)
 
         # Disconnects from board when terminated
         atexit.register(self.disconnect)
 
+    @property
+    def bytes_skipped(self):
+        return self._framer.bytes_skipped
+
+    @property
+    def frames_recovered(self):
+        return self._framer.frames_recovered
+
     def getBoardType(self):
         """ Returns the version of the board """
         return self.board_type
@@ -129,7 +205,8 @@ class OpenBCICyton(object):
         return
 
     def ser_write(self, b):
-        """Access serial port object for write"""
+        """Access serial port object for write, settings commands are remembered"""
+        self.journal.record(b)
         self.ser.write(b)
 
     def ser_read(self):
@@ -158,7 +235,8 @@ class OpenBCICyton(object):
     def getNbImpChannels(self):
         return self.imp_channels_per_sample
 
-    def start_streaming(self, callback, lapse=-1):
+    def start_streaming(self, callback, lapse=-1, queue_size=0,
+                        queue_policy=Constants.QUEUE_POLICY_BLOCK):
         """
         Start handling streaming data from the board. Call a provided callback
         for every single sample that is processed (every two samples with daisy module).
@@ -166,10 +244,18 @@ class OpenBCICyton(object):
         Args:
           callback: A callback function, or a list of functions, that will receive a single
            argument of the OpenBCISample object captured.
+          queue_size: if > 0, a dedicated thread reads and decodes the serial data into a queue
+           of that size while callbacks are called from the current thread. A slow callback
+           then no longer lets the serial buffer overflow.
+          queue_policy: what to do when the queue is full, one of Constants.QUEUE_POLICY_*
+
+        In capture-only mode, see start_capture(), bytes are only recorded and callbacks are
+        never called.
         """
         if not self.streaming:
             self.ser.write(b'b')
             self.streaming = True
+            self.gap_detector.reset()
 
         start_time = timeit.default_timer()
 
@@ -177,139 +263,259 @@ class OpenBCICyton(object):
         if not isinstance(callback, list):
             callback = [callback]
 
+        reader = None
+        if queue_size > 0 and not self.capture_only:
+            self.sample_queue = SampleQueue(queue_size, queue_policy)
+            self.sample_queue.put_many(self._pending_samples)
+            self._pending_samples.clear()
+            reader = AcquisitionThread(self._read_serial_packets, self.sample_queue)
+            reader.start()
+
         # Initialize check connection
         self.check_connection()
 
-        while self.streaming:
+        try:
+            while self.streaming:
 
-            # read current sample
-            sample = self._read_serial_binary()
-            # if a daisy module is attached, wait to concatenate two samples
-            # (main board + daisy) before passing it to callback
-            if self.daisy:
-                # odd sample: daisy sample, save for later
-                if ~sample.id % 2:
-                    self.last_odd_sample = sample
-                # even sample: concatenate and send if last sample was the fist part,
-                #  otherwise drop the packet
-                elif sample.id - 1 == self.last_odd_sample.id:
-                    # the aux data will be the average between the two samples, as the channel
-                    #  samples themselves have been averaged by the board
-                    avg_aux_data = list(
-                        (np.array(sample.aux_data) + np.array(self.last_odd_sample.aux_data)) / 2)
-                    whole_sample = OpenBCISample(sample.id,
-                                                 sample.channel_data +
-                                                 self.last_odd_sample.channel_data,
-                                                 avg_aux_data)
+                if self.capture_only:
+                    self._capture_serial()
+                    samples = []
+                elif reader is None:
+                    # read current sample
+                    samples = [self._read_serial_binary()]
+                else:
+                    samples = self.sample_queue.get_all(timeout=0.1)
+                    if not samples and self.sample_queue.closed:
+                        if reader.error is not None:
+                            raise reader.error
+                        break
+
+                for sample in samples:
                     for call in callback:
-                        call(whole_sample)
-            else:
-                for call in callback:
-                    call(sample)
+                        call(sample)
+
+                    if self.log:
+                        self.log_packet_count = self.log_packet_count + 1
+
+                if lapse > 0 and (timeit.default_timer() - start_time) > lapse:
+                    self.stop()
+        except IOError as error:
+            self.warn('%s. Quitting...' % error)
+            self.streaming = False
+        finally:
+            if reader is not None:
+                self._stop_reader(reader)
+
+    def _stop_reader(self, reader):
+        """ Stops the acquisition thread and waits for it. """
+        reader.stop()
+        # it might be waiting for room in the queue
+        reader.sample_queue.close()
+        if reader.is_alive() and hasattr(self.ser, 'cancel_read'):
+            # let the pending read return, it might block forever if the port has no timeout
+            self.ser.cancel_read()
+            reader.join()
+        else:
+            reader.join((self.ser.timeout or 0) + 1)
+
+    def _read_serial_binary(self, max_bytes_to_skip=3000):
+        """ Returns the next sample, reading a new chunk from the serial port if none is left. """
+        if not self._pending_samples:
+            self._pending_samples.extend(self._read_serial_packets(max_bytes_to_skip))
+        if self._pending_samples:
+            return self._pending_samples.popleft()
+
+    def _read_serial_packets(self, max_bytes_to_skip=3000):
+        """
+        Reads everything waiting on the serial port (at least one packet worth of bytes, or
+        `chunk_size` bytes if set) and returns the samples of all the complete packets found.
+        Partial packets are kept by the framer until the next read.
+        """
 
-            if lapse > 0 and (timeit.default_timer() - start_time) > lapse:
-                self.stop()
-            if self.log:
-                self.log_packet_count = self.log_packet_count + 1
+        read = self._read_serial
+        framer = self._framer
+        bytes_read = 0
+        while bytes_read - framer.buffered() <= max_bytes_to_skip:
+            self._reconnect_if_requested()
+            if self.chunk_size > 0:
+                n = self.chunk_size
+            else:
+                n = max(self.ser.inWaiting(), START_TO_END_BYTES - framer.buffered())
+            data = read(n)
+            bytes_read += len(data)
+
+            skipped = framer.bytes_skipped
+            invalid = framer.packets_invalid
+            packets = framer.feed(data)
+            if framer.bytes_skipped != skipped:
+                self.warn('Skipped %d bytes before start found' % (framer.bytes_skipped - skipped))
+                self.watchdog.bytes_skipped(framer.bytes_skipped - skipped)
+            if framer.packets_invalid != invalid:
+                self.warn("%d packet(s) with unexpected END_BYTE instead of <%s>"
+                          % (framer.packets_invalid - invalid, END_BYTE))
+                self.packets_dropped = self.packets_dropped + framer.packets_invalid - invalid
+                self.watchdog.packets_dropped(framer.packets_invalid - invalid)
+            if packets:
+                self.packets_dropped = 0
+                self.watchdog.packets_received(len(packets))
+                return self._decode_packets(packets)
+        return []
+
+    def _read_serial(self, n):
+        bb = self.ser.read(n)
+        if not bb:
+            if self._read_cancelled:
+                # woken up by the watchdog, not a stall
+                self._read_cancelled = False
+                return bb
+            raise IOError('Device Stalled')
+        # stop_capture() might be called meanwhile, a closed capture drops the chunk
+        capture = self.capture
+        if capture is not None:
+            capture.write(bb)
+        return bb
+
+    def _capture_serial(self):
+        """ Capture-only mode: records whatever is waiting on the serial port, no parsing. """
+        self._reconnect_if_requested()
+        n = self.chunk_size if self.chunk_size > 0 else \
+            max(self.ser.inWaiting(), START_TO_END_BYTES)
+        self._read_serial(n)
+        # no packet is framed, only tell the watchdog that data is flowing
+        self.watchdog.packets_received(0)
+
+    def start_capture(self, path, max_bytes=0, capture_only=False):
+        """
+        Records every byte read from the serial port to `path`, before any parsing, see
+        RawCapture for the format and the rotation.
+        :param max_bytes: start a new file once the current one is larger, 0 to never rotate
+        :param capture_only: start_streaming() will then only record, without decoding the
+            packets nor calling the callbacks
+        :return: RawCapture
+        :raises OSError: if `path` already exists
+        """
+        self.stop_capture()
+        self.capture = RawCapture(path, max_bytes=max_bytes)
+        self.capture_only = capture_only
+        return self.capture
+
+    def stop_capture(self):
+        """ Can be called while streaming, from another thread than the one reading. """
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+        self.capture_only = False
 
     """
       PARSER:
-      Parses incoming data packet into OpenBCISample.
+      Parses incoming data packets into OpenBCISample, all the packets of a read at once.
       Incoming Packet Structure:
       Start Byte(1)|Sample ID(1)|Channel Data(24)|Aux Data(6)|End Byte(1)
       0xA0|0-255|8, 3-byte signed ints|3 2-byte signed ints|0xC0
-  
-    """
 
-    def _read_serial_binary(self, max_bytes_to_skip=3000):
-        def read(n):
-            bb = self.ser.read(n)
-            if not bb:
-                self.warn('Device appears to be stalled. Quitting...')
-                sys.exit()
-                raise Exception('Device Stalled')
-                sys.exit()
-                return '\xFF'
-            else:
-                return bb
+    """
 
-        for rep in range(max_bytes_to_skip):
-
-            # ---------Start Byte & ID---------
-            if self.read_state == 0:
-
-                b = read(1)
-
-                if struct.unpack('B', b)[0] == START_BYTE:
-                    if (rep != 0):
-                        self.warn(
-                            'Skipped %d bytes before start found' % (rep))
-                        rep = 0
-                    # packet id goes from 0-255
-                    packet_id = struct.unpack('B', read(1))[0]
-                    log_bytes_in = str(packet_id)
-
-                    self.read_state = 1
-
-            # ---------Channel Data---------
-            elif self.read_state == 1:
-                channel_data = []
-                for c in range(self.eeg_channels_per_sample):
-
-                    # 3 byte ints
-                    literal_read = read(3)
-
-                    unpacked = struct.unpack('3B', literal_read)
-                    log_bytes_in = log_bytes_in + '|' + str(literal_read)
-
-                    # 3byte int in 2s compliment
-                    if (unpacked[0] > 127):
-                        pre_fix = bytes(bytearray.fromhex('FF'))
-                    else:
-                        pre_fix = bytes(bytearray.fromhex('00'))
-
-                    literal_read = pre_fix + literal_read
-
-                    # unpack little endian(>) signed integer(i)
-                    # (makes unpacking platform independent)
-                    myInt = struct.unpack('>i', literal_read)[0]
-
-                    if self.scaling_output:
-                        channel_data.append(myInt * scale_fac_uVolts_per_count)
-                    else:
-                        channel_data.append(myInt)
-
-                self.read_state = 2
-
-            # ---------Accelerometer Data---------
-            elif self.read_state == 2:
-                aux_data = []
-                for a in range(self.aux_channels_per_sample):
-
-                    # short = h
-                    acc = struct.unpack('>h', read(2))[0]
-                    log_bytes_in = log_bytes_in + '|' + str(acc)
-
-                    if self.scaling_output:
-                        aux_data.append(acc * scale_fac_accel_G_per_count)
-                    else:
-                        aux_data.append(acc)
-
-                self.read_state = 3
-            # ---------End Byte---------
-            elif self.read_state == 3:
-                val = struct.unpack('B', read(1))[0]
-                log_bytes_in = log_bytes_in + '|' + str(val)
-                self.read_state = 0  # read next packet
-                if (val == END_BYTE):
-                    sample = OpenBCISample(packet_id, channel_data, aux_data)
-                    self.packets_dropped = 0
-                    return sample
-                else:
-                    self.warn("ID:<%d> <Unexpected END_BYTE found <%s> instead of <%s>"
-                              % (packet_id, val, END_BYTE))
-                    logging.debug(log_bytes_in)
-                    self.packets_dropped = self.packets_dropped + 1
+    def _decode_packets(self, packets):
+        data = b''.join(packets)
+        packet_types = np.frombuffer(data, dtype=np.uint8)[START_TO_END_BYTES - 1::
+                                                           START_TO_END_BYTES] & 0x0F
+        if not packet_types.any():
+            samples = self._decode_standard_packets(data)
+        else:
+            # not only 0xC0 stop bytes, e.g. time synced packets
+            samples = self._decode_packets_by_type(packets, packet_types)
+            if self.daisy:
+                samples = self._merge_daisy_samples(samples)
+        # merged daisy samples keep the odd ids only
+        self.gap_detector.step = 2 if self.daisy else 1
+        return self.gap_detector.process_many(samples)
+
+    def _decode_standard_packets(self, data, merge_daisy=True):
+        """ All packets at once, as standard packets: 8 channels and 3 accelerometer axes. """
+        sample_numbers, channel_data, aux_data = \
+            self._parser.transform_raw_data_packets_to_arrays(data)
+        # if a daisy module is attached, concatenate two samples (main board + daisy)
+        if self.daisy and merge_daisy:
+            sample_numbers, channel_data, aux_data, _ = \
+                self._merge_daisy(sample_numbers, channel_data, aux_data)
+        return [OpenBCISample(packet_id, channels, aux) for packet_id, channels, aux in
+                zip(sample_numbers.tolist(), channel_data.tolist(), aux_data.tolist())]
+
+    def _decode_packets_by_type(self, packets, packet_types):
+        """
+        Each packet through the parser of its stop byte, unsupported types are dropped. Daisy
+        samples are not merged yet.
+        As for standard packets, aux_data holds the accelerometer data, zeros if the packet
+        has none. The aux bytes of the packet are kept as they came in aux_bytes.
+        """
+        samples = []
+        for packet, packet_type in zip(packets, packet_types.tolist()):
+            if packet_type == Constants.RAW_PACKET_TYPE_STANDARD_ACCEL:
+                samples.extend(self._decode_standard_packets(packet, merge_daisy=False))
+                continue
+            sample = self._parser.transform_raw_data_packet_to_sample(bytes(packet))
+            if not sample.valid:
+                self.warn("Packet dropped: %s" % sample.error)
+                continue
+            sample.protocol = Constants.PROTOCOL_SERIAL
+            sample.aux_bytes = sample.aux_data
+            # v3 API: accelerometer in the aux data
+            sample.aux_data = list(sample.accel_data) or [0] * self.aux_channels_per_sample
+            samples.append(sample)
+        return samples
+
+    def _merge_daisy_samples(self, samples):
+        """
+        _merge_daisy for samples decoded one by one: the odd sample of each pair gets the
+        channels of both and the average aux data, its other attributes are kept.
+        """
+        if not samples:
+            return samples
+        sample_numbers = np.array([sample.id for sample in samples], dtype=np.uint8)
+        channel_data = np.array([sample.channel_data for sample in samples]).reshape(
+            len(samples), -1)
+        aux_data = np.array([sample.aux_data for sample in samples]).reshape(len(samples), -1)
+        sample_numbers, channel_data, aux_data, upper = \
+            self._merge_daisy(sample_numbers, channel_data, aux_data)
+        merged = []
+        for i, channels, aux in zip(upper.tolist(), channel_data.tolist(), aux_data.tolist()):
+            sample = samples[i]
+            sample.channel_data = channels
+            sample.aux_data = aux
+            merged.append(sample)
+        return merged
+
+    def _merge_daisy(self, sample_numbers, channel_data, aux_data):
+        """
+        Pairs the samples of a decoded block, all at once. An even sample followed by the next
+        odd one make a 16 channels sample: odd channels first, then even channels. The aux data
+        is the average of both, as the channel samples themselves have been averaged by the
+        board. A trailing even sample is kept for the next block, other unpaired samples are
+        dropped and counted in `daisy_unpaired`.
+        Also returns the index in the block of the odd sample of each pair.
+        """
+        nb_kept = 0
+        if self._daisy_lower is not None:
+            sample_numbers = np.concatenate((self._daisy_lower[0], sample_numbers))
+            channel_data = np.concatenate((self._daisy_lower[1], channel_data))
+            aux_data = np.concatenate((self._daisy_lower[2], aux_data))
+            self._daisy_lower = None
+            nb_kept = 1
+
+        ids = sample_numbers.astype(np.int32)
+        lower = np.nonzero((ids[:-1] % 2 == 0) & (ids[1:] == ids[:-1] + 1))[0]
+        upper = lower + 1
+
+        nb_unpaired = len(ids) - 2 * len(lower)
+        if len(ids) and ids[-1] % 2 == 0:
+            self._daisy_lower = (sample_numbers[-1:], channel_data[-1:], aux_data[-1:])
+            nb_unpaired -= 1
+        self.daisy_unpaired += nb_unpaired
+
+        return (sample_numbers[upper],
+                np.hstack((channel_data[upper], channel_data[lower])),
+                (aux_data[upper] + aux_data[lower]) / 2.,
+                upper - nb_kept)
 
     """
   
@@ -319,14 +525,17 @@ class OpenBCICyton(object):
 
     def stop(self):
         print("Stopping streaming...\nWait for buffer to flush...")
-        self.streaming = False
-        self.ser.write(b's')
+        with self._streaming_lock:
+            self.streaming = False
+            self.ser.write(b's')
         if self.log:
             logging.warning('sent <s>: stopped streaming')
 
     def disconnect(self):
         if (self.streaming == True):
             self.stop()
+        self.watchdog.stop()
+        self.stop_capture()
         if (self.ser.isOpen()):
             print("Closing Serial...")
             self.ser.close()
@@ -372,27 +581,67 @@ class OpenBCICyton(object):
         else:
             self.warn("No Message")
 
-    def openbci_id(self, serial):
+    def wait_for_ready(self, timeout=3, retry_interval=0.5):
         """
 
-        When automatically detecting port, parse the serial return for the "OpenBCI" ID.
+        Stops the stream and sends the soft reset command 'v', then prints the board message
+        once it ends with '$$$'. The board might still be streaming, e.g. when the program
+        reading it restarted, or still be booting after the port was opened: both commands are
+        sent again when nothing came for `retry_interval` seconds.
+        Returns False if the message is not complete after `timeout` seconds.
 
         """
         line = ''
-        # Wait for device to send data
-        time.sleep(2)
-
-        if serial.inWaiting():
-            line = ''
-            c = ''
-            # Look for end sequence $$$
-            while '$$$' not in line:
+        deadline = timeit.default_timer() + timeout
+        next_try = 0
+        # length of the message at the previous try
+        length_at_try = 0
+        self.ser.flushInput()
+        while '$$$' not in line:
+            now = timeit.default_timer()
+            if now > deadline:
+                self.warn("Board not ready after %s seconds: %s" % (timeout, line or "No Message"))
+                return False
+            if now >= next_try:
+                # unless a slow answer is still coming, another reset would add one later
+                if len(line) == length_at_try:
+                    # Initialize 32-bit board, doesn't affect 8bit board
+                    self.ser.write(b'sv')
+                length_at_try = len(line)
+                next_try = now + retry_interval
+            n = self.ser.inWaiting()
+            if n:
                 # we're supposed to get UTF8 text, but the board might behave otherwise
-                c = serial.read().decode('utf-8',
-                                         errors='replace')
-                line += c
+                line += self.ser.read(n).decode('utf-8', errors='replace')
+            else:
+                time.sleep(0.005)
+        # packets still in flight when the stream stopped come first
+        print(line[line.rfind('OpenBCI'):] if 'OpenBCI' in line else line)
+        return True
+
+    def openbci_id(self, serial, timeout=2, cancel=None):
+        """
+
+        When automatically detecting port, parse the serial return for the "OpenBCI" ID.
+        Returns as soon as the ID is read, or the end sequence $$$, or after `timeout` seconds
+        or once the `cancel` event is set.
+
+        """
+        line = ''
+        deadline = timeit.default_timer() + timeout
+        while timeit.default_timer() < deadline and not (cancel and cancel.is_set()):
+            n = serial.inWaiting()
+            if not n:
+                # Wait for device to send data
+                time.sleep(0.01)
+                continue
+            # we're supposed to get UTF8 text, but the board might behave otherwise
+            line += serial.read(n).decode('utf-8', errors='replace')
             if "OpenBCI" in line:
                 return True
+            # Look for end sequence $$$
+            if '$$$' in line:
+                break
         return False
 
     def print_register_settings(self):
@@ -470,57 +719,180 @@ class OpenBCICyton(object):
                 self.warn('Reconnecting')
                 self.reconnect()
 
-    def check_connection(self, interval=2, max_packets_to_skip=10):
-        # stop checking when we're no longer streaming
-        if not self.streaming:
+    def check_connection(self, interval=None, max_packets_to_skip=None):
+        """
+        Starts the watchdog thread, only the first call creates it. It sleeps while not
+        streaming and calls reconnect() when the stream looks lost.
+        """
+        if interval is not None:
+            self.watchdog.interval = interval
+        if max_packets_to_skip is not None:
+            self.watchdog.max_packets_to_skip = max_packets_to_skip
+        self.watchdog.start()
+
+    def _connection_lost(self, reason):
+        self.warn(reason)
+        if hasattr(self.ser, 'cancel_read'):
+            # it might be blocked waiting for data that will never come
+            self._read_cancelled = True
+            self.ser.cancel_read()
+        # the serial port belongs to the reading thread, it reconnects between two reads
+        self._reconnect_requested = True
+
+    def _reconnect_if_requested(self):
+        """ Called by the reading thread before each read. """
+        if not self._reconnect_requested:
             return
-        # check number of dropped packages and establish connection problem if too large
-        if self.packets_dropped > max_packets_to_skip:
-            # if error, attempt to reconnect
-            self.reconnect()
-        # check again again in 2 seconds
-        threading.Timer(interval, self.check_connection).start()
-
-    def reconnect(self):
+        self._reconnect_requested = False
+        # the cancelled read might have returned data, the next empty read is a stall
+        self._read_cancelled = False
+        with self._streaming_lock:
+            # stop() might have been called meanwhile
+            if self.streaming:
+                self.reconnect()
+
+    def reconnect(self, timeout=1):
+        """
+        Soft resets the board, sends again in one batch the settings recorded in the journal,
+        then streams again. Only waits for the board to answer the reset, at most `timeout`
+        seconds.
+        Reads the serial port: when the stream looks lost, the watchdog does not call it
+        itself but asks the thread reading the port to, between two reads.
+        """
+        start_time = timeit.default_timer()
         self.packets_dropped = 0
+        self.gap_detector.reset()
         self.warn('Reconnecting')
-        self.stop()
-        time.sleep(0.5)
+        # stop the board only, start_streaming() goes on
+        self.ser.write(b's')
+        self.ser.flushInput()
+        self._framer.reset()
+        self._daisy_lower = None
         self.ser.write(b'v')
-        time.sleep(0.5)
+        if '$$$' not in self._read_reply(timeout):
+            self.warn('No answer to the soft reset')
+        # the soft reset brought the defaults back
+        self.journal.replay(self.ser.write)
         self.ser.write(b'b')
-        time.sleep(0.5)
         self.streaming = True
+        self.watchdog.rearm()
+        self.time_to_reconnect = timeit.default_timer() - start_time
         # self.attempt_reconnect = False
 
+    def sync_clocks(self, timeout=1):
+        """
+        One time sync exchange with the board, which must be streaming. The board then sends
+        time synced packets, stamped with the host clock from their board time. Each call adds
+        a point to the estimation of the offset and the drift of the board clock, call it
+        regularly to follow the drift.
+        :param timeout: seconds to wait for the answer of the board
+        :return: bool - True if the exchange was used
+        """
+        if not self.streaming:
+            raise RuntimeError('Time sync needs the board to be streaming')
+        exchanges = self.time_sync.exchanges
+        rejected = self.time_sync.rejected
+        self.time_sync.start()
+        self.ser.write(b'<')
+        deadline = timeit.default_timer() + timeout
+        while self.time_sync.exchanges == exchanges and timeit.default_timer() < deadline:
+            time.sleep(0.001)
+        if self.time_sync.exchanges == exchanges:
+            self.time_sync.cancel()
+            self.warn('Time sync: no answer from the board')
+            return False
+        return self.time_sync.rejected == rejected
+
+    def set_baud_rate(self, baud, timeout=1):
+        """
+        Asks the dongle to switch to another baud rate, follows it on the serial port and
+        checks the link with the radio status command. Comes back to the previous baud rate
+        if anything goes wrong. Must be called while not streaming.
+        :param baud: one of Constants.CYTON_BAUD_RATE_*
+        :param timeout: seconds to wait for each answer of the dongle
+        :return: bool - True if the new baud rate is in use
+        """
+        commands = {
+            Constants.CYTON_BAUD_RATE_DEFAULT: Constants.CYTON_COMMAND_BAUD_RATE_DEFAULT,
+            Constants.CYTON_BAUD_RATE_HIGH: Constants.CYTON_COMMAND_BAUD_RATE_HIGH,
+            Constants.CYTON_BAUD_RATE_HYPER: Constants.CYTON_COMMAND_BAUD_RATE_HYPER
+        }
+        if baud not in commands:
+            raise ValueError('Unsupported baud rate %s, use one of %s' % (baud, sorted(commands)))
+        if self.streaming:
+            raise RuntimeError('Cannot change the baud rate while streaming')
+        previous = self.ser.baudrate
+
+        self.ser.flushInput()
+        self.ser.write(commands[baud])
+        reply = self._read_reply(timeout)
+        if 'Success' not in reply:
+            self.warn("Baud rate %s refused: %s" % (baud, reply or "No Message"))
+            return False
+        try:
+            self.ser.baudrate = baud
+            self.ser.flushInput()
+            self.ser.write(Constants.CYTON_COMMAND_RADIO_SYSTEM_STATUS)
+            reply = self._read_reply(timeout)
+        except (ValueError, serial.SerialException) as e:
+            reply = str(e)
+        if 'Success' in reply:
+            self.baudrate = baud
+            print("Serial baud rate: %s" % baud)
+            return True
+
+        self.warn("No link at %s baud (%s), back to %s" % (baud, reply or "No Message", previous))
+        try:
+            # the dongle might have switched and only its answer got lost
+            if previous in commands:
+                self.ser.write(commands[previous])
+                self._read_reply(timeout)
+        finally:
+            self.ser.baudrate = previous
+            self.ser.flushInput()
+        return False
+
+    def _read_reply(self, timeout):
+        """ Text sent by the board or the dongle up to '$$$', partial after `timeout` seconds. """
+        line = ''
+        deadline = timeit.default_timer() + timeout
+        while '$$$' not in line and timeit.default_timer() < deadline:
+            n = self.ser.inWaiting()
+            if n:
+                # we're supposed to get UTF8 text, but the board might behave otherwise
+                line += self.ser.read(n).decode('utf-8', errors='replace')
+            else:
+                time.sleep(0.005)
+        return line
+
     # Adds a filter at 60hz to cancel out ambient electrical noise
     def enable_filters(self):
-        self.ser.write(b'f')
+        self.ser_write(b'f')
         self.filtering_data = True
 
     def disable_filters(self):
-        self.ser.write(b'g')
+        self.ser_write(b'g')
         self.filtering_data = False
 
     def test_signal(self, signal):
         """ Enable / disable test signal """
         if signal == 0:
-            self.ser.write(b'0')
+            self.ser_write(b'0')
             self.warn("Connecting all pins to ground")
         elif signal == 1:
-            self.ser.write(b'p')
+            self.ser_write(b'p')
             self.warn("Connecting all pins to Vcc")
         elif signal == 2:
-            self.ser.write(b'-')
+            self.ser_write(b'-')
             self.warn("Connecting pins to low frequency 1x amp signal")
         elif signal == 3:
-            self.ser.write(b'=')
+            self.ser_write(b'=')
             self.warn("Connecting pins to high frequency 1x amp signal")
         elif signal == 4:
-            self.ser.write(b'[')
+            self.ser_write(b'[')
             self.warn("Connecting pins to low frequency 2x amp signal")
         elif signal == 5:
-            self.ser.write(b']')
+            self.ser_write(b']')
             self.warn("Connecting pins to high frequency 2x amp signal")
         else:
             self.warn("%s is not a known test signal. Valid signals go from 0-5" % signal)
@@ -530,106 +902,179 @@ class OpenBCICyton(object):
         # Commands to set toggle to on position
         if toggle_position == 1:
             if channel is 1:
-                self.ser.write(b'!')
+                self.ser_write(b'!')
             if channel is 2:
-                self.ser.write(b'@')
+                self.ser_write(b'@')
             if channel is 3:
-                self.ser.write(b'#')
+                self.ser_write(b'#')
             if channel is 4:
-                self.ser.write(b'$')
+                self.ser_write(b'$')
             if channel is 5:
-                self.ser.write(b'%')
+                self.ser_write(b'%')
             if channel is 6:
-                self.ser.write(b'^')
+                self.ser_write(b'^')
             if channel is 7:
-                self.ser.write(b'&')
+                self.ser_write(b'&')
             if channel is 8:
-                self.ser.write(b'*')
+                self.ser_write(b'*')
             if channel is 9 and self.daisy:
-                self.ser.write(b'Q')
+                self.ser_write(b'Q')
             if channel is 10 and self.daisy:
-                self.ser.write(b'W')
+                self.ser_write(b'W')
             if channel is 11 and self.daisy:
-                self.ser.write(b'E')
+                self.ser_write(b'E')
             if channel is 12 and self.daisy:
-                self.ser.write(b'R')
+                self.ser_write(b'R')
             if channel is 13 and self.daisy:
-                self.ser.write(b'T')
+                self.ser_write(b'T')
             if channel is 14 and self.daisy:
-                self.ser.write(b'Y')
+                self.ser_write(b'Y')
             if channel is 15 and self.daisy:
-                self.ser.write(b'U')
+                self.ser_write(b'U')
             if channel is 16 and self.daisy:
-                self.ser.write(b'I')
+                self.ser_write(b'I')
         # Commands to set toggle to off position
         elif toggle_position == 0:
             if channel is 1:
-                self.ser.write(b'1')
+                self.ser_write(b'1')
             if channel is 2:
-                self.ser.write(b'2')
+                self.ser_write(b'2')
             if channel is 3:
-                self.ser.write(b'3')
+                self.ser_write(b'3')
             if channel is 4:
-                self.ser.write(b'4')
+                self.ser_write(b'4')
             if channel is 5:
-                self.ser.write(b'5')
+                self.ser_write(b'5')
             if channel is 6:
-                self.ser.write(b'6')
+                self.ser_write(b'6')
             if channel is 7:
-                self.ser.write(b'7')
+                self.ser_write(b'7')
             if channel is 8:
-                self.ser.write(b'8')
+                self.ser_write(b'8')
             if channel is 9 and self.daisy:
-                self.ser.write(b'q')
+                self.ser_write(b'q')
             if channel is 10 and self.daisy:
-                self.ser.write(b'w')
+                self.ser_write(b'w')
             if channel is 11 and self.daisy:
-                self.ser.write(b'e')
+                self.ser_write(b'e')
             if channel is 12 and self.daisy:
-                self.ser.write(b'r')
+                self.ser_write(b'r')
             if channel is 13 and self.daisy:
-                self.ser.write(b't')
+                self.ser_write(b't')
             if channel is 14 and self.daisy:
-                self.ser.write(b'y')
+                self.ser_write(b'y')
             if channel is 15 and self.daisy:
-                self.ser.write(b'u')
+                self.ser_write(b'u')
             if channel is 16 and self.daisy:
-                self.ser.write(b'i')
+                self.ser_write(b'i')
 
-    def find_port(self):
-        # Finds the serial port names
-        if sys.platform.startswith('win'):
-            ports = ['COM%s' % (i + 1) for i in range(256)]
-        elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
-            ports = glob.glob('/dev/ttyUSB*')
-        elif sys.platform.startswith('darwin'):
-            ports = glob.glob('/dev/tty.usbserial*')
-        else:
+    def find_port(self, probe_timeout=2, cache=None):
+        """
+        Probes every serial port that might be a dongle at once, the dongle found during the
+        previous run is tried alone first. Ports are remembered by USB serial number, or
+        VID:PID, in a DeviceCache.
+        """
+        candidates = serial_port_candidates()
+        if not candidates:
             raise EnvironmentError('Error finding ports on your operating system')
-        openbci_port = ''
-        for port in ports:
+        if cache is None:
+            cache = DeviceCache('cyton')
+        known = cache.items()
+
+        port = None
+        preferred = [(device, key) for device, key in candidates if key in known]
+        if preferred:
+            port = self._probe_ports([device for device, key in preferred], probe_timeout)
+        if port is None:
+            port = self._probe_ports([device for device, key in candidates
+                                      if (device, key) not in preferred], probe_timeout)
+        if port is None:
+            raise OSError('Cannot find OpenBCI port')
+        cache.set(dict(candidates)[port], port)
+        return port
+
+    def _probe_ports(self, ports, timeout):
+        """ Sends the version command to all `ports` in parallel, returns the first answering. """
+        found = []
+        done = threading.Event()
+
+        def probe(port):
             try:
-                s = serial.Serial(port=port, baudrate=self.baudrate, timeout=self.timeout)
-                s.write(b'v')
-                openbci_serial = self.openbci_id(s)
-                s.close()
-                if openbci_serial:
-                    openbci_port = port
+                s = serial.serial_for_url(port, baudrate=self.baudrate, timeout=timeout)
+                try:
+                    s.write(b'v')
+                    if self.openbci_id(s, timeout=timeout, cancel=done):
+                        found.append(port)
+                        done.set()
+                finally:
+                    s.close()
             except (OSError, serial.SerialException):
                 pass
-        if openbci_port == '':
-            raise OSError('Cannot find OpenBCI port')
-        else:
-            return openbci_port
 
+        threads = [threading.Thread(target=probe, args=(port,)) for port in ports]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return found[0] if found else None
 
-class OpenBCISample(object):
+
+def serial_port_candidates():
+    """
+    Lists the serial ports an OpenBCI dongle might use.
+    :return: list of (port, key) - key identifies the USB device plugged in the port
+    """
+    if sys.platform.startswith('win'):
+        pattern = 'COM*'
+    elif sys.platform.startswith('linux') or sys.platform.startswith('cygwin'):
+        pattern = '/dev/ttyUSB*'
+    elif sys.platform.startswith('darwin'):
+        pattern = '/dev/tty.usbserial*'
+    else:
+        return []
+    try:
+        ports = [(info[0], usb_device_key(info)) for info in list_ports.comports()
+                 if fnmatch.fnmatch(info[0], pattern)]
+    except Exception:
+        ports = []
+    if not ports:
+        # no USB details, fall back to the device names
+        if sys.platform.startswith('win'):
+            names = ['COM%s' % (i + 1) for i in range(256)]
+        else:
+            names = glob.glob(pattern)
+        ports = [(name, name) for name in names]
+    return ports
+
+
+def usb_device_key(info):
+    """ USB serial number of a list_ports entry, VID:PID if unknown, the port name otherwise. """
+    serial_number = getattr(info, 'serial_number', None)
+    vid, pid = getattr(info, 'vid', None), getattr(info, 'pid', None)
+    if serial_number is None and vid is None:
+        # pyserial 2.x gives (port, description, hwid) with e.g. hwid
+        # 'USB VID:PID=0403:6015 SER=DN00ABCD'
+        match = re.search(r'VID:PID=([0-9A-Fa-f]+):([0-9A-Fa-f]+)(?: SER=(\S+))?', info[2])
+        if match:
+            vid, pid = int(match.group(1), 16), int(match.group(2), 16)
+            serial_number = match.group(3)
+    if serial_number:
+        return serial_number
+    if vid is not None:
+        return '%04X:%04X' % (vid, pid)
+    return info[0]
+
+
+class OpenBCISample(ParsedSample):
     """Object encapulsating a single sample from the OpenBCI board.
+    Sample shared with the other boards, created with the arguments of the v3 API:
+    aux_data holds the accelerometer data of standard packets.
     NB: dummy imp for plugin compatiblity
     """
 
     def __init__(self, packet_id, channel_data, aux_data):
-        self.id = packet_id
-        self.channel_data = channel_data
-        self.aux_data = aux_data
-        self.imp_data = []
+        ParsedSample.__init__(self, aux_data=aux_data, channel_data=channel_data,
+                              protocol=Constants.PROTOCOL_SERIAL, sample_number=packet_id,
+                              start_byte=Constants.RAW_BYTE_START, stop_byte=END_BYTE,
+                              accel_data=aux_data)
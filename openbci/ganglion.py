@@ -15,6 +15,7 @@ TODO: support impedance
 TODO: reset board with 'v'?
 """
 from __future__ import print_function
+import binascii
 import struct
 import time
 import timeit
@@ -26,6 +27,11 @@ import pdb
 import glob
 from bluepy.btle import Scanner, DefaultDelegate, Peripheral
 
+from openbci.utils.acquisition import AcquisitionThread, SampleQueue
+from openbci.utils.cache import DeviceCache
+from openbci.utils.constants import Constants
+from openbci.utils.journal import CommandJournal
+
 SAMPLE_RATE = 200.0  # Hz
 scale_fac_uVolts_per_count = 1200 / (8388607.0 * 1.5 * 51.0)
 scale_fac_accel_G_per_count = 0.000016
@@ -36,6 +42,10 @@ BLE_SERVICE = "fe84"
 BLE_CHAR_RECEIVE = "2d30c082f39f4ce6923f3484ea480596"
 BLE_CHAR_SEND = "2d30c083f39f4ce6923f3484ea480596"
 BLE_CHAR_DISCONNECT = "2d30c084f39f4ce6923f3484ea480596"
+# advertising data type holding the name of the device, e.g. "Ganglion-b2a6"
+BLE_AD_COMPLETE_LOCAL_NAME = 9
+# Ganglions seen for the last time longer ago are not tried without a scan
+CACHE_TTL = 7 * 24 * 3600
 
 '''
 #Commands for in SDK http://docs.openbci.com/Hardware/08-Ganglion_Data_Forma
@@ -50,18 +60,24 @@ class OpenBCIGanglion(object):
     Handle a connection to an OpenBCI board.
 
     Args:
-      port: MAC address of the Ganglion Board. "None" to attempt auto-detect.
+      port: MAC address of the Ganglion Board. "None" to attempt auto-detect: the Ganglion
+       connected last is tried first, then a scan looks for one.
+      name: auto-detect only the Ganglion with this name, e.g. "Ganglion-b2a6"
+      cache: DeviceCache of the Ganglions connected recently, see find_port()
+      scanner: finds the BLE devices nearby, see GanglionScanner
       aux: enable on not aux channels (i.e. switch to 18bit mode if set)
       impedance: measures impedance when start streaming
       timeout: in seconds, if set will try to disconnect / reconnect after a period without new data
        -- should be high if impedance check
-      max_packets_to_skip: will try to disconnect / reconnect after too many packets are skipped
+      max_packets_to_skip: warns when more packets are lost at once, streaming goes on and
+       samples are marked invalid until the next raw packet re-anchors the deltas
+      ring_size: samples kept between two reads, the oldest are overwritten past that
       baud, filter_data, daisy: Not used, for compatibility with v3
     """
 
     def __init__(self, port=None, baud=0, filter_data=False,
                  scaled_output=True, daisy=False, log=True, aux=False, impedance=False, timeout=2,
-                 max_packets_to_skip=20):
+                 max_packets_to_skip=20, ring_size=1024, name=None, cache=None, scanner=None):
         # unused, for compatibility with Cyton v3 API
         self.daisy = False
         # these one are used
@@ -72,16 +88,40 @@ class OpenBCIGanglion(object):
         self.max_packets_to_skip = max_packets_to_skip
         self.scaling_output = scaled_output
         self.impedance = impedance
+        self.ring_size = ring_size
+        self.samples_overflowed = 0
+        self.chain_breaks = 0
+        # settings sent to the board, sent again after a reconnection
+        self.journal = CommandJournal()
+        self.time_to_reconnect = None
+        # BLE characteristics, kept to reconnect without discovering them again
+        self.char_read = self.char_write = self.char_discon = self.desc_notify = None
+        self.delegate = None
+        # seconds to wait for data before checking on the stream anyway, notifications read
+        # in a row
+        self.max_wait = 0.5
+        self.max_burst = ring_size // 2
 
         # might be handy to know API
         self.board_type = "ganglion"
 
+        self.name = name
+        self.cache = cache if cache is not None else DeviceCache('ganglion', ttl=CACHE_TTL)
+        self.scanner = scanner if scanner is not None else GanglionScanner()
+
         print("Looking for Ganglion board")
+        connected = False
+        self.port = port
+        if port == None:
+            port = self.connect_cached()
+            connected = port is not None
         if port == None:
             port = self.find_port()
         self.port = port  # find_port might not return string
 
-        self.connect()
+        if not connected:
+            self.connect()
+        self.cache.set(self.port, self.name)
 
         self.streaming = False
         # number of EEG channels and (optionally) accelerometer channel
@@ -92,6 +132,10 @@ class OpenBCIGanglion(object):
         self.log_packet_count = 0
         self.packets_dropped = 0
         self.time_last_packet = 0
+        # set when streaming with a dedicated acquisition thread
+        self.sample_queue = None
+        # only stop() ends start_streaming(), not the stop of a reconnection
+        self._stop_requested = False
 
         # Disconnects from board when terminated
         atexit.register(self.disconnect)
@@ -104,12 +148,42 @@ class OpenBCIGanglion(object):
         """ Enable/disable impedance measure """
         self.impedance = bool(flag)
 
-    def connect(self):
-        """ Connect to the board and configure it. Note: recreates various objects upon call. """
+    def connect(self, fast=False):
+        """ Connect to the board and configure it. Note: recreates various objects upon call.
+        fast: reuse the characteristics and the delegate of the previous connection, their
+        handles do not change, instead of discovering the services again """
         print("Init BLE connection with MAC: " + self.port)
         print("NB: if it fails, try with root privileges.")
         self.gang = Peripheral(self.port, 'random')  # ADDR_TYPE_RANDOM
 
+        if fast and self.desc_notify is not None:
+            for attribute in [self.char_read, self.char_write, self.char_discon,
+                              self.desc_notify]:
+                attribute.peripheral = self.gang
+            self.delegate.restart()
+        else:
+            self.discover()
+        self.gang.setDelegate(self.delegate)
+
+        # enable AUX channel
+        if self.aux:
+            print("Enabling AUX data...")
+            try:
+                # part of the connection, not of the journal
+                self.char_write.write(b'n')
+            except Exception as e:
+                print("Something went wrong while enabling aux channels: " + str(e))
+
+        print("Turn on notifications")
+        try:
+            self.desc_notify.write(b"\x01")
+        except Exception as e:
+            print("Something went wrong while trying to enable notification: " + str(e))
+
+        print("Connection established")
+
+    def discover(self):
+        """ Look up the BLE characteristics, set a new delegate. """
         print("Get mainservice...")
         self.service = self.gang.getServiceByUUID(BLE_SERVICE)
         print("Got:" + str(self.service))
@@ -127,27 +201,13 @@ class OpenBCIGanglion(object):
         print("disconnect, properties: " + str(self.char_discon.propertiesToString()) +
               ", supports read: " + str(self.char_discon.supportsRead()))
 
-        # set delegate to handle incoming data
-        self.delegate = GanglionDelegate(self.scaling_output)
-        self.gang.setDelegate(self.delegate)
-
-        # enable AUX channel
-        if self.aux:
-            print("Enabling AUX data...")
-            try:
-                self.ser_write(b'n')
-            except Exception as e:
-                print("Something went wrong while enabling aux channels: " + str(e))
-
-        print("Turn on notifications")
         # nead up-to-date bluepy, cf https://github.com/IanHarvey/bluepy/issues/53
         self.desc_notify = self.char_read.getDescriptors(forUUID=0x2902)[0]
-        try:
-            self.desc_notify.write(b"\x01")
-        except Exception as e:
-            print("Something went wrong while trying to enable notification: " + str(e))
 
-        print("Connection established")
+        # set delegate to handle incoming data
+        self.delegate = GanglionDelegate(self.scaling_output, self.ring_size)
+        self.samples_overflowed = 0
+        self.chain_breaks = 0
 
     def init_streaming(self):
         """ Tell the board to record like crazy. """
@@ -163,64 +223,64 @@ class OpenBCIGanglion(object):
         self.packets_dropped = 0
         self.time_last_packet = timeit.default_timer()
 
-    def find_port(self):
+    def connect_cached(self):
+        """
+        Connects directly to the Ganglion of the cache seen last, or to the last one named
+        `self.name` if set, without scanning. Only one attempt: each takes a while to fail.
+        :return: str - MAC address of the Ganglion connected, None if it did not answer
+        """
+        entry = self.cache.latest(self.name)
+        if entry is None:
+            return None
+        mac, name = entry
+        print("Trying Ganglion %s seen recently" % mac)
+        port = self.port
+        self.port = mac
+        try:
+            self.connect()
+        except Exception as e:
+            print("Not available: " + str(e))
+            self.port = port
+            return None
+        self.name = name
+        return mac
+
+    def find_port(self, scan_time=5):
         """Detects Ganglion board MAC address
-        If more than 1 around, will select first. Needs root privilege.
+        Returns as soon as a Ganglion is seen, the one named `self.name` if set. Needs root
+        privilege.
         """
 
         print("Try to detect Ganglion MAC address. "
               "NB: Turn on bluetooth and run as root for this to work!"
               "Might not work with every BLE dongles.")
-        scan_time = 5
-        print("Scanning for 5 seconds nearby devices...")
+        print("Scanning for at most %d seconds nearby devices..." % scan_time)
 
-        #   From bluepy example
-        class ScanDelegate(DefaultDelegate):
-            def __init__(self):
-                DefaultDelegate.__init__(self)
+        found = []
 
-            def handleDiscovery(self, dev, isNewDev, isNewData):
-                if isNewDev:
-                    print("Discovered device: " + dev.addr)
-                elif isNewData:
-                    print("Received new data from: " + dev.addr)
+        def on_device(mac, name):
+            # "Ganglion" should appear inside the "Complete Local Name", e.g. "Ganglion-b2a6"
+            if not name or not name.startswith("Ganglion"):
+                return False
+            print("Got Ganglion: " + name + ", with MAC: " + mac)
+            if self.name and name != self.name:
+                return False
+            self.name = name
+            found.append(mac)
+            return True
 
-        scanner = Scanner().withDelegate(ScanDelegate())
-        devices = scanner.scan(scan_time)
+        self.scanner.scan(scan_time, on_device)
 
-        nb_devices = len(devices)
-        if nb_devices < 1:
-            print("No BLE devices found. Check connectivity.")
-            return ""
-        else:
-            print("Found " + str(nb_devices) + ", detecting Ganglion")
-            list_mac = []
-            list_id = []
-
-            for dev in devices:
-                # "Ganglion" should appear inside the "value" associated
-                # to "Complete Local Name", e.g. "Ganglion-b2a6"
-                for (adtype, desc, value) in dev.getScanData():
-                    if desc == "Complete Local Name" and value.startswith("Ganglion"):
-                        list_mac.append(dev.addr)
-                        list_id.append(value)
-                        print("Got Ganglion: " + value +
-                              ", with MAC: " + dev.addr)
-                        break
-        nb_ganglions = len(list_mac)
-
-        if nb_ganglions < 1:
+        if not found:
             print("No Ganglion found ;(")
             raise OSError('Cannot find OpenBCI Ganglion MAC address')
 
-        if nb_ganglions > 1:
-            print("Found " + str(nb_ganglions) + ", selecting first")
-
-        print("Selecting MAC address " + list_mac[0] + " for " + list_id[0])
-        return list_mac[0]
+        print("Selecting MAC address " + found[0] + " for " + self.name)
+        return found[0]
 
     def ser_write(self, b):
-        """Access serial port object for write"""
+        """Access serial port object for write, settings commands are remembered"""
+        self.journal.record(b)
         self.char_write.write(b)
 
     def ser_read(self):
@@ -251,7 +311,8 @@ class OpenBCIGanglion(object):
         """Might not be used depending on the mode."""
         return self.imp_channels_per_sample
 
-    def start_streaming(self, callback, lapse=-1):
+    def start_streaming(self, callback, lapse=-1, queue_size=0,
+                        queue_policy=Constants.QUEUE_POLICY_BLOCK):
         """
         Start handling streaming data from the board. Call a provided callback
         for every single sample that is processed
@@ -259,7 +320,11 @@ class OpenBCIGanglion(object):
         Args:
           callback: A callback function or a list of functions that will receive a single argument
                     of the OpenBCISample object captured.
+          queue_size: if > 0, a dedicated thread handles BLE notifications and pushes samples into
+                    a queue of that size while callbacks are called from the current thread.
+          queue_policy: what to do when the queue is full, one of Constants.QUEUE_POLICY_*
         """
+        self._stop_requested = False
         if not self.streaming:
             self.init_streaming()
 
@@ -269,47 +334,86 @@ class OpenBCIGanglion(object):
         if not isinstance(callback, list):
             callback = [callback]
 
-        while self.streaming:
-            # should the board get disconnected and we could not wait for notification
-            # anymore, a reco should be attempted through timeout mechanism
-            try:
-                # at most we will get one sample per packet
-                self.waitForNotifications(1. / self.getSampleRate())
-            except Exception as e:
-                print("Something went wrong while waiting for a new sample: " + str(e))
-            # retrieve current samples on the stack
-            samples = self.delegate.getSamples()
-            self.packets_dropped = self.delegate.getMaxPacketsDropped()
-            if samples:
-                self.time_last_packet = timeit.default_timer()
-                for call in callback:
-                    for sample in samples:
-                        call(sample)
+        reader = None
+        if queue_size > 0:
+            self.sample_queue = SampleQueue(queue_size, queue_policy)
+            reader = AcquisitionThread(self._read_samples, self.sample_queue)
+            reader.start()
+
+        # streaming is off for a while when the acquisition thread reconnects
+        while not self._stop_requested:
+            if reader is None:
+                samples = self._read_samples()
+            else:
+                samples = self.sample_queue.get_all(timeout=0.1)
+                if not samples and self.sample_queue.closed:
+                    if reader.error is not None:
+                        self.warn("Acquisition stopped: %s" % reader.error)
+                        self.streaming = False
+                    break
+
+            for call in callback:
+                for sample in samples:
+                    call(sample)
 
             if (lapse > 0 and timeit.default_timer() - start_time > lapse):
                 self.stop()
             if self.log:
                 self.log_packet_count = self.log_packet_count + 1
 
-            # Checking connection -- timeout and packets dropped
-            self.check_connection()
+        if reader is not None:
+            reader.stop()
+            # it might be waiting for room in the queue
+            self.sample_queue.close()
+            # BLE waits are bounded by max_wait
+            reader.join()
+
+    def _read_samples(self):
+        """ Wait for BLE notifications and return the samples parsed meanwhile. """
+        # should the board get disconnected and we could not wait for notification
+        # anymore, a reco should be attempted through timeout mechanism
+        try:
+            # sleep until data comes, at most until the connection has to be checked
+            delay = self.max_wait
+            if self.timeout > 0:
+                delay = min(delay, self.time_last_packet + self.timeout - timeit.default_timer())
+            if self.waitForNotifications(max(delay, 1. / self.getSampleRate())):
+                # a burst might follow, take what is already there without sleeping again
+                nb_notifications = 1
+                while nb_notifications < self.max_burst and self.waitForNotifications(0):
+                    nb_notifications += 1
+        except Exception as e:
+            print("Something went wrong while waiting for a new sample: " + str(e))
+        # retrieve current samples on the stack
+        samples = self.delegate.getSamples()
+        self.packets_dropped = self.delegate.getMaxPacketsDropped()
+        if self.delegate.ring.overflows != self.samples_overflowed:
+            self.warn("%d samples overwritten, not read in time" %
+                      (self.delegate.ring.overflows - self.samples_overflowed))
+            self.samples_overflowed = self.delegate.ring.overflows
+        if samples:
+            self.time_last_packet = timeit.default_timer()
+
+        # Checking connection -- timeout and packets dropped
+        self.check_connection()
+        return samples
 
     def waitForNotifications(self, delay):
-        """ Allow some time for the board to receive new data. """
-        self.gang.waitForNotifications(delay)
+        """ Allow some time for the board to receive new data, True if a notification came. """
+        return self.gang.waitForNotifications(delay)
 
     def test_signal(self, signal):
         """ Enable / disable test signal """
         if signal == 0:
             self.warn("Disabling synthetic square wave")
             try:
-                self.char_write.write(b']')
+                self.ser_write(b']')
             except Exception as e:
                 print("Something went wrong while setting signal: " + str(e))
         elif signal == 1:
             self.warn("Eisabling synthetic square wave")
             try:
-                self.char_write.write(b'[')
+                self.ser_write(b'[')
             except Exception as e:
                 print("Something went wrong while setting signal: " + str(e))
         else:
@@ -322,23 +426,23 @@ class OpenBCIGanglion(object):
             # Commands to set toggle to on position
             if toggle_position == 1:
                 if channel is 1:
-                    self.ser.write(b'!')
+                    self.ser_write(b'!')
                 if channel is 2:
-                    self.ser.write(b'@')
+                    self.ser_write(b'@')
                 if channel is 3:
-                    self.ser.write(b'#')
+                    self.ser_write(b'#')
                 if channel is 4:
-                    self.ser.write(b'$')
+                    self.ser_write(b'$')
             # Commands to set toggle to off position
             elif toggle_position == 0:
                 if channel is 1:
-                    self.ser.write(b'1')
+                    self.ser_write(b'1')
                 if channel is 2:
-                    self.ser.write(b'2')
+                    self.ser_write(b'2')
                 if channel is 3:
-                    self.ser.write(b'3')
+                    self.ser_write(b'3')
                 if channel is 4:
-                    self.ser.write(b'4')
+                    self.ser_write(b'4')
         except Exception as e:
             print("Something went wrong while setting channels: " + str(e))
 
@@ -349,6 +453,10 @@ class OpenBCIGanglion(object):
     """
 
     def stop(self):
+        self._stop_requested = True
+        self._stop_streaming()
+
+    def _stop_streaming(self):
         print("Stopping streaming...")
         self.streaming = False
         # connection might be already down here
@@ -396,53 +504,209 @@ class OpenBCIGanglion(object):
 
     def check_connection(self):
         """ Check connection quality in term of lag and number of packets drop.
-         Reinit connection if necessary.
-         FIXME: parameters given to the board will be lost.
+         Reinit connection if necessary, settings are sent again from the journal.
          """
         # stop checking when we're no longer streaming
         if not self.streaming:
             return
-        # check number of dropped packets and duration without new packets, deco/reco if too large
-        if self.packets_dropped > self.max_packets_to_skip:
-            self.warn("Too many packets dropped, attempt to reconnect")
-            self.reconnect()
-        elif self.timeout > 0 and timeit.default_timer() - self.time_last_packet > self.timeout:
+        # dropped packets only break the delta chain until the next raw packet, the link is up
+        if self.delegate.chain_breaks != self.chain_breaks:
+            self.chain_breaks = self.delegate.chain_breaks
+            if self.packets_dropped > self.max_packets_to_skip:
+                self.warn("%d packets dropped, samples invalid until the next raw packet" %
+                          self.packets_dropped)
+        # only a duration without new packets means the link is lost, deco/reco then
+        if self.timeout > 0 and timeit.default_timer() - self.time_last_packet > self.timeout:
             self.warn("Too long since got new data, attempt to reconnect")
             # if error, attempt to reconect
             self.reconnect()
 
     def reconnect(self):
-        """ In case of poor connection, will shut down and relaunch everything.
-        FIXME: parameters given to the board will be lost."""
+        """ In case of poor connection, will shut down and relaunch everything. The BLE
+        characteristics of the first connection are reused and the settings recorded in the
+        journal are sent again in one go. """
+        start_time = timeit.default_timer()
         self.warn('Reconnecting')
-        self.stop()
+        self._stop_streaming()
         self.disconnect()
-        self.connect()
+        self.connect(fast=True)
+        try:
+            # BLE writes are 20 bytes at most
+            self.journal.replay(self.char_write.write, chunk_size=20)
+        except Exception as e:
+            print("Something went wrong while sending the settings again: " + str(e))
         self.init_streaming()
+        self.time_to_reconnect = timeit.default_timer() - start_time
+
+
+class GanglionScanner(object):
+    """
+    Looks for BLE devices nearby with bluepy. Any object with the same `scan` method can be
+    used instead, e.g. in tests.
+    """
+
+    def scan(self, timeout, on_device):
+        """
+        Calls `on_device(mac, name)` for every device seen, `name` being its complete local name
+        or None. Stops after `timeout` seconds, or as soon as `on_device` returns True.
+        """
+        found = []
+
+        #   From bluepy example
+        class ScanDelegate(DefaultDelegate):
+            def __init__(self):
+                DefaultDelegate.__init__(self)
+
+            def handleDiscovery(self, dev, isNewDev, isNewData):
+                if isNewDev:
+                    print("Discovered device: " + dev.addr)
+                if not found and on_device(dev.addr,
+                                           dev.getValueText(BLE_AD_COMPLETE_LOCAL_NAME)):
+                    found.append(dev.addr)
+
+        scanner = Scanner().withDelegate(ScanDelegate())
+        scanner.clear()
+        scanner.start()
+        deadline = timeit.default_timer() + timeout
+        try:
+            while not found and timeit.default_timer() < deadline:
+                scanner.process(min(0.1, max(deadline - timeit.default_timer(), 0)))
+        finally:
+            scanner.stop()
 
 
 class OpenBCISample(object):
     """Object encapsulating a single sample from the OpenBCI board."""
 
-    def __init__(self, packet_id, channel_data, aux_data, imp_data):
+    def __init__(self, packet_id, channel_data, aux_data, imp_data, valid=True):
         self.id = packet_id
         self.channel_data = channel_data
         self.aux_data = aux_data
         self.imp_data = imp_data
+        # False when the channel data was computed from deltas following a lost packet
+        self.valid = valid
+
+
+class SampleRing(object):
+    """
+    Preallocated ring of samples: ids, channels, aux and impedance data are rows of fixed size
+    arrays, written in place and claimed by blocks. When the consumer does not keep up the
+    oldest samples are overwritten and counted in `overflows`, memory never grows.
+
+    Handoff without lock between one producer (bluepy notifications, `push`) and one consumer
+    (`pop`), which may run in different threads: the producer only moves the write counters,
+    announcing the rows it is about to write then publishing them once written, the consumer
+    only moves the read counter. Rows the producer might have overwritten while the consumer
+    was copying them are dropped and counted.
+
+    Args:
+      size: number of samples held
+      scale_channels, scale_aux: factors applied while writing, None to keep the counts
+    """
+
+    def __init__(self, size=1024, nb_channels=4, nb_aux=3, nb_imp=5, scale_channels=None,
+                 scale_aux=None):
+        self.size = size
+        self.scale_channels = scale_channels
+        self.scale_aux = scale_aux
+        channels_type = np.int64 if scale_channels is None else np.float64
+        aux_type = np.int64 if scale_aux is None else np.float64
+        self.ids = np.zeros(size, dtype=np.int32)
+        self.channel_data = np.zeros((size, nb_channels), dtype=channels_type)
+        self.aux_data = np.zeros((size, nb_aux), dtype=aux_type)
+        self.imp_data = np.zeros((size, nb_imp), dtype=np.float64)
+        self.valid = np.zeros(size, dtype=bool)
+        # total number of samples ever read and written, positions are taken modulo size
+        self._read = 0
+        self._written = 0
+        self._writing = 0
+        # one counter per side, each only written by its own thread
+        self._overflows_push = 0
+        self._overflows_pop = 0
+
+    def __len__(self):
+        return min(self._written - self._read, self.size)
+
+    @property
+    def overflows(self):
+        return self._overflows_push + self._overflows_pop
+
+    def push(self, ids, channel_data, aux_data, imp_data, valid=True):
+        """
+        Writes a block of samples sharing the same aux and impedance data, and validity.
+        :param ids: list of int - one id per sample
+        :param channel_data: array of shape (len(ids), nb_channels)
+        """
+        nb_samples = len(ids)
+        if nb_samples > self.size:
+            # only the last ones would fit anyway
+            self._overflows_push += nb_samples - self.size
+            ids, channel_data = ids[-self.size:], channel_data[-self.size:]
+            nb_samples = self.size
+        written = self._written
+        # rows about to be written over, before touching them
+        self._writing = written + nb_samples
+        position = written % self.size
+        first = min(nb_samples, self.size - position)
+        # split in two slices when wrapping around the end of the ring
+        for rows, block in [(slice(position, position + first), slice(0, first)),
+                            (slice(0, nb_samples - first), slice(first, nb_samples))]:
+            if rows.start == rows.stop:
+                continue
+            self.ids[rows] = ids[block]
+            if self.scale_channels is None:
+                self.channel_data[rows] = channel_data[block]
+            else:
+                np.multiply(channel_data[block], self.scale_channels,
+                            out=self.channel_data[rows])
+            if self.scale_aux is None:
+                self.aux_data[rows] = aux_data
+            else:
+                np.multiply(aux_data, self.scale_aux, out=self.aux_data[rows])
+            self.imp_data[rows] = imp_data
+            self.valid[rows] = valid
+        # publish the rows only once complete
+        self._written = written + nb_samples
+
+    def pop(self):
+        """ :return: tuple - (ids, channel_data, aux_data, imp_data, valid), copies of the
+            samples written since the last call, oldest first """
+        written = self._written
+        start = max(self._read, written - self.size)
+        indexes = np.arange(start, written) % self.size
+        block = (self.ids[indexes], self.channel_data[indexes], self.aux_data[indexes],
+                 self.imp_data[indexes], self.valid[indexes])
+        # rows written over while copying, or being written, are not to be trusted
+        valid_from = min(max(start, self._writing - self.size), written)
+        self._overflows_pop += valid_from - self._read
+        self._read = written
+        if valid_from > start:
+            block = tuple(array[valid_from - start:] for array in block)
+        return block
 
 
 class GanglionDelegate(DefaultDelegate):
     """ Called by bluepy (handling BLE connection) when new data arrive, parses samples. """
 
-    def __init__(self, scaling_output=True):
+    def __init__(self, scaling_output=True, ring_size=1024):
         DefaultDelegate.__init__(self)
         # holds samples until OpenBCIBoard claims them
-        self.samples = []
+        self.ring = SampleRing(ring_size,
+                               scale_channels=scale_fac_uVolts_per_count if scaling_output
+                               else None,
+                               scale_aux=scale_fac_accel_G_per_count if scaling_output else None)
         # detect gaps between packets
         self.last_id = -1
         self.packets_dropped = 0
         # save uncompressed data to compute deltas
-        self.lastChannelData = [0, 0, 0, 0]
+        self.lastChannelData = np.zeros(4, dtype=np.int64)
+        # deltas are only meaningful from a raw packet with no packet lost since, samples are
+        # marked invalid from a lost packet until the next raw packet (id 0, every 101 packets)
+        self.chain_valid = False
+        self.chain_breaks = 0
+        self.samples_invalid = 0
+        self.time_invalid = 0
+        self._time_chain_broken = None
         # 18bit data got here and then accelerometer with it
         self.lastAcceleromoter = [0, 0, 0]
         # when the board is manually set in the right mode (z to start, Z to stop)
@@ -518,11 +782,13 @@ class GanglionDelegate(DefaultDelegate):
         # 4 channels of 24bits, take values one by one
         for i in range(0, 12, 3):
             chan_data.append(conv24bitsToInt(packet[i:i + 3]))
+        self.updatePacketsCount(packet_id)
+        # full values: the delta chain starts again from here
+        self.anchorChain()
         # save uncompressed raw channel for future use and append whole sample
         self.pushSample(packet_id, chan_data,
                         self.lastAcceleromoter, self.lastImpedance)
-        self.lastChannelData = chan_data
-        self.updatePacketsCount(packet_id)
+        self.lastChannelData = np.array(chan_data, dtype=np.int64)
 
     def parse19bit(self, packet_id, packet):
         """ Dealing with "19-bit compression without Accelerometer" """
@@ -531,22 +797,11 @@ class GanglionDelegate(DefaultDelegate):
                   str(len(packet)) + ' instead of 19 bytes')
             return
 
+        self.updatePacketsCount(packet_id)
         # should get 2 by 4 arrays of uncompressed data
         deltas = decompressDeltas19Bit(packet)
-        # the sample_id will be shifted
-        delta_id = 1
-        for delta in deltas:
-            # convert from packet to sample id
-            sample_id = (packet_id - 1) * 2 + delta_id
-            # 19bit packets hold deltas between two samples
-            # TODO: use more broadly numpy
-            full_data = list(np.array(self.lastChannelData) - np.array(delta))
-            # NB: aux data updated only in 18bit mode, send values here only to be consistent
-            self.pushSample(sample_id, full_data,
-                            self.lastAcceleromoter, self.lastImpedance)
-            self.lastChannelData = full_data
-            delta_id += 1
-        self.updatePacketsCount(packet_id)
+        # NB: aux data updated only in 18bit mode, send values here only to be consistent
+        self.pushDeltas(packet_id, deltas)
 
     def parse18bit(self, packet_id, packet):
         """ Dealing with "18-bit compression without Accelerometer" """
@@ -555,6 +810,7 @@ class GanglionDelegate(DefaultDelegate):
                   str(len(packet)) + ' instead of 19 bytes')
             return
 
+        self.updatePacketsCount(packet_id)
         # accelerometer X
         if packet_id % 10 == 1:
             self.lastAcceleromoter[0] = conv8bitToInt8(packet[18])
@@ -567,19 +823,7 @@ class GanglionDelegate(DefaultDelegate):
 
         # deltas: should get 2 by 4 arrays of uncompressed data
         deltas = decompressDeltas18Bit(packet[:-1])
-        # the sample_id will be shifted
-        delta_id = 1
-        for delta in deltas:
-            # convert from packet to sample id
-            sample_id = (packet_id - 1) * 2 + delta_id
-            # 19bit packets hold deltas between two samples
-            # TODO: use more broadly numpy
-            full_data = list(np.array(self.lastChannelData) - np.array(delta))
-            self.pushSample(sample_id, full_data,
-                            self.lastAcceleromoter, self.lastImpedance)
-            self.lastChannelData = full_data
-            delta_id += 1
-        self.updatePacketsCount(packet_id)
+        self.pushDeltas(packet_id, deltas)
 
     def parseImpedance(self, packet_id, packet):
         """ Dealing with impedance data. packet: ASCII data.
@@ -595,13 +839,42 @@ class GanglionDelegate(DefaultDelegate):
         self.pushSample(packet_id - 200, self.lastChannelData,
                         self.lastAcceleromoter, self.lastImpedance)
 
+    def pushDeltas(self, packet_id, deltas):
+        """ Integrate the 2 samples of a compressed packet and add them to the ring. """
+        # 19bit and 18bit packets hold deltas between two samples
+        channel_data = self.lastChannelData - np.cumsum(deltas, axis=0)
+        # convert from packet to sample id
+        sample_ids = [(packet_id - 1) * 2 + 1, (packet_id - 1) * 2 + 2]
+        self.ring.push(sample_ids, channel_data, self.lastAcceleromoter, self.lastImpedance,
+                       self.chain_valid)
+        if not self.chain_valid:
+            self.samples_invalid += len(sample_ids)
+        self.lastChannelData = channel_data[-1]
+
     def pushSample(self, sample_id, chan_data, aux_data, imp_data):
-        """ Add a sample to inner stack, setting ID and dealing with scaling if necessary. """
-        if self.scaling_output:
-            chan_data = list(np.array(chan_data) * scale_fac_uVolts_per_count)
-            aux_data = list(np.array(aux_data) * scale_fac_accel_G_per_count)
-        sample = OpenBCISample(sample_id, chan_data, aux_data, imp_data)
-        self.samples.append(sample)
+        """ Add a sample to the ring, scaled if necessary. """
+        self.ring.push([sample_id], [chan_data], aux_data, imp_data, self.chain_valid)
+        if not self.chain_valid:
+            self.samples_invalid += 1
+
+    def restart(self):
+        """ New connection: packet ids start over, deltas need a raw packet again. """
+        self.last_id = -1
+        self.breakChain()
+
+    def breakChain(self):
+        """ A packet was lost, channel data are wrong until the next raw packet. """
+        self.chain_breaks += 1
+        if self.chain_valid:
+            self.chain_valid = False
+            self._time_chain_broken = timeit.default_timer()
+
+    def anchorChain(self):
+        """ Raw packet received, channel data are right again. """
+        if self._time_chain_broken is not None:
+            self.time_invalid += timeit.default_timer() - self._time_chain_broken
+            self._time_chain_broken = None
+        self.chain_valid = True
 
     def updatePacketsCount(self, packet_id):
         """Update last packet ID and dropped packets"""
@@ -617,12 +890,30 @@ class GanglionDelegate(DefaultDelegate):
         self.last_id = packet_id
         if self.packets_dropped > 0:
             print("Warning: dropped " + str(self.packets_dropped) + " packets.")
+            self.breakChain()
+
+    def getBlock(self):
+        """ Retrieve and remove from the ring last samples, as arrays (see SampleRing.pop). """
+        return self.ring.pop()
 
     def getSamples(self):
-        """ Retrieve and remove from buffer last samples. """
-        unstack_samples = self.samples
-        self.samples = []
-        return unstack_samples
+        """ Retrieve and remove from the ring last samples. """
+        ids, channel_data, aux_data, imp_data, valid = self.ring.pop()
+        return [OpenBCISample(*sample) for sample in
+                zip(ids.tolist(), channel_data.tolist(), aux_data.tolist(), imp_data.tolist(),
+                    valid.tolist())]
+
+    def getChainState(self):
+        """ Validity of the delta chain, for metrics. """
+        time_invalid = self.time_invalid
+        if self._time_chain_broken is not None:
+            time_invalid += timeit.default_timer() - self._time_chain_broken
+        return {
+            'valid': self.chain_valid,
+            'breaks': self.chain_breaks,
+            'samples_invalid': self.samples_invalid,
+            'seconds_invalid': time_invalid
+        }
 
     def getMaxPacketsDropped(self):
         """ While processing last samples, how many packets were dropped?"""
@@ -701,6 +992,75 @@ def conv8bitToInt8(byte):
         return byte
 
 
+"""
+  Compressed packets hold 8 deltas (2 samples x 4 channels) packed as consecutive big endian
+  fields of 19 bits (18 bits when the last byte carries the accelerometer). The least
+  significant bit of a field is its sign. Fields are unpacked with a table of (first byte,
+  shift) per field, from the whole packet as a single integer or from a block of packets at
+  once with numpy.
+
+"""
+
+
+def makeDeltasTable(bits):
+    """ For each of the 8 fields: first byte holding it, right shift of the 32 bits word read
+    from that byte. """
+    first_bytes = [bits * i // 8 for i in range(8)]
+    shifts = [32 - bits - (bits * i) % 8 for i in range(8)]
+    return first_bytes, shifts
+
+
+DELTAS_TABLES = {
+    19: makeDeltasTable(19),
+    18: makeDeltasTable(18)
+}
+
+
+def decompressDeltas(buffer, bits):
+    """
+    Table driven decoding of one compressed packet.
+    buffer: the data portion of the packet, 19 bytes for 19 bits fields, 18 bytes for 18 bits
+    return {Array} - An array of deltas of shape 2x4
+    """
+    size = bits  # 8 fields of `bits` bits are `bits` bytes
+    if len(buffer) != size:
+        raise ValueError("Input should be %d bytes long." % size)
+    # whole packet as a single integer, fields are read from the end
+    packed = int(binascii.hexlify(bytearray(buffer)), 16)
+    mask = (1 << bits) - 1
+    sign = 1 << bits
+    deltas = []
+    for i in range(8):
+        field = (packed >> (bits * (7 - i))) & mask
+        deltas.append(field - sign if field & 1 else field)
+    return [deltas[:4], deltas[4:]]
+
+
+def decompressDeltasBlock(packets, bits):
+    """
+    Table driven decoding of a block of compressed packets at once.
+    packets: bytes of the data portions one after the other, or array of shape (n, bits)
+    return {numpy.ndarray} - int32 deltas of shape (n, 2, 4)
+    """
+    size = bits
+    packets = np.frombuffer(packets, dtype=np.uint8) if isinstance(packets, (bytes, bytearray))\
+        else np.asarray(packets, dtype=np.uint8)
+    if packets.size % size:
+        raise ValueError("Input should be made of %d bytes long packets." % size)
+    packets = packets.reshape(-1, size)
+    first_bytes, shifts = DELTAS_TABLES[bits]
+    # 3 bytes of padding, the last fields are read as a 32 bits word too
+    padded = np.zeros((len(packets), size + 3), dtype=np.uint32)
+    padded[:, :size] = packets
+    index = np.array(first_bytes)[:, None] + np.arange(4)
+    words = padded[:, index]
+    words = (words[:, :, 0] << 24) | (words[:, :, 1] << 16) | (words[:, :, 2] << 8) | \
+        words[:, :, 3]
+    fields = ((words >> np.array(shifts, dtype=np.uint32)) & ((1 << bits) - 1)).astype(np.int32)
+    fields -= (fields & 1) << bits
+    return fields.reshape(-1, 2, 4)
+
+
 def decompressDeltas19Bit(buffer):
     """
     Called to when a compressed packet is received.
@@ -708,149 +1068,14 @@ def decompressDeltas19Bit(buffer):
     return {Array} - An array of deltas of shape 2x4
     (2 samples per packet and 4 channels per sample.)
     """
-    if len(buffer) != 19:
-        raise ValueError("Input should be 19 bytes long.")
-
-    receivedDeltas = [[0, 0, 0, 0], [0, 0, 0, 0]]
-
-    # Sample 1 - Channel 1
-    miniBuf = [
-        (buffer[0] >> 5),
-        ((buffer[0] & 0x1F) << 3 & 0xFF) | (buffer[1] >> 5),
-        ((buffer[1] & 0x1F) << 3 & 0xFF) | (buffer[2] >> 5)
-    ]
-
-    receivedDeltas[0][0] = conv19bitToInt32(miniBuf)
-
-    # Sample 1 - Channel 2
-    miniBuf = [
-        (buffer[2] & 0x1F) >> 2,
-        (buffer[2] << 6 & 0xFF) | (buffer[3] >> 2),
-        (buffer[3] << 6 & 0xFF) | (buffer[4] >> 2)
-    ]
-    receivedDeltas[0][1] = conv19bitToInt32(miniBuf)
-
-    # Sample 1 - Channel 3
-    miniBuf = [
-        ((buffer[4] & 0x03) << 1 & 0xFF) | (buffer[5] >> 7),
-        ((buffer[5] & 0x7F) << 1 & 0xFF) | (buffer[6] >> 7),
-        ((buffer[6] & 0x7F) << 1 & 0xFF) | (buffer[7] >> 7)
-    ]
-    receivedDeltas[0][2] = conv19bitToInt32(miniBuf)
-
-    # Sample 1 - Channel 4
-    miniBuf = [
-        ((buffer[7] & 0x7F) >> 4),
-        ((buffer[7] & 0x0F) << 4 & 0xFF) | (buffer[8] >> 4),
-        ((buffer[8] & 0x0F) << 4 & 0xFF) | (buffer[9] >> 4)
-    ]
-    receivedDeltas[0][3] = conv19bitToInt32(miniBuf)
-
-    # Sample 2 - Channel 1
-    miniBuf = [
-        ((buffer[9] & 0x0F) >> 1),
-        (buffer[9] << 7 & 0xFF) | (buffer[10] >> 1),
-        (buffer[10] << 7 & 0xFF) | (buffer[11] >> 1)
-    ]
-    receivedDeltas[1][0] = conv19bitToInt32(miniBuf)
-
-    # Sample 2 - Channel 2
-    miniBuf = [
-        ((buffer[11] & 0x01) << 2 & 0xFF) | (buffer[12] >> 6),
-        (buffer[12] << 2 & 0xFF) | (buffer[13] >> 6),
-        (buffer[13] << 2 & 0xFF) | (buffer[14] >> 6)
-    ]
-    receivedDeltas[1][1] = conv19bitToInt32(miniBuf)
-
-    # Sample 2 - Channel 3
-    miniBuf = [
-        ((buffer[14] & 0x38) >> 3),
-        ((buffer[14] & 0x07) << 5 & 0xFF) | ((buffer[15] & 0xF8) >> 3),
-        ((buffer[15] & 0x07) << 5 & 0xFF) | ((buffer[16] & 0xF8) >> 3)
-    ]
-    receivedDeltas[1][2] = conv19bitToInt32(miniBuf)
-
-    # Sample 2 - Channel 4
-    miniBuf = [(buffer[16] & 0x07), buffer[17], buffer[18]]
-    receivedDeltas[1][3] = conv19bitToInt32(miniBuf)
-
-    return receivedDeltas
+    return decompressDeltas(buffer, 19)
 
 
 def decompressDeltas18Bit(buffer):
     """
     Called to when a compressed packet is received.
-    buffer: Just the data portion of the sample. So 19 bytes.
+    buffer: Just the data portion of the sample. So 18 bytes.
     return {Array} - An array of deltas of shape 2x4
     (2 samples per packet and 4 channels per sample.)
     """
-    if len(buffer) != 18:
-        raise ValueError("Input should be 18 bytes long.")
-
-    receivedDeltas = [[0, 0, 0, 0], [0, 0, 0, 0]]
-
-    # Sample 1 - Channel 1
-    miniBuf = [
-        (buffer[0] >> 6),
-        ((buffer[0] & 0x3F) << 2 & 0xFF) | (buffer[1] >> 6),
-        ((buffer[1] & 0x3F) << 2 & 0xFF) | (buffer[2] >> 6)
-    ]
-    receivedDeltas[0][0] = conv18bitToInt32(miniBuf)
-
-    # Sample 1 - Channel 2
-    miniBuf = [
-        (buffer[2] & 0x3F) >> 4,
-        (buffer[2] << 4 & 0xFF) | (buffer[3] >> 4),
-        (buffer[3] << 4 & 0xFF) | (buffer[4] >> 4)
-    ]
-    receivedDeltas[0][1] = conv18bitToInt32(miniBuf)
-
-    # Sample 1 - Channel 3
-    miniBuf = [
-        (buffer[4] & 0x0F) >> 2,
-        (buffer[4] << 6 & 0xFF) | (buffer[5] >> 2),
-        (buffer[5] << 6 & 0xFF) | (buffer[6] >> 2)
-    ]
-    receivedDeltas[0][2] = conv18bitToInt32(miniBuf)
-
-    # Sample 1 - Channel 4
-    miniBuf = [
-        (buffer[6] & 0x03),
-        buffer[7],
-        buffer[8]
-    ]
-    receivedDeltas[0][3] = conv18bitToInt32(miniBuf)
-
-    # Sample 2 - Channel 1
-    miniBuf = [
-        (buffer[9] >> 6),
-        ((buffer[9] & 0x3F) << 2 & 0xFF) | (buffer[10] >> 6),
-        ((buffer[10] & 0x3F) << 2 & 0xFF) | (buffer[11] >> 6)
-    ]
-    receivedDeltas[1][0] = conv18bitToInt32(miniBuf)
-
-    # Sample 2 - Channel 2
-    miniBuf = [
-        (buffer[11] & 0x3F) >> 4,
-        (buffer[11] << 4 & 0xFF) | (buffer[12] >> 4),
-        (buffer[12] << 4 & 0xFF) | (buffer[13] >> 4)
-    ]
-    receivedDeltas[1][1] = conv18bitToInt32(miniBuf)
-
-    # Sample 2 - Channel 3
-    miniBuf = [
-        (buffer[13] & 0x0F) >> 2,
-        (buffer[13] << 6 & 0xFF) | (buffer[14] >> 2),
-        (buffer[14] << 6 & 0xFF) | (buffer[15] >> 2)
-    ]
-    receivedDeltas[1][2] = conv18bitToInt32(miniBuf)
-
-    # Sample 2 - Channel 4
-    miniBuf = [
-        (buffer[15] & 0x03),
-        buffer[16],
-        buffer[17]
-    ]
-    receivedDeltas[1][3] = conv18bitToInt32(miniBuf)
-
-    return receivedDeltas
+    return decompressDeltas(buffer, 18)
@@ -1,6 +1,13 @@
+from .acquisition import *
+from .cache import DeviceCache
+from .capture import RawCapture, read_capture
 from .constants import Constants as k
+from .gaps import SampleGapDetector
+from .journal import CommandJournal, CYTON_COMMAND_LENGTHS
 from .parse import *
 from .ssdp import SSDPResponse
+from .time_sync import ClockSync
 from .utilities import *
+from .watchdog import *
 
 __version__ = "1.0.0"
@@ -0,0 +1,164 @@
+import threading
+import timeit
+from collections import deque
+
+from openbci.utils.constants import Constants as k
+
+
+class SampleQueue(object):
+    """
+    Bounded FIFO between the thread reading the board and the thread calling the plugins.
+
+    What happens when the queue is full depends on the policy:
+      - block: the producer waits for some room, data piles up in the OS buffers instead
+      - drop-oldest: the oldest sample is discarded to make room for the new one
+      - drop-newest: the new sample is discarded
+
+    Counters:
+      high_water_mark: maximum number of samples waiting at once
+      overflows: number of samples discarded, or number of times the producer had to wait
+        with the blocking policy
+    """
+
+    def __init__(self, maxsize=1024, policy=k.QUEUE_POLICY_BLOCK):
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        if policy not in (k.QUEUE_POLICY_BLOCK, k.QUEUE_POLICY_DROP_NEWEST,
+                          k.QUEUE_POLICY_DROP_OLDEST):
+            raise ValueError('Unknown queue policy %s' % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.high_water_mark = 0
+        self.overflows = 0
+        self.closed = False
+        self._samples = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def qsize(self):
+        return len(self._samples)
+
+    def put(self, sample, timeout=None):
+        """ Add one sample, returns False if it was discarded. """
+        return self.put_many([sample], timeout=timeout) == 1
+
+    def put_many(self, samples, timeout=None):
+        """
+        Add several samples, taking the lock only once.
+        :param timeout: with the blocking policy, maximum time to wait for room in seconds
+        :return: int - number of samples actually queued
+        """
+        queued = 0
+        with self._lock:
+            for sample in samples:
+                if len(self._samples) >= self.maxsize:
+                    if self.policy == k.QUEUE_POLICY_DROP_NEWEST:
+                        self.overflows += 1
+                        continue
+                    elif self.policy == k.QUEUE_POLICY_DROP_OLDEST:
+                        self._samples.popleft()
+                        self.overflows += 1
+                    else:
+                        self.overflows += 1
+                        if not self._wait_for_room(timeout):
+                            break
+                self._samples.append(sample)
+                queued += 1
+            if len(self._samples) > self.high_water_mark:
+                self.high_water_mark = len(self._samples)
+            if queued:
+                self._not_empty.notify()
+        return queued
+
+    def _wait_for_room(self, timeout):
+        # called with the lock held
+        deadline = None if timeout is None else timeit.default_timer() + timeout
+        while len(self._samples) >= self.maxsize and not self.closed:
+            if deadline is None:
+                self._not_full.wait()
+            else:
+                remaining = deadline - timeit.default_timer()
+                if remaining <= 0:
+                    return False
+                self._not_full.wait(remaining)
+        return not self.closed
+
+    def get_all(self, timeout=None):
+        """
+        Remove and return every sample waiting, waits for at least one unless `timeout` expires.
+        :return: list - possibly empty if timeout expired or queue was closed
+        """
+        with self._lock:
+            if not self._samples and not self.closed:
+                self._not_empty.wait(timeout)
+            samples = list(self._samples)
+            self._samples.clear()
+            if samples:
+                self._not_full.notify_all()
+        return samples
+
+    def close(self):
+        """ Wake up any thread waiting on the queue. """
+        with self._lock:
+            self.closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+
+
+class AcquisitionThread(threading.Thread):
+    """
+    Calls `read` in a loop and pushes the samples it returns to `sample_queue`.
+    `read` should block until new data is available and return a list of samples.
+    An exception raised by `read` ends the thread and is kept in `error`, unless the thread
+    was stopped already.
+    """
+
+    def __init__(self, read, sample_queue, name='OpenBCI acquisition'):
+        threading.Thread.__init__(self, name=name)
+        # the serial / BLE read might block forever, do not prevent the interpreter to exit
+        self.daemon = True
+        self.read = read
+        self.sample_queue = sample_queue
+        self.running = True
+        self.error = None
+
+    def run(self):
+        try:
+            while self.running:
+                samples = self.read()
+                if samples:
+                    self.sample_queue.put_many(samples)
+        except Exception as error:
+            # a read cancelled by stop() is not an error
+            if self.running:
+                self.error = error
+        finally:
+            self.sample_queue.close()
+
+    def stop(self):
+        self.running = False
+
+
+class DispatcherThread(threading.Thread):
+    """ Drains `sample_queue` and gives every sample to every callback. """
+
+    def __init__(self, sample_queue, callbacks, name='OpenBCI dispatcher'):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.sample_queue = sample_queue
+        self.callbacks = callbacks
+        self.running = True
+
+    def run(self):
+        while self.running:
+            samples = self.sample_queue.get_all(timeout=0.1)
+            if not samples and self.sample_queue.closed:
+                break
+            for sample in samples:
+                for call in self.callbacks:
+                    call(sample)
+
+    def stop(self):
+        self.running = False
+        self.sample_queue.close()
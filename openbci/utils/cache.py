@@ -0,0 +1,94 @@
+import json
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.openbci', 'devices.json')
+
+
+class DeviceCache(object):
+    """
+    Small on-disk cache remembering devices found during previous runs, e.g. the serial port
+    of a dongle or the address of a board, so they can be tried first next time.
+
+    The file is a JSON object of sections, each a mapping key -> (value, time stored). The cache
+    is only a hint: a file that cannot be read or written is ignored.
+
+    Args:
+      section: name of the section used by this instance, e.g. 'cyton'
+      path: JSON file, defaults to ~/.openbci/devices.json, or $OPENBCI_CACHE if set
+      ttl: seconds after which an entry is ignored, 0 to keep entries forever
+    """
+
+    _lock = threading.Lock()
+
+    def __init__(self, section, path=None, ttl=0):
+        self.section = section
+        self.path = path or os.environ.get('OPENBCI_CACHE', DEFAULT_CACHE_PATH)
+        self.ttl = ttl
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                content = json.load(f)
+            if isinstance(content, dict):
+                return content
+        except (IOError, OSError, ValueError):
+            pass
+        return {}
+
+    def _save(self, content):
+        folder = os.path.dirname(self.path)
+        try:
+            if folder and not os.path.isdir(folder):
+                os.makedirs(folder)
+            # write aside then rename, another process might be reading the file
+            fd, tmp_path = tempfile.mkstemp(dir=folder or None, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(content, f, indent=2, sort_keys=True)
+            if os.name == 'nt' and os.path.exists(self.path):
+                # os.rename does not overwrite on Windows
+                os.remove(self.path)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def items(self):
+        """ :return: dict - key -> value of the entries still valid in the section """
+        with self._lock:
+            section = self._load().get(self.section, {})
+        now = time.time()
+        return dict((key, entry[0]) for key, entry in section.items()
+                    if self.ttl <= 0 or now - entry[1] <= self.ttl)
+
+    def latest(self, value=None):
+        """
+        :param value: only consider the entries holding this value, any if None
+        :return: tuple - (key, value) of the valid entry stored last, None if there is none
+        """
+        with self._lock:
+            section = self._load().get(self.section, {})
+        now = time.time()
+        entries = [(entry[1], key, entry[0]) for key, entry in section.items()
+                   if (self.ttl <= 0 or now - entry[1] <= self.ttl) and
+                   (value is None or entry[0] == value)]
+        if not entries:
+            return None
+        _, key, value = max(entries)
+        return key, value
+
+    def get(self, key, default=None):
+        return self.items().get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            content = self._load()
+            content.setdefault(self.section, {})[key] = (value, time.time())
+            self._save(content)
+
+    def remove(self, key):
+        with self._lock:
+            content = self._load()
+            if content.get(self.section, {}).pop(key, None) is not None:
+                self._save(content)
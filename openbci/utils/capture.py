@@ -0,0 +1,120 @@
+import errno
+import os
+import struct
+import threading
+import time
+
+CAPTURE_MAGIC = b'OBCIRAW1'
+# per chunk: arrival time (seconds since epoch) and number of bytes
+CAPTURE_CHUNK_HEADER = struct.Struct('<dI')
+
+
+class RawCapture(object):
+    """
+    Records raw bytes exactly as read from the board, before any parsing, so that a lossless
+    archive is kept and any format can be rebuilt later with `read_capture`.
+
+    File format: CAPTURE_MAGIC, then for every chunk read a CAPTURE_CHUNK_HEADER followed by
+    the bytes of the chunk. Writes go through a large buffer, the file is only touched once
+    per `buffer_size` bytes.
+
+    Rotation: once a file is larger than `max_bytes`, the next chunk goes to a new file named
+    after `path` with an increasing suffix: capture.raw, capture.raw.1, capture.raw.2...
+    No file is ever overwritten nor deleted: an OSError is raised if `path` already exists,
+    suffixes already used are skipped. `files` lists the files of this capture.
+
+    `write` and `close` can be called from different threads, chunks written once closed are
+    dropped.
+
+    Args:
+      path: first file of the capture
+      max_bytes: rotate after that many bytes, 0 to keep a single file
+      buffer_size: bytes kept in memory between two writes to the disk
+    """
+
+    def __init__(self, path, max_bytes=0, buffer_size=1 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.buffer_size = buffer_size
+        self.files = []
+        self.bytes_captured = 0
+        self.chunks_captured = 0
+        self._file = None
+        self._file_size = 0
+        self._suffix = 0
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        if not self.files:
+            path, fd = self.path, _create(self.path)
+        else:
+            fd = None
+            while fd is None:
+                self._suffix += 1
+                path = '%s.%d' % (self.path, self._suffix)
+                try:
+                    fd = _create(path)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+        self._file = os.fdopen(fd, 'wb', self.buffer_size)
+        self._file.write(CAPTURE_MAGIC)
+        self._file_size = len(CAPTURE_MAGIC)
+        self.files.append(path)
+
+    def write(self, data, timestamp=None):
+        """ Record one chunk, `timestamp` defaults to now. """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            if self._file is None:
+                return
+            if self.max_bytes > 0 and self._file_size > self.max_bytes:
+                self._file.close()
+                self._open()
+            self._file.write(CAPTURE_CHUNK_HEADER.pack(timestamp, len(data)))
+            self._file.write(data)
+            self._file_size += CAPTURE_CHUNK_HEADER.size + len(data)
+            self.bytes_captured += len(data)
+            self.chunks_captured += 1
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def _create(path):
+    """ Creates the file, OSError if it already exists. """
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0))
+
+
+def read_capture(paths):
+    """
+    Reads back files written by RawCapture.
+    :param paths: str or list of str - files of the capture, in order
+    :return: generator of (timestamp, bytes) - one per chunk read from the board
+    """
+    if not isinstance(paths, (list, tuple)):
+        paths = [paths]
+    for path in paths:
+        with open(path, 'rb') as f:
+            if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+                raise ValueError('%s is not a raw capture' % path)
+            while True:
+                header = f.read(CAPTURE_CHUNK_HEADER.size)
+                if len(header) < CAPTURE_CHUNK_HEADER.size:
+                    # end of file, or capture interrupted while writing
+                    break
+                timestamp, size = CAPTURE_CHUNK_HEADER.unpack(header)
+                data = f.read(size)
+                if len(data) < size:
+                    break
+                yield timestamp, data
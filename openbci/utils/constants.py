@@ -18,6 +18,15 @@ class Constants:
 
     CYTON_ACCEL_SCALE_FACTOR_GAIN = 0.002 / (pow(2, 4))  # assume set to +/4G, so 2 mG
 
+    """ Cyton dongle baud rates and the radio commands to switch to them """
+    CYTON_BAUD_RATE_DEFAULT = 115200
+    CYTON_BAUD_RATE_HIGH = 230400
+    CYTON_BAUD_RATE_HYPER = 921600
+    CYTON_COMMAND_BAUD_RATE_DEFAULT = b'\xf0\x05'
+    CYTON_COMMAND_BAUD_RATE_HIGH = b'\xf0\x06'
+    CYTON_COMMAND_BAUD_RATE_HYPER = b'\xf0\x0a'
+    CYTON_COMMAND_RADIO_SYSTEM_STATUS = b'\xf0\x07'
+
     """ Errors """
     ERROR_INVALID_BYTE_LENGTH = 'Invalid Packet Byte Length'
     ERROR_INVALID_BYTE_START = 'Invalid Start Byte'
@@ -44,6 +53,10 @@ class Constants:
     RAW_BYTE_START = 0xA0
     RAW_BYTE_STOP = 0xC0
     RAW_PACKET_ACCEL_NUMBER_AXIS = 3
+    # time synced packets carry one accelerometer axis, chosen by sample number % 10
+    RAW_PACKET_ACCEL_AXIS_X = 7
+    RAW_PACKET_ACCEL_AXIS_Y = 8
+    RAW_PACKET_ACCEL_AXIS_Z = 9
     RAW_PACKET_SIZE = 33
     """
     OpenBCI Raw Packet Positions
@@ -71,6 +84,15 @@ class Constants:
     RAW_PACKET_TYPE_RAW_AUX_TIME_SYNCED = 6  # 0110
     RAW_PACKET_TYPE_IMPEDANCE = 7  # 0111
 
+    """ Sample queue policies when full """
+    QUEUE_POLICY_BLOCK = 'block'
+    QUEUE_POLICY_DROP_NEWEST = 'drop-newest'
+    QUEUE_POLICY_DROP_OLDEST = 'drop-oldest'
+
+    """ Placeholder samples for lost samples """
+    GAP_FILL_NAN = 'nan'
+    GAP_FILL_INTERPOLATE = 'interpolate'
+
     """ Max sample number """
     SAMPLE_NUMBER_MAX_CYTON = 255
     SAMPLE_NUMBER_MAX_GANGLION = 200
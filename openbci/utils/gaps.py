@@ -0,0 +1,123 @@
+import copy
+from collections import deque
+
+from openbci.utils.constants import Constants as k
+
+# sample attributes holding one value per channel / axis
+DATA_FIELDS = ('channel_data', 'aux_data', 'accel_data', 'imp_data')
+
+
+class SampleGapDetector(object):
+    """
+    Finds the samples lost in a stream from the sample counter of the boards, which wraps
+    around after `max_sample_number`.
+
+    Placeholders can be inserted in place of the lost samples so that downstream code sees one
+    sample per sampling period:
+      - Constants.GAP_FILL_NAN: channels and aux values are NaN
+      - Constants.GAP_FILL_INTERPOLATE: linear interpolation between the samples around the gap
+    Placeholders are copies of the sample following the gap, with their own id, their data
+    (channel_data, aux_data, accel_data, imp_data) filled and `valid` False.
+
+    Counters:
+      samples_received, samples_lost: since the last reset
+      loss_rate(): ratio of lost samples since the last reset
+      window_loss_rate(): ratio of lost samples over the last `window` received samples
+
+    Args:
+      fill: None to only count, or one of Constants.GAP_FILL_*
+      step: difference between two consecutive ids, e.g. 2 for a Cyton with daisy module
+      max_fill: gaps larger than this are counted but not filled
+    """
+
+    def __init__(self, fill=None, max_sample_number=k.SAMPLE_NUMBER_MAX_CYTON, step=1,
+                 window=1000, max_fill=k.SAMPLE_NUMBER_MAX_CYTON):
+        if fill not in (None, k.GAP_FILL_NAN, k.GAP_FILL_INTERPOLATE):
+            raise ValueError('Unknown gap fill %s' % fill)
+        self.fill = fill
+        self.modulo = max_sample_number + 1
+        self.step = step
+        self.max_fill = max_fill
+        self.samples_received = 0
+        self.samples_lost = 0
+        self.duplicates = 0
+        self._window = deque(maxlen=window)
+        self._window_lost = 0
+        self._last = None
+
+    def reset(self):
+        """ Forget the last sample, e.g. when the stream restarts. Counters are kept. """
+        self._last = None
+
+    def process(self, sample):
+        """
+        :return: list - the placeholders for the samples lost just before `sample`, if any,
+            followed by `sample` itself
+        """
+        last = self._last
+        self._last = sample
+        self.samples_received += 1
+        lost = 0
+        if last is not None:
+            lost = ((sample.id - last.id - self.step) % self.modulo) // self.step
+            if sample.id == last.id:
+                # sent twice, not a full turn of the counter
+                self.duplicates += 1
+                lost = 0
+        self.samples_lost += lost
+        if len(self._window) == self._window.maxlen:
+            self._window_lost -= self._window[0]
+        self._window.append(lost)
+        self._window_lost += lost
+
+        if not lost or self.fill is None or lost > self.max_fill:
+            return [sample]
+        return self._placeholders(last, sample, lost) + [sample]
+
+    def process_many(self, samples):
+        if self.fill is None:
+            for sample in samples:
+                self.process(sample)
+            return samples
+        filled = []
+        for sample in samples:
+            filled.extend(self.process(sample))
+        return filled
+
+    def _placeholders(self, last, sample, lost):
+        placeholders = []
+        for i in range(1, lost + 1):
+            # nothing shared with the real sample, downstream code might modify either
+            placeholder = copy.deepcopy(sample)
+            placeholder.id = (last.id + i * self.step) % self.modulo
+            if hasattr(placeholder, 'sample_number'):
+                placeholder.sample_number = placeholder.id
+            placeholder.valid = False
+            ratio = float(i) / (lost + 1)
+            for field in DATA_FIELDS:
+                values = getattr(sample, field, None)
+                if not isinstance(values, list):
+                    # e.g. the lower / upper aux data of WiFi daisy samples
+                    continue
+                if self.fill == k.GAP_FILL_NAN:
+                    setattr(placeholder, field, [float('nan')] * len(values))
+                else:
+                    setattr(placeholder, field,
+                            _interpolate(getattr(last, field, None), values, ratio))
+            placeholders.append(placeholder)
+        return placeholders
+
+    def loss_rate(self):
+        expected = self.samples_received + self.samples_lost
+        return float(self.samples_lost) / expected if expected else 0.
+
+    def window_loss_rate(self):
+        expected = len(self._window) + self._window_lost
+        return float(self._window_lost) / expected if expected else 0.
+
+
+def _interpolate(before, after, ratio):
+    if not isinstance(before, list) or len(before) != len(after):
+        # e.g. no accelerometer data in the sample before the gap
+        return [float('nan')] * len(after)
+    return [a + (b - a) * ratio for a, b in zip(before, after)]
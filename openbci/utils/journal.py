@@ -0,0 +1,124 @@
+from collections import OrderedDict
+
+# commands made of several bytes: first byte -> total length, e.g. x1060110X
+CYTON_COMMAND_LENGTHS = {
+    ord('x'): 9,  # channel settings
+    ord('z'): 5,  # lead-off (impedance) settings
+    ord('/'): 2,  # board mode
+    ord('~'): 2  # sample rate
+}
+
+CHANNELS_OFF = b'12345678qwertyui'
+CHANNELS_ON = b'!@#$%^&*QWERTYUI'
+TEST_SIGNALS = b'0p-=[]'
+FILTERS = b'fg'
+ACCELEROMETER = b'nN'
+# settings set back to their default value by the 'd' command
+CHANNEL_SETTINGS = ('channel', 'channel_settings', 'lead_off')
+
+
+def command_key(command):
+    """
+    Setting changed by a command, the commands changing the same setting override each other.
+    :param command: bytes - one complete command
+    :return: str or tuple - the setting, None if the command does not change any, 'reset'
+        when it sets the board back to its defaults
+    """
+    first = bytearray(command)[0]
+    if first in bytearray(CHANNELS_OFF):
+        return 'channel', bytearray(CHANNELS_OFF).index(first)
+    if first in bytearray(CHANNELS_ON):
+        return 'channel', bytearray(CHANNELS_ON).index(first)
+    if first in bytearray(TEST_SIGNALS):
+        return 'test_signal'
+    if first in bytearray(FILTERS):
+        return 'filters'
+    if first in bytearray(ACCELEROMETER):
+        return 'accelerometer'
+    if len(command) > 1:
+        if first == ord('x'):
+            return 'channel_settings', bytes(command[1:2])
+        if first == ord('z'):
+            return 'lead_off', bytes(command[1:2])
+        if first == ord('/'):
+            return 'board_mode'
+        if first == ord('~'):
+            return 'sample_rate'
+    if first == ord('d'):
+        return 'defaults'
+    if first == ord('v'):
+        return 'reset'
+    return None
+
+
+class CommandJournal(object):
+    """
+    Remembers the settings commands sent to a board so they can be sent again after a
+    reconnection. Only the effective state is kept: the last command of each setting, in the
+    order they were last sent. Commands that do not change a setting (start, stop...) are not
+    recorded, a soft reset ('v') forgets everything.
+
+    Bytes may be recorded one by one, commands of several bytes are put back together.
+
+    Args:
+      command_lengths: first byte -> length of the commands of several bytes, e.g.
+        CYTON_COMMAND_LENGTHS
+    """
+
+    def __init__(self, command_lengths=None):
+        self.command_lengths = command_lengths or {}
+        self._settings = OrderedDict()
+        self._partial = bytearray()
+
+    def record(self, data):
+        for byte in bytearray(data):
+            if self._partial:
+                self._partial.append(byte)
+                if len(self._partial) < self.command_lengths[self._partial[0]]:
+                    continue
+                command = bytes(self._partial)
+                self._partial = bytearray()
+            elif byte in self.command_lengths:
+                self._partial = bytearray([byte])
+                continue
+            else:
+                command = bytes(bytearray([byte]))
+            self._record_command(command)
+
+    def _record_command(self, command):
+        key = command_key(command)
+        if key is None:
+            return
+        if key == 'reset':
+            self.clear()
+            return
+        if key == 'defaults':
+            for setting in list(self._settings):
+                if isinstance(setting, tuple) and setting[0] in CHANNEL_SETTINGS:
+                    del self._settings[setting]
+        # moved to the end, the order of the last commands is kept
+        self._settings.pop(key, None)
+        self._settings[key] = command
+
+    def clear(self):
+        self._settings.clear()
+        self._partial = bytearray()
+
+    def commands(self):
+        """ :return: list of bytes - the commands to send to get the current settings back """
+        return list(self._settings.values())
+
+    def replay(self, write, chunk_size=0):
+        """
+        Sends all the commands at once.
+        :param write: function writing bytes to the board
+        :param chunk_size: at most that many bytes per write, 0 for a single write
+        :return: bytes - what was written
+        """
+        data = b''.join(self.commands())
+        if not data:
+            return data
+        step = chunk_size if chunk_size > 0 else len(data)
+        for start in range(0, len(data), step):
+            write(data[start:start + step])
+        return data
@@ -1,8 +1,16 @@
+import json
 import time
 import struct
 
+import numpy as np
+
 from openbci.utils.constants import Constants as k
 
+TIME_SYNC_SET_PACKET_TYPES = (k.RAW_PACKET_TYPE_ACCEL_TIME_SYNC_SET,
+                              k.RAW_PACKET_TYPE_RAW_AUX_TIME_SYNC_SET)
+# scale factors of every (gains, micro_volts) already computed, shared by all parsers
+_scale_factors_cache = {}
+
 
 class ParseRaw(object):
     def __init__(self,
@@ -26,6 +34,20 @@ class ParseRaw(object):
                                                   scale_factors=self.scale_factors,
                                                   verbose=log)
 
+        # one parser per stop byte 0xC0 - 0xCF, indexed by packet type
+        self.packet_parsers = [self.parse_packet_unsupported] * 16
+        self.packet_parsers[k.RAW_PACKET_TYPE_STANDARD_ACCEL] = self.parse_packet_standard_accel
+        self.packet_parsers[k.RAW_PACKET_TYPE_STANDARD_RAW_AUX] = \
+            self.parse_packet_standard_raw_aux
+        self.packet_parsers[k.RAW_PACKET_TYPE_ACCEL_TIME_SYNC_SET] = \
+            self.parse_packet_time_synced_accel
+        self.packet_parsers[k.RAW_PACKET_TYPE_ACCEL_TIME_SYNCED] = \
+            self.parse_packet_time_synced_accel
+        self.packet_parsers[k.RAW_PACKET_TYPE_RAW_AUX_TIME_SYNC_SET] = \
+            self.parse_packet_time_synced_raw_aux
+        self.packet_parsers[k.RAW_PACKET_TYPE_RAW_AUX_TIME_SYNCED] = \
+            self.parse_packet_time_synced_raw_aux
+
     def is_stop_byte(self, byte):
         """
         Used to check and see if a byte adheres to the stop byte structure
@@ -36,18 +58,20 @@ class ParseRaw(object):
         return (byte & 0xF0) == k.RAW_BYTE_STOP
 
     def get_ads1299_scale_factors(self, gains, micro_volts=None):
-        out = []
-        for gain in gains:
-            scale_factor = k.ADS1299_VREF / float((pow(2, 23) - 1)) / float(gain)
-            if micro_volts is None:
-                if self.micro_volts:
-                    scale_factor *= 1000000.
-            else:
+        if micro_volts is None:
+            micro_volts = self.micro_volts
+        key = (tuple(gains), bool(micro_volts))
+        cached = _scale_factors_cache.get(key)
+        if cached is None:
+            cached = []
+            for gain in gains:
+                scale_factor = k.ADS1299_VREF / float((pow(2, 23) - 1)) / float(gain)
                 if micro_volts:
                     scale_factor *= 1000000.
-
-            out.append(scale_factor)
-        return out
+                cached.append(scale_factor)
+            _scale_factors_cache[key] = cached
+        # callers own the list they get
+        return list(cached)
 
     def get_channel_data_array(self, raw_data_to_sample):
         """
@@ -96,19 +120,12 @@ class ParseRaw(object):
         return struct.unpack('>h', two_byte_buffer)[0]
 
     def interpret_24_bit_as_int_32(self, three_byte_buffer):
-        # 3 byte ints
-        unpacked = struct.unpack('3B', three_byte_buffer)
-
-        # 3byte int in 2s compliment
-        if unpacked[0] > 127:
-            pre_fix = bytes(bytearray.fromhex('FF'))
-        else:
-            pre_fix = bytes(bytearray.fromhex('00'))
-
-        three_byte_buffer = pre_fix + three_byte_buffer
-
-        # unpack little endian(>) signed integer(i) (makes unpacking platform independent)
-        return struct.unpack('>i', three_byte_buffer)[0]
+        # 3 byte big endian int in 2s compliment
+        unpacked = bytearray(three_byte_buffer)
+        value = (unpacked[0] << 16) | (unpacked[1] << 8) | unpacked[2]
+        if value & 0x800000:
+            value -= 0x1000000
+        return value
 
     def parse_packet_standard_accel(self, raw_data_to_sample):
         """
@@ -116,19 +133,7 @@ class ParseRaw(object):
         :param raw_data_to_sample: RawDataToSample
         :return:
         """
-        # Check to make sure data is not null.
-        if raw_data_to_sample is None:
-            raise RuntimeError(k.ERROR_UNDEFINED_OR_NULL_INPUT)
-        if raw_data_to_sample.raw_data_packet is None:
-            raise RuntimeError(k.ERROR_UNDEFINED_OR_NULL_INPUT)
-
-        # Check to make sure the buffer is the right size.
-        if len(raw_data_to_sample.raw_data_packet) != k.RAW_PACKET_SIZE:
-            raise RuntimeError(k.ERROR_INVALID_BYTE_LENGTH)
-
-        # Verify the correct stop byte.
-        if raw_data_to_sample.raw_data_packet[0] != k.RAW_BYTE_START:
-            raise RuntimeError(k.ERROR_INVALID_BYTE_START)
+        self.check_raw_data_packet(raw_data_to_sample)
 
         sample_object = OpenBCISample()
 
@@ -155,17 +160,131 @@ class ParseRaw(object):
 
         return sample_object
 
+    def check_raw_data_packet(self, raw_data_to_sample):
+        """ Raises a RuntimeError if the packet cannot be parsed at all. """
+        # Check to make sure data is not null.
+        if raw_data_to_sample is None:
+            raise RuntimeError(k.ERROR_UNDEFINED_OR_NULL_INPUT)
+        if raw_data_to_sample.raw_data_packet is None:
+            raise RuntimeError(k.ERROR_UNDEFINED_OR_NULL_INPUT)
+
+        # Check to make sure the buffer is the right size.
+        if len(raw_data_to_sample.raw_data_packet) != k.RAW_PACKET_SIZE:
+            raise RuntimeError(k.ERROR_INVALID_BYTE_LENGTH)
+
+        # Verify the correct stop byte.
+        if raw_data_to_sample.raw_data_packet[0] != k.RAW_BYTE_START:
+            raise RuntimeError(k.ERROR_INVALID_BYTE_START)
+
+    def get_board_time(self, raw_data_packet):
+        """ Board time in ms of time synced packets, 32 bit big endian unsigned int. """
+        return struct.unpack('>I', bytes(raw_data_packet[
+            k.RAW_PACKET_POSITION_TIME_SYNC_TIME_START:k.RAW_PACKET_POSITION_TIME_SYNC_TIME_STOP
+        ]))[0]
+
+    def get_accel_from_time_synced(self, raw_data_to_sample):
+        """
+        Time synced packets carry a single accelerometer axis, X, Y then Z according to the
+        sample number. Axes are gathered in `raw_data_to_sample.accel_data`.
+        :return: bool - True once the Z axis is received, the three axes are then up to date
+        """
+        raw_data_packet = raw_data_to_sample.raw_data_packet
+        axis = raw_data_packet[k.RAW_PACKET_POSITION_SAMPLE_NUMBER] % 10 - \
+            k.RAW_PACKET_ACCEL_AXIS_X
+        if axis < 0:
+            return False
+        counts = self.interpret_16_bit_as_int_32(bytes(raw_data_packet[
+            k.RAW_PACKET_POSITION_TIME_SYNC_AUX_START:k.RAW_PACKET_POSITION_TIME_SYNC_AUX_STOP
+        ]))
+        if len(raw_data_to_sample.accel_data) != k.RAW_PACKET_ACCEL_NUMBER_AXIS:
+            raw_data_to_sample.accel_data = [0] * k.RAW_PACKET_ACCEL_NUMBER_AXIS
+        raw_data_to_sample.accel_data[axis] = \
+            k.CYTON_ACCEL_SCALE_FACTOR_GAIN * counts if raw_data_to_sample.scale else counts
+        return axis == k.RAW_PACKET_ACCEL_NUMBER_AXIS - 1
+
+    def _make_sample(self, raw_data_to_sample):
+        """ Sample with the fields common to every packet type. """
+        raw_data_packet = raw_data_to_sample.raw_data_packet
+        sample_object = OpenBCISample()
+        sample_object.channel_data = self.get_channel_data_array(raw_data_to_sample)
+        sample_object.sample_number = raw_data_packet[k.RAW_PACKET_POSITION_SAMPLE_NUMBER]
+        sample_object.id = sample_object.sample_number
+        sample_object.start_byte = raw_data_packet[k.RAW_PACKET_POSITION_START_BYTE]
+        sample_object.stop_byte = raw_data_packet[k.RAW_PACKET_POSITION_STOP_BYTE]
+        sample_object.valid = True
+        return sample_object
+
+    def _set_time_synced(self, raw_data_to_sample, sample_object):
+        raw_data_packet = raw_data_to_sample.raw_data_packet
+        sample_object.board_time = self.get_board_time(raw_data_packet)
+        time_sync = raw_data_to_sample.time_sync
+        if time_sync is not None:
+            packet_type = self.get_raw_packet_type(raw_data_packet[k.RAW_PACKET_POSITION_STOP_BYTE])
+            if time_sync.pending and packet_type in TIME_SYNC_SET_PACKET_TYPES:
+                # board time at which the board got the sync command
+                time_sync.sync_set(sample_object.board_time)
+            if time_sync.synced:
+                # host clock from the board clock, no need to ask the system for the time
+                sample_object.timestamp = time_sync.to_host(sample_object.board_time)
+                return
+        if raw_data_to_sample.time_offset:
+            sample_object.timestamp = sample_object.board_time + raw_data_to_sample.time_offset
+        else:
+            sample_object.timestamp = int(round(time.time() * 1000))
+
+    def parse_packet_unsupported(self, raw_data_to_sample):
+        packet_type = self.get_raw_packet_type(
+            raw_data_to_sample.raw_data_packet[k.RAW_PACKET_POSITION_STOP_BYTE])
+        sample = OpenBCISample()
+        sample.error = 'This module does not support packet type %d' % packet_type
+        sample.valid = False
+        return sample
+
     def parse_packet_standard_raw_aux(self, raw_data_to_sample):
-        pass
+        """
+        0xC1: channel data followed by 6 raw aux bytes, kept as is in `aux_data`.
+        :param raw_data_to_sample: RawDataToSample
+        :return: OpenBCISample
+        """
+        self.check_raw_data_packet(raw_data_to_sample)
+        sample_object = self._make_sample(raw_data_to_sample)
+        sample_object.aux_data = bytearray(raw_data_to_sample.raw_data_packet[
+            k.RAW_PACKET_POSITION_START_AUX:k.RAW_PACKET_POSITION_STOP_AUX + 1])
+        sample_object.timestamp = int(round(time.time() * 1000)) + raw_data_to_sample.time_offset
+        return sample_object
 
     def parse_packet_time_synced_accel(self, raw_data_to_sample):
-        pass
+        """
+        0xC3 / 0xC4: channel data, one accelerometer axis (2 bytes) and the board time in ms
+        (4 bytes). `accel_data` is only set on the samples completing the three axes.
+        :param raw_data_to_sample: RawDataToSample
+        :return: OpenBCISample
+        """
+        self.check_raw_data_packet(raw_data_to_sample)
+        sample_object = self._make_sample(raw_data_to_sample)
+        self._set_time_synced(raw_data_to_sample, sample_object)
+        sample_object.aux_data = bytearray(raw_data_to_sample.raw_data_packet[
+            k.RAW_PACKET_POSITION_TIME_SYNC_AUX_START:k.RAW_PACKET_POSITION_TIME_SYNC_AUX_STOP])
+        if self.get_accel_from_time_synced(raw_data_to_sample):
+            sample_object.accel_data = list(raw_data_to_sample.accel_data)
+        return sample_object
 
     def parse_packet_time_synced_raw_aux(self, raw_data_to_sample):
-        pass
+        """
+        0xC5 / 0xC6: channel data, 2 raw aux bytes and the board time in ms (4 bytes).
+        :param raw_data_to_sample: RawDataToSample
+        :return: OpenBCISample
+        """
+        self.check_raw_data_packet(raw_data_to_sample)
+        sample_object = self._make_sample(raw_data_to_sample)
+        self._set_time_synced(raw_data_to_sample, sample_object)
+        sample_object.aux_data = bytearray(raw_data_to_sample.raw_data_packet[
+            k.RAW_PACKET_POSITION_TIME_SYNC_AUX_START:k.RAW_PACKET_POSITION_TIME_SYNC_AUX_STOP])
+        return sample_object
 
     def set_ads1299_scale_factors(self, gains, micro_volts=None):
         self.scale_factors = self.get_ads1299_scale_factors(gains, micro_volts=micro_volts)
+        self.raw_data_to_sample.scale_factors = self.scale_factors
 
     def transform_raw_data_packet_to_sample(self, raw_data):
         """
@@ -176,21 +295,7 @@ class ParseRaw(object):
         try:
             self.raw_data_to_sample.raw_data_packet = raw_data
             packet_type = self.get_raw_packet_type(raw_data[k.RAW_PACKET_POSITION_STOP_BYTE])
-            if packet_type == k.RAW_PACKET_TYPE_STANDARD_ACCEL:
-                sample = self.parse_packet_standard_accel(self.raw_data_to_sample)
-            elif packet_type == k.RAW_PACKET_TYPE_STANDARD_RAW_AUX:
-                sample = self.parse_packet_standard_raw_aux(self.raw_data_to_sample)
-            elif packet_type == k.RAW_PACKET_TYPE_ACCEL_TIME_SYNC_SET or \
-                    packet_type == k.RAW_PACKET_TYPE_ACCEL_TIME_SYNCED:
-                sample = self.parse_packet_time_synced_accel(self.raw_data_to_sample)
-            elif packet_type == k.RAW_PACKET_TYPE_RAW_AUX_TIME_SYNC_SET or \
-                    packet_type == k.RAW_PACKET_TYPE_RAW_AUX_TIME_SYNCED:
-                sample = self.parse_packet_time_synced_raw_aux(self.raw_data_to_sample)
-            else:
-                sample = OpenBCISample()
-                sample.error = 'This module does not support packet type %d' % packet_type
-                sample.valid = False
-
+            sample = self.packet_parsers[packet_type](self.raw_data_to_sample)
             sample.packet_type = packet_type
         except BaseException as e:
             sample = OpenBCISample()
@@ -286,15 +391,89 @@ function transformRawDataPacketsToSample (o) {
     """
 
     def transform_raw_data_packets_to_sample(self, raw_data_packets):
-        samples = []
-
-        for raw_data_packet in raw_data_packets:
-            sample = self.transform_raw_data_packet_to_sample(raw_data_packet)
-            samples.append(sample)
-            self.raw_data_to_sample.last_sample_number = sample.sample_number
+        """
+        Same as transform_raw_data_packet_to_sample for each packet, but the standard packets
+        (0xC0 stop byte) are all decoded at once by transform_raw_data_packets_to_arrays.
+        """
+        samples = [None] * len(raw_data_packets)
+        standard = []
+        for i, raw_data_packet in enumerate(raw_data_packets):
+            if len(raw_data_packet) == k.RAW_PACKET_SIZE and \
+                    raw_data_packet[k.RAW_PACKET_POSITION_START_BYTE] == k.RAW_BYTE_START and \
+                    raw_data_packet[k.RAW_PACKET_POSITION_STOP_BYTE] == k.RAW_BYTE_STOP:
+                standard.append(i)
+            else:
+                samples[i] = self.transform_raw_data_packet_to_sample(raw_data_packet)
 
+        if standard:
+            # join the framer views only once, in the vectorized decoder when all are standard
+            if len(standard) == len(raw_data_packets):
+                standard_packets = raw_data_packets
+            else:
+                standard_packets = b''.join(raw_data_packets[i] for i in standard)
+            sample_numbers, channel_data, accel_data = self.transform_raw_data_packets_to_arrays(
+                standard_packets)
+            now_ms = int(round(time.time() * 1000))
+            for i, sample_number, channels, accel in zip(standard, sample_numbers.tolist(),
+                                                         channel_data.tolist(),
+                                                         accel_data.tolist()):
+                sample = OpenBCISample(accel_data=accel,
+                                       channel_data=channels,
+                                       sample_number=sample_number,
+                                       start_byte=k.RAW_BYTE_START,
+                                       stop_byte=k.RAW_BYTE_STOP)
+                sample.timestamp = now_ms
+                sample.boardTime = 0
+                samples[i] = sample
+
+        if samples:
+            self.raw_data_to_sample.last_sample_number = samples[-1].sample_number
         return samples
 
+    def transform_raw_data_packets_to_arrays(self, raw_data_packets):
+        """
+        Vectorized decoding of a batch of packets, all channels of all packets at once.
+        Only the standard layout is decoded: 24 bit channel data followed by three 16 bit
+        accelerometer axes, whatever the stop byte.
+        :param raw_data_packets: list of 33 byte packets, or the packets concatenated in one
+            bytes-like object
+        :return: tuple of numpy arrays
+            sample numbers (N,), channel data (N, channels) and accel data (N, 3). Data is
+            float64 if the output is scaled, int32 otherwise.
+        """
+        if isinstance(raw_data_packets, (list, tuple)):
+            raw_data_packets = b''.join(raw_data_packets)
+        packets = np.frombuffer(raw_data_packets, dtype=np.uint8).reshape(-1, k.RAW_PACKET_SIZE)
+        nb_packets = packets.shape[0]
+
+        scale_factors = self.raw_data_to_sample.scale_factors
+        channels_in_packet = k.NUMBER_OF_CHANNELS_CYTON
+        if 0 < len(scale_factors) < k.NUMBER_OF_CHANNELS_CYTON:
+            channels_in_packet = len(scale_factors)
+
+        # 24 bit big endian values are copied in the 3 upper bytes of an int32,
+        # the arithmetic shift then takes care of the sign extension
+        channel_bytes = np.zeros((nb_packets, channels_in_packet, 4), dtype=np.uint8)
+        channel_bytes[:, :, :3] = packets[
+            :, k.RAW_PACKET_POSITION_CHANNEL_DATA_START:
+            k.RAW_PACKET_POSITION_CHANNEL_DATA_START + 3 * channels_in_packet
+        ].reshape(nb_packets, channels_in_packet, 3)
+        channel_data = channel_bytes.view('>i4').reshape(nb_packets, channels_in_packet)
+        channel_data = channel_data.astype(np.int32) >> 8
+
+        accel_data = np.ascontiguousarray(
+            packets[:, k.RAW_PACKET_POSITION_START_AUX:k.RAW_PACKET_POSITION_STOP_AUX + 1]
+        ).view('>i2').astype(np.int32)
+
+        if self.raw_data_to_sample.scale:
+            if len(scale_factors) > 0:
+                channel_data = channel_data * np.asarray(scale_factors[:channels_in_packet])
+            accel_data = accel_data * k.CYTON_ACCEL_SCALE_FACTOR_GAIN
+
+        sample_numbers = packets[:, k.RAW_PACKET_POSITION_SAMPLE_NUMBER]
+
+        return sample_numbers, channel_data, accel_data
+
 
 class RawDataToSample(object):
     """Object encapulsating a parsing object."""
@@ -308,6 +487,7 @@ class RawDataToSample(object):
                  scale=True,
                  scale_factors=None,
                  time_offset=0,
+                 time_sync=None,
                  verbose=False):
         """
         RawDataToSample
@@ -326,11 +506,14 @@ class RawDataToSample(object):
             Calculated scale factors
         :param time_offset: int
             For non time stamp use cases i.e. 0xC0 or 0xC1 (default and raw aux)
+        :param time_sync: ClockSync
+            Timestamps of time synced packets from the board time, once synced
         :param verbose:
         """
         self.accel_data = accel_data if accel_data is not None else []
         self.gains = gains if gains is not None else []
         self.time_offset = time_offset
+        self.time_sync = time_sync
         self.last_sample_number = last_sample_number
         self.raw_data_packets = raw_data_packets if raw_data_packets is not None else []
         self.raw_data_packet = raw_data_packet
@@ -357,10 +540,10 @@ class OpenBCISample(object):
                  accel_data=None):
         self.aux_data = aux_data if aux_data is not None else []
         self.board_time = board_time
-        self.channel_data = channel_data if aux_data is not None else []
+        self.channel_data = channel_data if channel_data is not None else []
         self.error = error
         self.id = sample_number
-        self.imp_data = imp_data if aux_data is not None else []
+        self.imp_data = imp_data if imp_data is not None else []
         self.packet_type = packet_type
         self.protocol = protocol
         self.sample_number = sample_number
@@ -370,3 +553,274 @@ class OpenBCISample(object):
         self._timestamps = {}
         self.valid = valid
         self.accel_data = accel_data if accel_data is not None else []
+
+
+class PacketFramer(object):
+    """
+    Splits a raw byte stream into complete OpenBCI packets.
+
+    Incoming bytes are copied into one reusable bytearray and scanned in place for
+    frames that start with 0xA0 and end with a 0xCx stop byte. Bytes belonging to a
+    partial frame are carried over to the next call to `feed`, so packets split
+    across two reads are not lost.
+
+    By default a frame with a wrong stop byte is dropped as a whole and the scan goes on
+    after it. In resync mode the scan goes back to the byte following its start byte and
+    looks ahead for the next frame with a plausible sample number, so a glitch does not
+    cost the real next packet when it started inside the dropped bytes.
+
+    NOTE: packets are returned as memoryviews into the internal buffer, they are only
+        valid until the next call to `feed`. Copy them if they must outlive it.
+    """
+
+    def __init__(self, packet_size=k.RAW_PACKET_SIZE, buffer_size=4096, resync=False,
+                 max_sample_gap=8):
+        """
+        :param packet_size: int
+            Size of one packet in bytes, start and stop bytes included
+        :param buffer_size: int
+            Initial size of the internal buffer, it grows if a single read does not fit
+        :param resync: bool
+            Look ahead for the next frame after a corrupt one instead of skipping it whole
+        :param max_sample_gap: int
+            While resyncing, a candidate frame is plausible if its sample number follows the
+            last one by at most this much. Otherwise the frame after it must be valid too.
+        """
+        self.packet_size = packet_size
+        self.resync = resync
+        self.max_sample_gap = max_sample_gap
+        self.buffer = bytearray(max(buffer_size, packet_size))
+        self.view = memoryview(self.buffer)
+        # unread bytes are self.buffer[self.head:self.tail]
+        self.head = 0
+        self.tail = 0
+        # counters, never reset by the framer itself
+        self.bytes_skipped = 0
+        self.packets_framed = 0
+        self.packets_invalid = 0
+        self.frames_recovered = 0
+        self.last_sample_number = None
+        # while resyncing, number of bytes of the corrupt frame not scanned yet
+        self._resyncing = False
+        self._corrupt_left = 0
+
+    def buffered(self):
+        """ Number of bytes waiting for the rest of their packet. """
+        return self.tail - self.head
+
+    def reset(self):
+        """ Forget any partial packet, e.g. after the stream has been restarted. """
+        self.head = 0
+        self.tail = 0
+        self.last_sample_number = None
+        self._resyncing = False
+        self._corrupt_left = 0
+
+    def feed(self, data):
+        """
+        Append raw bytes to the stream and return every packet completed by them.
+        :param data: bytes-like
+        :return: list of memoryview, one per packet
+        """
+        size = len(data)
+        if size:
+            self._make_room(size)
+            self.view[self.tail:self.tail + size] = data
+            self.tail += size
+        return self._scan()
+
+    def get_buffer(self, size):
+        """
+        Room for at least `size` more bytes, to read into directly instead of calling `feed`,
+        e.g. socket.recv_into or asyncio.BufferedProtocol. Then call `buffer_updated`.
+        :return: memoryview - writable, valid until the next call to the framer
+        """
+        self._make_room(max(size, 1))
+        return self.view[self.tail:]
+
+    def buffer_updated(self, size):
+        """
+        `size` bytes were written at the start of the view given by `get_buffer`.
+        :return: list of memoryview, one per packet completed, same as `feed`
+        """
+        self.tail += size
+        return self._scan()
+
+    def _make_room(self, size):
+        if self.tail + size <= len(self.buffer):
+            return
+        remaining = self.tail - self.head
+        if remaining + size > len(self.buffer):
+            # Packets handed out earlier still reference the old buffer: never resize it
+            buffer = bytearray(2 * (remaining + size))
+            buffer[:remaining] = self.buffer[self.head:self.tail]
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+        else:
+            self.buffer[:remaining] = self.buffer[self.head:self.tail]
+        self.head = 0
+        self.tail = remaining
+
+    def _scan(self):
+        packets = []
+        buf = self.buffer
+        size = self.packet_size
+        head = self.head
+        tail = self.tail
+        last = -1
+        while tail - head >= size:
+            if buf[head] != k.RAW_BYTE_START:
+                start = buf.find(b'\xa0', head, tail)
+                if start < 0:
+                    start = tail
+                self.bytes_skipped += start - head
+                self._corrupt_left -= start - head
+                head = start
+                continue
+            if not self._resyncing:
+                if (buf[head + size - 1] & 0xF0) == k.RAW_BYTE_STOP:
+                    packets.append(self.view[head:head + size])
+                    self.packets_framed += 1
+                    last = head
+                    head += size
+                    continue
+                self.packets_invalid += 1
+                if not self.resync:
+                    head += size
+                    continue
+                # the next packet might start inside this one
+                if last >= 0:
+                    self.last_sample_number = buf[last + 1]
+                self._resyncing = True
+                self._corrupt_left = size - 1
+                self.bytes_skipped += 1
+                head += 1
+                continue
+            plausible = self._plausible(head)
+            if plausible is None:
+                # wait for more bytes to decide
+                break
+            if plausible:
+                if self._corrupt_left > 0:
+                    self.frames_recovered += 1
+                self._resyncing = False
+                continue
+            self.bytes_skipped += 1
+            self._corrupt_left -= 1
+            head += 1
+        if last >= 0:
+            self.last_sample_number = buf[last + 1]
+        if head == tail:
+            head = tail = 0
+        self.head = head
+        self.tail = tail
+        return packets
+
+    def _plausible(self, start):
+        """ While resyncing, is there a frame at `start`? None if more bytes are needed. """
+        buf = self.buffer
+        size = self.packet_size
+        if (buf[start + size - 1] & 0xF0) != k.RAW_BYTE_STOP:
+            return False
+        if self.last_sample_number is None or \
+                (buf[start + 1] - self.last_sample_number - 1) % 256 < self.max_sample_gap:
+            return True
+        # unexpected sample number, confirm with the next frame
+        if self.tail - start < 2 * size:
+            return None
+        return buf[start + size] == k.RAW_BYTE_START and \
+            (buf[start + 2 * size - 1] & 0xF0) == k.RAW_BYTE_STOP
+
+
+class WiFiStreamDecoder(object):
+    """
+    Turns the TCP stream of a WiFi shield into samples, whatever the size of the reads.
+
+    Raw output (high speed): packets are framed by a PacketFramer, see `resync`. With a daisy
+    module, the samples of the main board and of the daisy are merged, a sample without its
+    counterpart is dropped.
+    JSON output: one JSON object per line, the samples are the dicts of its 'chunk' list.
+
+    Bytes can be given with `feed`, or read directly into the framer with `get_buffer` then
+    `buffer_updated`.
+
+    Args:
+      parser: ParseRaw of the board
+      daisy: merge main board and daisy samples
+      high_speed: raw output, else JSON
+      resync: look for the next packet inside a corrupt one
+    """
+
+    def __init__(self, parser=None, daisy=False, high_speed=True, resync=True):
+        self.parser = parser if parser is not None else ParseRaw(
+            gains=[24, 24, 24, 24, 24, 24, 24, 24])
+        self.daisy = daisy
+        self.high_speed = high_speed
+        self.framer = PacketFramer(packet_size=k.RAW_PACKET_SIZE, resync=resync)
+        self.last_odd_sample = OpenBCISample()
+        self.lines_invalid = 0
+        self._line = bytearray()
+
+    def feed(self, data):
+        """ :return: list - the samples completed by `data` """
+        if not self.high_speed:
+            return self._decode_lines(data)
+        return self._decode_packets(self.framer.feed(data))
+
+    def get_buffer(self, size):
+        if not self.high_speed:
+            # JSON is line based, no need to avoid a copy
+            return memoryview(bytearray(max(size, 1)))
+        return self.framer.get_buffer(size)
+
+    def buffer_updated(self, size, buffer=None):
+        """
+        :param buffer: the view given by `get_buffer`, only used for JSON
+        :return: list - the samples completed by these bytes
+        """
+        if not self.high_speed:
+            return self._decode_lines(buffer[:size])
+        return self._decode_packets(self.framer.buffer_updated(size))
+
+    def _decode_packets(self, raw_data_packets):
+        if not raw_data_packets:
+            return []
+        samples = self.parser.transform_raw_data_packets_to_sample(
+            raw_data_packets=raw_data_packets)
+        if not self.daisy:
+            return samples
+
+        # wait to concatenate two samples (main board + daisy)
+        daisy_samples = []
+        for sample in samples:
+            # odd sample: daisy sample, save for later
+            if ~sample.sample_number % 2:
+                self.last_odd_sample = sample
+            # even sample: concatenate and send if last sample was the first part,
+            #  otherwise drop the packet
+            elif sample.sample_number - 1 == self.last_odd_sample.sample_number:
+                # the aux data will be the average between the two samples, as the
+                # channel samples themselves have been averaged by the board
+                daisy_samples.append(self.parser.make_daisy_sample_object_wifi(
+                    self.last_odd_sample, sample))
+        return daisy_samples
+
+    def _decode_lines(self, data):
+        self._line += data
+        lines = self._line.split(b'\r\n')
+        # the last line is not complete yet
+        self._line = lines.pop()
+        samples = []
+        for line in lines:
+            if len(line) <= 2:
+                continue
+            try:
+                chunk_dict = json.loads(line.decode('utf-8'))
+            except ValueError:
+                self.lines_invalid += 1
+                continue
+            if 'chunk' in chunk_dict:
+                samples.extend(chunk_dict['chunk'])
+            else:
+                self.lines_invalid += 1
+        return samples
@@ -14,6 +14,7 @@
 
 import socket
 import sys
+import time
 
 pyVersion = sys.version_info[0]
 if pyVersion == 2:
@@ -48,15 +49,27 @@ class SSDPResponse(object):
         return "<SSDPResponse({location}, {st}, {usn})>".format(**self.__dict__)
 
 
-def discover(service, timeout=5, retries=1, mx=3, wifi_found_cb=None):
-    group = ("239.255.255.250", 1900)
+SSDP_GROUP = ("239.255.255.250", 1900)
+# while a stop event is given, longest wait before checking it
+STOP_POLL = 0.05
+
+
+def discover(service, timeout=5, retries=1, mx=3, wifi_found_cb=None, stop=None, group=None):
+    """
+    Multicasts an M-SEARCH and collects the answers until `timeout` seconds have elapsed,
+    `retries` times.
+    :param wifi_found_cb: called once per location found, discovery stops if it returns True
+    :param stop: threading.Event, discovery stops as soon as it is set
+    :param group: (address, port) to send the search to, defaults to SSDP_GROUP
+    :return: list of SSDPResponse, one per location
+    """
+    group = group or SSDP_GROUP
     message = "\r\n".join([
         'M-SEARCH * HTTP/1.1',
         'HOST: {0}:{1}',
         'MAN: "ssdp:discover"',
         'ST: {st}', 'MX: {mx}', '', ''])
 
-    socket.setdefaulttimeout(timeout)
     responses = {}
     for _ in range(retries):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -65,13 +78,33 @@ def discover(service, timeout=5, retries=1, mx=3, wifi_found_cb=None):
         sockMessage = message.format(*group, st=service, mx=mx)
         if pyVersion == 3:
             sockMessage = sockMessage.encode("utf-8")
-        sock.sendto(sockMessage, group)
-        while True:
-            try:
-                response = SSDPResponse(sock.recv(1024))
-                if wifi_found_cb is not None:
-                    wifi_found_cb(response)
+        # the deadline is this socket's own, socket.setdefaulttimeout would change every
+        # socket created afterwards in the process
+        deadline = time.time() + timeout
+        try:
+            sock.sendto(sockMessage, group)
+            while stop is None or not stop.is_set():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining if stop is None else min(remaining, STOP_POLL))
+                try:
+                    data = sock.recv(1024)
+                except socket.timeout:
+                    continue
+                try:
+                    response = SSDPResponse(data)
+                except Exception:
+                    # not an answer to the search
+                    continue
+                # devices usually answer several times
+                if response.location in responses:
+                    continue
                 responses[response.location] = response
-            except socket.timeout:
-                break
+                if wifi_found_cb is not None and wifi_found_cb(response):
+                    return list(responses.values())
+        finally:
+            sock.close()
+        if stop is not None and stop.is_set():
+            break
     return list(responses.values())
@@ -0,0 +1,147 @@
+import threading
+import timeit
+from collections import deque
+
+
+def host_time_ms():
+    """ Host clock used for the sync, in ms. Monotonic where timeit's default timer is. """
+    return timeit.default_timer() * 1000.
+
+
+class ClockSync(object):
+    """
+    Maps the board clock (ms, from time synced packets) onto the host clock. Every sync
+    exchange gives one point (board time, host time), the offset and the drift between both
+    clocks come from a linear regression over the last `window` points, kept up to date
+    with running sums.
+
+    An exchange: `start()` when the sync command is sent, then `sync_set(board_time)` when
+    the packet carrying the board time at which the board received the command comes back.
+    The host time of that moment is taken in the middle of the round trip, or in the middle
+    of the command and its confirmation if `confirm()` was called.
+
+    Estimation:
+      offset: host time - board time, in ms, at the board time of the oldest point ever added
+      drift: ms gained by the host clock per ms of the board clock
+
+    Args:
+      window: number of points in the regression
+      max_round_trip: ms, slower exchanges are ignored, 0 to keep them all
+    """
+
+    def __init__(self, window=30, max_round_trip=0):
+        self.window = window
+        self.max_round_trip = max_round_trip
+        self.exchanges = 0
+        self.rejected = 0
+        self.last_round_trip = None
+        self._points = deque()
+        self._sent = None
+        self._confirmed = None
+        self._synced = threading.Event()
+        self.reset()
+
+    def reset(self):
+        """ Forget every point, e.g. when the board restarted and its clock with it. """
+        self._points.clear()
+        # board time of the first point, regression on (board - reference, host - board)
+        self._reference = None
+        self._sums = [0., 0., 0., 0.]  # x, y, xx, xy
+        self.offset = 0.
+        self.drift = 0.
+        self._synced.clear()
+
+    @property
+    def synced(self):
+        return self._synced.is_set()
+
+    @property
+    def pending(self):
+        return self._sent is not None
+
+    def start(self, host_time=None):
+        """ The sync command has just been sent. """
+        self._sent = host_time_ms() if host_time is None else host_time
+        self._confirmed = None
+
+    def cancel(self):
+        """ The answer to the sync command will not come. """
+        self._sent = None
+        self._confirmed = None
+
+    def confirm(self, host_time=None):
+        """ The board acknowledged the command. """
+        if self._sent is not None:
+            self._confirmed = host_time_ms() if host_time is None else host_time
+
+    def sync_set(self, board_time, host_time=None):
+        """
+        The board time at which the board got the command has been received.
+        :return: bool - True if the exchange added a point
+        """
+        if self._sent is None:
+            return False
+        if host_time is None:
+            host_time = host_time_ms()
+        sent = self._sent
+        end = self._confirmed if self._confirmed is not None else host_time
+        self._sent = None
+        self.exchanges += 1
+        self.last_round_trip = end - sent
+        if self.max_round_trip > 0 and self.last_round_trip > self.max_round_trip:
+            self.rejected += 1
+            return False
+        self.add_point(board_time, sent + self.last_round_trip / 2.)
+        return True
+
+    def add_point(self, board_time, host_time):
+        if self._reference is None:
+            self._reference = board_time
+        x = float(board_time - self._reference)
+        y = float(host_time - board_time)
+        point = (x, y)
+        self._points.append(point)
+        self._add(point, 1)
+        if len(self._points) > self.window:
+            self._add(self._points.popleft(), -1)
+        self._fit()
+        self._synced.set()
+
+    def _add(self, point, sign):
+        x, y = point
+        sums = self._sums
+        sums[0] += sign * x
+        sums[1] += sign * y
+        sums[2] += sign * x * x
+        sums[3] += sign * x * y
+
+    def _fit(self):
+        n = len(self._points)
+        sum_x, sum_y, sum_xx, sum_xy = self._sums
+        denominator = n * sum_xx - sum_x * sum_x
+        # a single point, or all at the same board time: no drift to measure yet
+        if n < 2 or abs(denominator) < 1e-9:
+            self.drift = 0.
+        else:
+            self.drift = (n * sum_xy - sum_x * sum_y) / denominator
+        self.offset = (sum_y - self.drift * sum_x) / n
+
+    def wait(self, timeout=None):
+        """ :return: bool - True once at least one point is known """
+        return self._synced.wait(timeout)
+
+    def to_host(self, board_time):
+        """ :return: float - host time in ms of a board time, once synced """
+        return board_time + self.offset + self.drift * (board_time - self._reference)
+
+    def state(self):
+        """ Snapshot of the estimation, for metrics. """
+        return {
+            'synced': self.synced,
+            'points': len(self._points),
+            'offset': self.offset,
+            'drift': self.drift,
+            'exchanges': self.exchanges,
+            'rejected': self.rejected,
+            'last_round_trip': self.last_round_trip
+        }
@@ -0,0 +1,151 @@
+import threading
+import timeit
+
+
+class ConnectionWatchdog(object):
+    """
+    Single long-lived thread watching the health of a stream, calls `on_failure(reason)` when
+    a threshold is crossed. The reading code reports what it sees with `packets_received`,
+    `packets_dropped` and `bytes_skipped`, the watchdog only looks at the counters.
+
+    Thresholds, 0 disables the check:
+      stall_timeout: seconds without any valid packet
+      max_packets_to_skip: consecutive invalid packets
+      max_drop_rate: ratio of invalid packets over the last `rate_window` seconds
+      max_bytes_to_skip: bytes skipped looking for a packet over the last `rate_window` seconds
+    The rates are sliding: they include the previous window as well, so a window just started
+    is not judged on its first few packets. The drop rate is only judged over at least
+    `min_rate_packets` packets, e.g. right after a reconnection.
+
+    Args:
+      on_failure: called from the watchdog thread, e.g. the reconnect of the board
+      is_active: the stream is only checked while it returns True, e.g. while streaming
+      interval: seconds between two checks
+    """
+
+    def __init__(self, on_failure, is_active=None, interval=0.1, stall_timeout=0,
+                 max_packets_to_skip=10, max_drop_rate=0, max_bytes_to_skip=0, rate_window=2,
+                 min_rate_packets=10, name='OpenBCI watchdog'):
+        self.on_failure = on_failure
+        self.is_active = is_active
+        self.interval = interval
+        self.stall_timeout = stall_timeout
+        self.max_packets_to_skip = max_packets_to_skip
+        self.max_drop_rate = max_drop_rate
+        self.max_bytes_to_skip = max_bytes_to_skip
+        self.rate_window = rate_window
+        self.min_rate_packets = min_rate_packets
+        self.name = name
+        # counters, only written by the reading thread
+        self.received = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.consecutive_dropped = 0
+        self.time_last_packet = timeit.default_timer()
+        # what the watchdog did
+        self.failures = 0
+        self.last_failure = None
+        self.running = False
+        self._active = False
+        # counters at the start of the current and of the previous window
+        self._window = self._previous_window = (self.time_last_packet, 0, 0, 0)
+        self._stop = threading.Event()
+        self._thread = None
+
+    """ Reporting, called by the reading code """
+
+    def packets_received(self, nb_packets=1):
+        self.received += nb_packets
+        self.consecutive_dropped = 0
+        self.time_last_packet = timeit.default_timer()
+
+    def packets_dropped(self, nb_packets=1):
+        self.dropped += nb_packets
+        self.consecutive_dropped += nb_packets
+
+    def bytes_skipped(self, nb_bytes):
+        self.skipped += nb_bytes
+
+    """ Thread """
+
+    def start(self):
+        """ Starts the thread if it is not running yet, it then lives until `stop()`. """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self.running = True
+        self._thread = threading.Thread(target=self._run, name=self.name)
+        # never prevent the interpreter to exit
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.running = False
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self.is_active is not None and not self.is_active():
+                self._active = False
+                continue
+            if not self._active:
+                # (re)starting to stream, do not blame the time spent idle
+                self._active = True
+                self.rearm()
+                continue
+            reason = self.check()
+            if reason is not None:
+                self.failures += 1
+                self.last_failure = reason
+                self.on_failure(reason)
+                self.rearm()
+
+    def rearm(self):
+        """ Restart the stall timer and the rate window, e.g. after a reconnection. """
+        now = timeit.default_timer()
+        self.time_last_packet = now
+        self.consecutive_dropped = 0
+        self._window = self._previous_window = (now, self.received, self.dropped, self.skipped)
+
+    def check(self):
+        """
+        Compares the counters with the thresholds.
+        :return: str - why the stream is considered lost, None if it looks healthy
+        """
+        now = timeit.default_timer()
+        if self.stall_timeout > 0 and now - self.time_last_packet > self.stall_timeout:
+            return 'No data for %.2f seconds' % (now - self.time_last_packet)
+        if 0 < self.max_packets_to_skip < self.consecutive_dropped:
+            return 'Too many packets dropped (%d in a row)' % self.consecutive_dropped
+
+        window_start = self._window[0]
+        _, received, dropped, skipped = self._previous_window
+        received = self.received - received
+        dropped = self.dropped - dropped
+        skipped = self.skipped - skipped
+        if self.max_bytes_to_skip > 0 and skipped > self.max_bytes_to_skip:
+            return 'Too many bytes skipped (%d)' % skipped
+        if self.max_drop_rate > 0 and dropped and received + dropped >= self.min_rate_packets and \
+                float(dropped) / (received + dropped) > self.max_drop_rate:
+            return 'Drop rate too high (%d%%)' % (100. * dropped / (received + dropped))
+        if now - window_start >= self.rate_window:
+            self._previous_window = self._window
+            self._window = (now, self.received, self.dropped, self.skipped)
+        return None
+
+    def state(self):
+        """ Snapshot of the counters, for metrics. """
+        return {
+            'running': self.running,
+            'active': self._active,
+            'packets_received': self.received,
+            'packets_dropped': self.dropped,
+            'bytes_skipped': self.skipped,
+            'consecutive_dropped': self.consecutive_dropped,
+            'seconds_since_last_packet': timeit.default_timer() - self.time_last_packet,
+            'failures': self.failures,
+            'last_failure': self.last_failure
+        }
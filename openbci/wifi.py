@@ -17,25 +17,48 @@ TODO: Cyton Raw
 
 """
 from __future__ import print_function
-import asyncore
 import atexit
 import json
 import logging
 import re
 import socket
+import sys
+import threading
 import timeit
+from collections import deque
+from contextlib import contextmanager
 
 try:
     import urllib2
 except ImportError:
     import urllib
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 import requests
 import xmltodict
 
-from openbci.utils import Constants, ParseRaw, OpenBCISample, ssdp
+from openbci.utils import (Constants, DeviceCache, DispatcherThread, ParseRaw, SampleQueue,
+                           WiFiStreamDecoder, ssdp)
+
+if sys.version_info >= (3, 7):
+    from openbci.wifi_async import ThreadedWiFiShieldServer
+    # deprecated since Python 3.6, removed in 3.12
+    asyncore = None
+else:
+    # the asyncore server is used instead
+    ThreadedWiFiShieldServer = None
+    import asyncore
 
 SAMPLE_RATE = 0  # Hz
+# longest string given to /command at once by wifi_write_many, the shield forwards it to the
+# board in a single SPI packet
+COMMAND_MAX_LENGTH = 31
+# the IP address of a shield is given by DHCP, do not trust it for too long
+CACHE_TTL = 24 * 3600
 
 '''
 #Commands for in SDK
@@ -61,11 +84,19 @@ class OpenBCIWiFi(object):
       timeout: in seconds, disconnect / reconnect after a period without new data
         should be high if impedance check
       max_packets_to_skip: will try to disconnect / reconnect after too many packets are skipped
+      cache: DeviceCache of the IP address of the shields found recently, by name, tried first
+        when `shield_name` is given, see find_wifi_shield()
+      manager: openbci.wifi_async.WiFiShieldManager shared by several shields, they then use
+        a single port and a single event loop instead of a server each
+
+    All the HTTP requests to the shield go through one keep-alive session. Several commands can
+    be sent in a single request with `wifi_write_many` or within `batch_commands()`, the
+    latency of the /command requests is kept in `command_latencies`.
     """
 
     def __init__(self, ip_address=None, shield_name=None, sample_rate=None, log=True, timeout=3,
                  max_packets_to_skip=20, latency=10000, high_speed=True, ssdp_attempts=5,
-                 num_channels=8, local_ip_address=None):
+                 num_channels=8, local_ip_address=None, cache=None, manager=None):
         # these one are used
         self.daisy = False
         self.gains = None
@@ -90,6 +121,17 @@ class OpenBCIWiFi(object):
         self.log_packet_count = 0
         self.packets_dropped = 0
         self.time_last_packet = 0
+        # set when streaming with a dispatcher thread
+        self.sample_queue = None
+        self.dispatcher = None
+        # one pooled TCP connection to the shield instead of one per request
+        self.session = requests.Session()
+        # seconds per command of the last /command requests, a batch counts its commands
+        self.command_latencies = deque(maxlen=100)
+        self.command_requests = 0
+        self.commands_sent = 0
+        self._batch = None
+        self.cache = cache if cache is not None else DeviceCache('wifi', ttl=CACHE_TTL)
 
         if self.log:
             print("Welcome to OpenBCI Native WiFi Shield Driver - Please contribute code!")
@@ -98,24 +140,33 @@ class OpenBCIWiFi(object):
         if not self.local_ip_address:
             self.local_ip_address = self._get_local_ip_address()
 
+        self.manager = manager
         # Intentionally bind to port 0
-        self.local_wifi_server = WiFiShieldServer(self.local_ip_address, 0)
-        self.local_wifi_server_port = self.local_wifi_server.socket.getsockname()[1]
+        if manager is not None:
+            # the connection of the shield is told apart by its address, see connect()
+            self.local_wifi_server = manager.add_shield(name=shield_name)
+        elif ThreadedWiFiShieldServer is not None:
+            # samples are received in a thread of their own, loop() only waits
+            self.local_wifi_server = ThreadedWiFiShieldServer(self.local_ip_address, 0)
+        else:
+            self.local_wifi_server = WiFiShieldServer(self.local_ip_address, 0)
+        self.local_wifi_server_port = self.local_wifi_server.port
         if self.log:
             print("Opened socket on %s:%d" %
                   (self.local_ip_address, self.local_wifi_server_port))
 
-        if ip_address is None:
+        if ip_address is not None:
+            self.on_shield_found(ip_address)
+        elif shield_name is None or self.connect_cached() is None:
             for i in range(ssdp_attempts):
                 try:
-                    self.find_wifi_shield(wifi_shield_cb=self.on_shield_found)
+                    self.find_wifi_shield(shield_name=shield_name,
+                                          wifi_shield_cb=self.on_shield_found)
                     break
                 except OSError:
                     # Try again
                     if self.log:
                         print("Did not find any WiFi Shields")
-        else:
-            self.on_shield_found(ip_address)
 
     def on_shield_found(self, ip_address):
         self.ip_address = ip_address
@@ -124,7 +175,7 @@ class OpenBCIWiFi(object):
         atexit.register(self.disconnect)
 
     def loop(self):
-        asyncore.loop()
+        self.local_wifi_server.serve_forever()
 
     def _get_local_ip_address(self):
         """
@@ -158,7 +209,7 @@ class OpenBCIWiFi(object):
         https://app.swaggerhub.com/apis/pushtheworld/openbci-wifi-server/1.3.0
         """
 
-        res_board = requests.get("http://%s/board" % self.ip_address)
+        res_board = self.session.get("http://%s/board" % self.ip_address)
 
         if res_board.status_code == 200:
             board_info = res_board.json()
@@ -183,6 +234,8 @@ class OpenBCIWiFi(object):
         elif self.board_type == Constants.BOARD_GANGLION:
             self.gains = [51, 51, 51, 51]
             self.daisy = False
+        if self.manager is not None:
+            self.local_wifi_server.set_address(self.ip_address)
         self.local_wifi_server.set_daisy(daisy=self.daisy)
         self.local_wifi_server.set_parser(
             ParseRaw(gains=self.gains, board_type=self.board_type))
@@ -191,14 +244,14 @@ class OpenBCIWiFi(object):
             output_style = 'raw'
         else:
             output_style = 'json'
-        res_tcp_post = requests.post("http://%s/tcp" % self.ip_address,
-                                     json={
-                                         'ip': self.local_ip_address,
-                                         'port': self.local_wifi_server_port,
-                                         'output': output_style,
-                                         'delimiter': True,
-                                         'latency': self.latency
-                                     })
+        res_tcp_post = self.session.post("http://%s/tcp" % self.ip_address,
+                                         json={
+                                             'ip': self.local_ip_address,
+                                             'port': self.local_wifi_server_port,
+                                             'output': output_style,
+                                             'delimiter': True,
+                                             'latency': self.latency
+                                         })
         if res_tcp_post.status_code == 200:
             tcp_status = res_tcp_post.json()
             if tcp_status['connected']:
@@ -210,7 +263,7 @@ class OpenBCIWiFi(object):
 
     def init_streaming(self):
         """ Tell the board to record like crazy. """
-        res_stream_start = requests.get(
+        res_stream_start = self.session.get(
             "http://%s/stream/start" % self.ip_address)
         if res_stream_start.status_code == 200:
             self.streaming = True
@@ -221,61 +274,155 @@ class OpenBCIWiFi(object):
                                    "Check API for status code %d on /stream/start"
                                    % res_stream_start.status_code)
 
+    def connect_cached(self):
+        """
+        Connects directly to the shield named `shield_name` if its IP address is in the cache.
+        :return: str - IP address of the shield, None if it is unknown or did not answer
+        """
+        ip_address = self.cache.get(self.shield_name)
+        if ip_address is None:
+            return None
+        if self.log:
+            print("Trying WiFi Shield %s seen recently at %s" % (self.shield_name, ip_address))
+        try:
+            self.on_shield_found(ip_address)
+            return ip_address
+        except Exception as e:
+            print("Not available: " + str(e))
+            self.ip_address = None
+            return None
+
     def find_wifi_shield(self, shield_name=None, wifi_shield_cb=None):
-        """Detects Ganglion board MAC address if more than 1, will select first. Needs root."""
+        """
+        Finds the WiFi shields of the local network with SSDP. The description of each shield
+        is fetched in a thread of its own while the search goes on, the search stops as soon as
+        the shield named `shield_name` is described, or the first one if None.
+        The shields found are cached by name.
+        :param wifi_shield_cb: called with the IP address of the shield selected
+        :return: str - IP address of the shield selected
+        """
 
         if self.log:
             print("Try to find WiFi shields on your local wireless network")
-            print("Scanning for %d seconds nearby devices..." % self.timeout)
-
-        list_ip = []
-        list_id = []
-        found_shield = False
-
-        def wifi_shield_found(response):
-            res = requests.get(response.location, verify=False).text
-            device_description = xmltodict.parse(res)
-            cur_shield_name = str(
-                device_description['root']['device']['serialNumber'])
-            cur_base_url = str(device_description['root']['URLBase'])
-            cur_ip_address = re.findall(r'[0-9]+(?:\.[0-9]+){3}', cur_base_url)[0]
-            list_id.append(cur_shield_name)
-            list_ip.append(cur_ip_address)
-            found_shield = True
-            if shield_name is None:
-                print("Found WiFi Shield %s with IP Address %s" %
-                      (cur_shield_name, cur_ip_address))
-                if wifi_shield_cb is not None:
-                    wifi_shield_cb(cur_ip_address)
-            else:
-                if shield_name == cur_shield_name:
-                    if wifi_shield_cb is not None:
-                        wifi_shield_cb(cur_ip_address)
+            print("Scanning for at most %d seconds nearby devices..." % self.timeout)
 
-        ssdp_hits = ssdp.discover("urn:schemas-upnp-org:device:Basic:1", timeout=self.timeout,
-                                  wifi_found_cb=wifi_shield_found)
+        described = queue.Queue()
+        found_shield = threading.Event()
+        fetches = []
 
-        nb_wifi_shields = len(list_id)
+        def describe(location):
+            try:
+                res = requests.get(location, verify=False, timeout=self.timeout).text
+                device_description = xmltodict.parse(res)
+                cur_shield_name = str(
+                    device_description['root']['device']['serialNumber'])
+                cur_base_url = str(device_description['root']['URLBase'])
+                cur_ip_address = re.findall(r'[0-9]+(?:\.[0-9]+){3}', cur_base_url)[0]
+            except Exception as e:
+                # not a shield, or gone
+                if self.log:
+                    print("Cannot describe %s: %s" % (location, e))
+                described.put(None)
+                return
+            described.put((cur_shield_name, cur_ip_address))
+            if shield_name is None or shield_name == cur_shield_name:
+                found_shield.set()
 
-        if nb_wifi_shields < 1:
+        def wifi_shield_found(response):
+            fetch = threading.Thread(target=describe, args=(response.location,),
+                                     name='OpenBCI WiFi shield description')
+            fetch.daemon = True
+            fetch.start()
+            fetches.append(fetch)
+
+        ssdp.discover("urn:schemas-upnp-org:device:Basic:1", timeout=self.timeout,
+                      wifi_found_cb=wifi_shield_found, stop=found_shield)
+        if not found_shield.is_set():
+            # descriptions still being fetched
+            deadline = timeit.default_timer() + self.timeout
+            for fetch in fetches:
+                fetch.join(max(0, deadline - timeit.default_timer()))
+
+        shields = []
+        while not described.empty():
+            shield = described.get()
+            if shield is not None:
+                shields.append(shield)
+                self.cache.set(*shield)
+        if shield_name is not None:
+            shields = [shield for shield in shields if shield[0] == shield_name]
+
+        if not shields:
             print("No WiFi Shields found ;(")
             raise OSError('Cannot find OpenBCI WiFi Shield with local name')
 
-        if nb_wifi_shields > 1:
-            print(
-                "Found " + str(nb_wifi_shields) +
-                ", selecting first named: " + list_id[0] +
-                " with IPV4: " + list_ip[0])
-            return list_ip[0]
+        cur_shield_name, cur_ip_address = shields[0]
+        print("Found WiFi Shield %s with IP Address %s" % (cur_shield_name, cur_ip_address))
+        if wifi_shield_cb is not None:
+            wifi_shield_cb(cur_ip_address)
+        return cur_ip_address
 
     def wifi_write(self, output):
         """
         Pass through commands from the WiFi Shield to the Carrier board
         :param output:
-        :return:
+        :return: str - answer of the board, None when the command is held by batch_commands()
+        """
+        if self._batch is not None:
+            self._batch.append(output)
+            return None
+        return self._post_command(output, 1)
+
+    def wifi_write_many(self, commands):
+        """
+        Sends several commands with as few /command requests as possible, commands are put
+        together up to COMMAND_MAX_LENGTH characters and never split.
+        :param commands: list of str
+        :return: list of str - answer of the board to each request
+        """
+        answers = []
+        output = ''
+        count = 0
+        for command in commands:
+            if output and len(output) + len(command) > COMMAND_MAX_LENGTH:
+                answers.append(self._post_command(output, count))
+                output = ''
+                count = 0
+            output += command
+            count += 1
+        if output:
+            answers.append(self._post_command(output, count))
+        return answers
+
+    @contextmanager
+    def batch_commands(self):
+        """
+        Commands written within the block are sent together when it ends, e.g. to set all
+        the channels of a daisy:
+
+            with shield.batch_commands():
+                for channel in range(1, 17):
+                    shield.set_channel_settings(channel, gain=8)
         """
-        res_command_post = requests.post("http://%s/command" % self.ip_address,
-                                         json={'command': output})
+        if self._batch is not None:
+            # nested, the outer block sends everything
+            yield
+            return
+        self._batch = []
+        try:
+            yield
+        finally:
+            commands = self._batch
+            self._batch = None
+        self.wifi_write_many(commands)
+
+    def _post_command(self, output, count):
+        start = timeit.default_timer()
+        res_command_post = self.session.post("http://%s/command" % self.ip_address,
+                                             json={'command': output})
+        self.command_latencies.append((timeit.default_timer() - start) / count)
+        self.command_requests += 1
+        self.commands_sent += count
         if res_command_post.status_code == 200:
             ret_val = res_command_post.text
             if self.log:
@@ -295,7 +442,8 @@ class OpenBCIWiFi(object):
         """Will not get new data on impedance check."""
         return self.eeg_channels_per_sample
 
-    def start_streaming(self, callback, lapse=-1):
+    def start_streaming(self, callback, lapse=-1, queue_size=0,
+                        queue_policy=Constants.QUEUE_POLICY_BLOCK):
         """
         Start handling streaming data from the board. Call a provided callback
         for every single sample that is processed
@@ -303,11 +451,25 @@ class OpenBCIWiFi(object):
         Args:
           callback: A callback function, or a list of functions, that will receive a single
             argument of the OpenBCISample object captured.
+          queue_size: if > 0, the network loop only parses samples into a queue of that size
+            and a dispatcher thread calls the callbacks as the queue drains.
+          queue_policy: what to do when the queue is full, one of Constants.QUEUE_POLICY_*
         """
         start_time = timeit.default_timer()
 
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+            self.dispatcher = None
+
+        if queue_size > 0:
+            if not isinstance(callback, list):
+                callback = [callback]
+            self.sample_queue = SampleQueue(queue_size, queue_policy)
+            self.local_wifi_server.set_callback(self.sample_queue.put)
+            self.dispatcher = DispatcherThread(self.sample_queue, callback)
+            self.dispatcher.start()
         # Enclose callback function in a list if it comes alone
-        if not isinstance(callback, list):
+        elif not isinstance(callback, list):
             self.local_wifi_server.set_callback(callback)
         else:
             self.local_wifi_server.set_callback(callback[0])
@@ -569,6 +731,8 @@ class OpenBCIWiFi(object):
     def disconnect(self):
         if self.streaming:
             self.stop()
+        # the session opens a new connection if used again, e.g. by reconnect()
+        self.session.close()
 
         # should not try to read/write anything after that, will crash
 
@@ -615,109 +779,70 @@ class OpenBCIWiFi(object):
         self.init_streaming()
 
 
-class WiFiShieldHandler(asyncore.dispatcher_with_send):
-    def __init__(self, sock, callback=None, high_speed=True,
-                 parser=None, daisy=False):
-        asyncore.dispatcher_with_send.__init__(self, sock)
+if asyncore is not None:
+    class WiFiShieldHandler(asyncore.dispatcher_with_send):
+        """
+        Reads the packets streamed by the shield over TCP, see WiFiStreamDecoder: a packet cut
+        between two reads is completed by the next one, and after a corrupt packet the next
+        start byte is looked for within its bytes (see `resync`).
+        `decoder.framer.bytes_skipped` and `decoder.framer.packets_invalid` count what was lost.
+        """
 
-        self.callback = callback
-        self.daisy = daisy
-        self.high_speed = high_speed
-        self.last_odd_sample = OpenBCISample()
-        self.parser = parser if parser is not None else ParseRaw(
-            gains=[24, 24, 24, 24, 24, 24, 24, 24])
-
-    def handle_read(self):
-        # 3000 is the max data the WiFi shield is allowed to send over TCP
-        data = self.recv(3000)
-        if len(data) > 2:
-            if self.high_speed:
-                packets = int(len(data) / 33)
-                raw_data_packets = []
-                for i in range(packets):
-                    raw_data_packets.append(
-                        bytearray(data[i * Constants.RAW_PACKET_SIZE: i * Constants.RAW_PACKET_SIZE +
-                                                                      Constants.RAW_PACKET_SIZE]))
-                samples = self.parser.transform_raw_data_packets_to_sample(
-                    raw_data_packets=raw_data_packets)
+        def __init__(self, sock, callback=None, high_speed=True,
+                     parser=None, daisy=False, resync=True):
+            asyncore.dispatcher_with_send.__init__(self, sock)
 
-                for sample in samples:
-                    # if a daisy module is attached, wait to concatenate two samples
-                    # (main board + daisy) before passing it to callback
-                    if self.daisy:
-                        # odd sample: daisy sample, save for later
-                        if ~sample.sample_number % 2:
-                            self.last_odd_sample = sample
-                        # even sample: concatenate and send if last sample was the first part,
-                        #  otherwise drop the packet
-                        elif sample.sample_number - 1 == self.last_odd_sample.sample_number:
-                            # the aux data will be the average between the two samples, as the
-                            # channel samples themselves have been averaged by the board
-                            daisy_sample = self.parser.make_daisy_sample_object_wifi(
-                                self.last_odd_sample, sample)
-                            if self.callback is not None:
-                                self.callback(daisy_sample)
-                    else:
-                        if self.callback is not None:
-                            self.callback(sample)
+            self.callback = callback
+            self.decoder = WiFiStreamDecoder(parser=parser, daisy=daisy, high_speed=high_speed,
+                                             resync=resync)
 
-            else:
-                try:
-                    possible_chunks = data.split('\r\n')
-                    if len(possible_chunks) > 1:
-                        possible_chunks = possible_chunks[:-1]
-                    for possible_chunk in possible_chunks:
-                        if len(possible_chunk) > 2:
-                            chunk_dict = json.loads(possible_chunk)
-                            if 'chunk' in chunk_dict:
-                                for sample in chunk_dict['chunk']:
-                                    if self.callback is not None:
-                                        self.callback(sample)
-                            else:
-                                print("not a sample packet")
-                except ValueError as e:
-                    print("failed to parse: %s" % data)
-                    print(e)
-                except BaseException as e:
-                    print(e)
-
-
-class WiFiShieldServer(asyncore.dispatcher):
-
-    def __init__(self, host, port, callback=None, gains=None, high_speed=True, daisy=False):
-        asyncore.dispatcher.__init__(self)
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.set_reuse_addr()
-        self.bind((host, port))
-        self.daisy = daisy
-        self.listen(5)
-        self.callback = None
-        self.handler = None
-        self.parser = ParseRaw(gains=gains)
-        self.high_speed = high_speed
-
-    def handle_accept(self):
-        pair = self.accept()
-        if pair is not None:
-            sock, addr = pair
-            print('Incoming connection from %s' % repr(addr))
-            self.handler = WiFiShieldHandler(sock, self.callback, high_speed=self.high_speed,
-                                             parser=self.parser, daisy=self.daisy)
-
-    def set_callback(self, callback):
-        self.callback = callback
-        if self.handler is not None:
-            self.handler.callback = callback
-
-    def set_daisy(self, daisy):
-        self.daisy = daisy
-        if self.handler is not None:
-            self.handler.daisy = daisy
-
-    def set_gains(self, gains):
-        self.parser.set_ads1299_scale_factors(gains)
-
-    def set_parser(self, parser):
-        self.parser = parser
-        if self.handler is not None:
-            self.handler.parser = parser
+        def handle_read(self):
+            # 3000 is the max data the WiFi shield is allowed to send over TCP
+            samples = self.decoder.feed(self.recv(3000))
+            if self.callback is not None:
+                for sample in samples:
+                    self.callback(sample)
+
+    class WiFiShieldServer(asyncore.dispatcher):
+
+        def __init__(self, host, port, callback=None, gains=None, high_speed=True, daisy=False):
+            asyncore.dispatcher.__init__(self)
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+            self.bind((host, port))
+            self.port = self.socket.getsockname()[1]
+            self.daisy = daisy
+            self.listen(5)
+            self.callback = None
+            self.handler = None
+            self.parser = ParseRaw(gains=gains)
+            self.high_speed = high_speed
+
+        def handle_accept(self):
+            pair = self.accept()
+            if pair is not None:
+                sock, addr = pair
+                print('Incoming connection from %s' % repr(addr))
+                self.handler = WiFiShieldHandler(sock, self.callback, high_speed=self.high_speed,
+                                                 parser=self.parser, daisy=self.daisy)
+
+        def set_callback(self, callback):
+            self.callback = callback
+            if self.handler is not None:
+                self.handler.callback = callback
+
+        def set_daisy(self, daisy):
+            self.daisy = daisy
+            if self.handler is not None:
+                self.handler.decoder.daisy = daisy
+
+        def set_gains(self, gains):
+            self.parser.set_ads1299_scale_factors(gains)
+
+        def set_parser(self, parser):
+            self.parser = parser
+            if self.handler is not None:
+                self.handler.decoder.parser = parser
+
+        def serve_forever(self):
+            asyncore.loop()
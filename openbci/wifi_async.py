@@ -0,0 +1,542 @@
+"""
+asyncio servers receiving the TCP stream of OpenBCI WiFi shields, replace the asyncore one
+of openbci.wifi (asyncore is gone since Python 3.12). Python 3.7+.
+
+A shield connects to the server once told to by a POST to /tcp, see OpenBCIWiFi.connect.
+Bytes are read straight into the packet framer (asyncio.BufferedProtocol), parsed as soon as
+they arrive, then given to the callback and to every `samples()` iterator.
+
+  WiFiShieldIngestServer: one shield, async API
+  ThreadedWiFiShieldServer: one shield, event loop in its own thread
+  MultiShieldServer: several shields on a single port, async API
+  WiFiShieldManager: several shields on a single port and a single event loop, in its own
+    thread
+
+EXAMPLE USE (async):
+
+async def main():
+    server = WiFiShieldIngestServer('0.0.0.0')
+    await server.start()
+    # ... tell the shield to connect to server.port and to start streaming
+    async for sample in server.samples():
+        print(sample.channel_data)
+
+EXAMPLE USE (from regular code, the event loop runs in its own thread):
+
+server = ThreadedWiFiShieldServer('0.0.0.0', callback=handle_sample)
+...
+server.close()
+
+EXAMPLE USE (several shields):
+
+manager = WiFiShieldManager(local_ip_address, block_callback=handle_block)
+shields = [OpenBCIWiFi(shield_name=name, local_ip_address=local_ip_address, manager=manager)
+           for name in names]
+for shield in shields:
+    shield.start_streaming(handle_sample)
+manager.serve_forever()
+
+"""
+import asyncio
+import logging
+import threading
+
+from openbci.utils import ParseRaw, WiFiStreamDecoder
+from openbci.utils.time_sync import host_time_ms
+
+# bytes asked to the transport at once, the shield sends at most 3000 bytes per TCP packet
+READ_SIZE = 4096
+
+
+class WiFiShieldProtocol(asyncio.BufferedProtocol):
+    """ One TCP connection from a shield, its ShieldStream is chosen by `server`. """
+
+    def __init__(self, server):
+        self.server = server
+        self.stream = None
+        self.decoder = None
+        self.transport = None
+        self._buffer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        peer = transport.get_extra_info('peername')
+        self.stream = self.server._route(peer)
+        if self.stream is None:
+            logging.warning('Connection from %s refused, not a known WiFi shield', peer)
+            transport.close()
+            return
+        logging.info('Incoming connection from %s', peer)
+        self.decoder = WiFiStreamDecoder(parser=self.stream.parser, daisy=self.stream.daisy,
+                                         high_speed=self.stream.high_speed,
+                                         resync=self.stream.resync)
+        self.stream._connection_made(self)
+
+    def get_buffer(self, sizehint):
+        self._buffer = self.decoder.get_buffer(max(sizehint, READ_SIZE))
+        return self._buffer
+
+    def buffer_updated(self, nbytes):
+        samples = self.decoder.buffer_updated(nbytes, self._buffer)
+        self._buffer = None
+        if samples:
+            self.stream._samples_received(samples)
+
+    def connection_lost(self, exc):
+        if self.stream is not None:
+            self.stream._connection_lost(self, exc)
+
+
+class ShieldStream(object):
+    """
+    Samples of one shield: its parser and daisy state, its current connection (`handler`),
+    its callback and its `samples()` iterators. Lives in the event loop.
+
+    Samples go to `callback`, called from the event loop for each sample, and to the
+    iterators of `samples()`. Each iterator has its own queue of at most `queue_size`
+    batches of samples, the new batches are dropped when it is full and counted in
+    `batches_dropped`.
+    """
+
+    def __init__(self, callback=None, gains=None, high_speed=True, daisy=False, resync=True,
+                 queue_size=1024, name=None):
+        self.name = name
+        self.callback = callback
+        self.parser = ParseRaw(gains=gains)
+        self.high_speed = high_speed
+        self.daisy = daisy
+        self.resync = resync
+        self.queue_size = queue_size
+        self.handler = None
+        self.samples_received = 0
+        self.batches_dropped = 0
+        # samples waiting for the next block of a MultiShieldServer, None outside of one
+        self.pending = None
+        self._queues = []
+
+    async def samples(self):
+        """ Async iterator over the samples received from now on, until the stream ends. """
+        queue = asyncio.Queue(self.queue_size)
+        self._queues.append(queue)
+        try:
+            while True:
+                batch = await queue.get()
+                if batch is None:
+                    return
+                for sample in batch:
+                    yield sample
+        finally:
+            self._queues.remove(queue)
+
+    def _end(self):
+        if self.handler is not None:
+            self.handler.transport.close()
+        for queue in self._queues:
+            self.batches_dropped += _put(queue, None)
+
+    def _connection_made(self, handler):
+        # the shield opens a new connection when it is told to connect again, the old one
+        # is stale
+        if self.handler is not None:
+            self.handler.transport.close()
+        self.handler = handler
+
+    def _connection_lost(self, handler, exc):
+        if handler is self.handler:
+            self.handler = None
+        if exc is not None:
+            logging.warning('Connection to the WiFi shield lost: %s', exc)
+
+    def _samples_received(self, samples):
+        self.samples_received += len(samples)
+        if self.callback is not None:
+            for sample in samples:
+                self.callback(sample)
+        if self.pending is not None:
+            self.pending.extend(samples)
+        for queue in self._queues:
+            self.batches_dropped += _put(queue, samples)
+
+    # same interface as openbci.wifi.WiFiShieldServer
+
+    def set_callback(self, callback):
+        self.callback = callback
+
+    def set_daisy(self, daisy):
+        self.daisy = daisy
+        if self.handler is not None:
+            self.handler.decoder.daisy = daisy
+
+    def set_gains(self, gains):
+        self.parser.set_ads1299_scale_factors(gains)
+
+    def set_parser(self, parser):
+        self.parser = parser
+        if self.handler is not None:
+            self.handler.decoder.parser = parser
+
+
+def _put(queue, item):
+    """
+    Adds `item` to `queue` without waiting, None (end of the stream) always makes it.
+    :return: int - 1 if an item was dropped, else 0
+    """
+    try:
+        queue.put_nowait(item)
+        return 0
+    except asyncio.QueueFull:
+        if item is None:
+            queue.get_nowait()
+            queue.put_nowait(item)
+        return 1
+
+
+class WiFiShieldIngestServer(ShieldStream):
+    """
+    TCP server a single shield streams to, to be used from a running event loop. Whoever
+    connects is taken for the shield.
+
+    Args:
+      host: address to listen on, the shield must be able to reach it
+      port: 0 to let the OS pick one, see `port` once started
+      resync: see PacketFramer
+    """
+
+    def __init__(self, host, port=0, callback=None, gains=None, high_speed=True, daisy=False,
+                 resync=True, queue_size=1024):
+        ShieldStream.__init__(self, callback=callback, gains=gains, high_speed=high_speed,
+                              daisy=daisy, resync=resync, queue_size=queue_size)
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def _route(self, peer):
+        return self
+
+    async def start(self):
+        self._server = await asyncio.get_running_loop().create_server(
+            lambda: WiFiShieldProtocol(self), self.host, self.port, reuse_address=True)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+        self._end()
+
+
+class SampleBlock(object):
+    """
+    Samples of every shield received between `start` and `end`, host time in ms (see
+    openbci.utils.time_sync.host_time_ms).
+    `samples`: shield name -> list of samples, with every shield of the server.
+    """
+
+    def __init__(self, start, end, samples):
+        self.start = start
+        self.end = end
+        self.samples = samples
+
+
+class MultiShieldServer(object):
+    """
+    Single TCP server several shields stream to, to be used from a running event loop.
+    Connections are routed by the IP address of the peer to the ShieldStream of the shield,
+    each with its own parser, gains and daisy state. Connections from unknown addresses are
+    refused.
+
+    Every `block_interval` seconds, the samples received from all the shields in the meantime
+    are put together in a SampleBlock, given to `block_callback` and to the iterators of
+    `blocks()`. Nothing is emitted while no shield sends anything.
+
+    Args:
+      host: address to listen on, the shields must be able to reach it
+      port: 0 to let the OS pick one, see `port` once started
+      block_interval: seconds, 0 for no blocks
+    """
+
+    def __init__(self, host, port=0, block_interval=0.05, block_callback=None,
+                 queue_size=1024):
+        self.host = host
+        self.port = port
+        self.block_interval = block_interval
+        self.block_callback = block_callback
+        self.queue_size = queue_size
+        # IP address -> ShieldStream
+        self.streams = {}
+        self.connections_refused = 0
+        self.blocks_dropped = 0
+        self._server = None
+        self._ticker = None
+        self._queues = []
+
+    def add_shield(self, ip_address, name=None, stream=None, **kwargs):
+        """
+        :param ip_address: address the shield connects from
+        :param name: key of the shield in the blocks, defaults to `ip_address`
+        :param stream: ShieldStream to use, else one is made with `kwargs`
+        :return: ShieldStream
+        """
+        if stream is None:
+            stream = ShieldStream(**kwargs)
+        stream.name = name or ip_address
+        stream.pending = []
+        self.streams[ip_address] = stream
+        return stream
+
+    def remove_shield(self, ip_address):
+        stream = self.streams.pop(ip_address, None)
+        if stream is not None:
+            stream._end()
+        return stream
+
+    def _route(self, peer):
+        stream = self.streams.get(peer[0])
+        if stream is None:
+            self.connections_refused += 1
+        return stream
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._server = await loop.create_server(
+            lambda: WiFiShieldProtocol(self), self.host, self.port, reuse_address=True)
+        self.port = self._server.sockets[0].getsockname()[1]
+        if self.block_interval > 0:
+            self._ticker = loop.create_task(self._tick())
+        return self
+
+    async def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+        if self._ticker is not None:
+            self._ticker.cancel()
+            self._ticker = None
+        for stream in self.streams.values():
+            stream._end()
+        for queue in self._queues:
+            self.blocks_dropped += _put(queue, None)
+
+    async def blocks(self):
+        """ Async iterator over the SampleBlocks emitted from now on, until the server closes. """
+        queue = asyncio.Queue(self.queue_size)
+        self._queues.append(queue)
+        try:
+            while True:
+                block = await queue.get()
+                if block is None:
+                    return
+                yield block
+        finally:
+            self._queues.remove(queue)
+
+    async def _tick(self):
+        loop = asyncio.get_running_loop()
+        start = host_time_ms()
+        next_tick = loop.time()
+        while True:
+            # on a fixed schedule, a late tick does not delay the next ones
+            next_tick += self.block_interval
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            block = self.take_block(start)
+            start = block.end
+            if any(block.samples.values()):
+                self._emit(block)
+
+    def take_block(self, start):
+        """ :return: SampleBlock - samples received since the last block, from `start` on """
+        samples = {}
+        for stream in self.streams.values():
+            samples[stream.name] = stream.pending
+            stream.pending = []
+        return SampleBlock(start, host_time_ms(), samples)
+
+    def _emit(self, block):
+        if self.block_callback is not None:
+            self.block_callback(block)
+        for queue in self._queues:
+            self.blocks_dropped += _put(queue, block)
+
+
+class EventLoopThread(object):
+    """ An event loop running forever in a daemon thread, until `stop()`. """
+
+    def __init__(self, name='OpenBCI WiFi server'):
+        self.loop = asyncio.new_event_loop()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+            self.closed.set()
+
+    def call(self, coroutine, timeout=None):
+        """ Runs `coroutine` in the loop and waits for its result. """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def call_soon(self, function, *args):
+        self.loop.call_soon_threadsafe(function, *args)
+
+    def stop(self, timeout=5):
+        self.call_soon(self.loop.stop)
+        self.thread.join(timeout)
+
+
+class ThreadedWiFiShieldServer(object):
+    """
+    WiFiShieldIngestServer running on its own event loop in a daemon thread, for code that is
+    not async. Same interface as openbci.wifi.WiFiShieldServer, the callback is called from
+    the thread of the event loop.
+    """
+
+    def __init__(self, host, port=0, callback=None, gains=None, high_speed=True, daisy=False,
+                 resync=True):
+        self.server = WiFiShieldIngestServer(host, port, callback=callback, gains=gains,
+                                             high_speed=high_speed, daisy=daisy, resync=resync)
+        self.loop_thread = EventLoopThread()
+        # raises here if the port cannot be bound
+        self.loop_thread.call(self.server.start())
+
+    @property
+    def port(self):
+        return self.server.port
+
+    @property
+    def handler(self):
+        return self.server.handler
+
+    def set_callback(self, callback):
+        self.loop_thread.call_soon(self.server.set_callback, callback)
+
+    def set_daisy(self, daisy):
+        self.loop_thread.call_soon(self.server.set_daisy, daisy)
+
+    def set_gains(self, gains):
+        self.loop_thread.call_soon(self.server.set_gains, gains)
+
+    def set_parser(self, parser):
+        self.loop_thread.call_soon(self.server.set_parser, parser)
+
+    def serve_forever(self, timeout=None):
+        """ Wait for the server to be closed, the samples keep coming in the meantime. """
+        return self.loop_thread.closed.wait(timeout)
+
+    def close(self, timeout=5):
+        if self.loop_thread.closed.is_set():
+            return
+        self.loop_thread.call(self.server.close(), timeout)
+        self.loop_thread.stop(timeout)
+
+
+class WiFiShieldManager(object):
+    """
+    MultiShieldServer running on its own event loop in a daemon thread: any number of shields
+    on one port and one thread. Given to OpenBCIWiFi as `manager`, each shield gets a
+    ShieldHandle instead of a server of its own.
+
+    `block_callback` is called from the thread of the event loop with every SampleBlock.
+    """
+
+    def __init__(self, host, port=0, block_interval=0.05, block_callback=None):
+        self.server = MultiShieldServer(host, port, block_interval=block_interval,
+                                        block_callback=block_callback)
+        self.loop_thread = EventLoopThread(name='OpenBCI WiFi manager')
+        # raises here if the port cannot be bound
+        self.loop_thread.call(self.server.start())
+
+    @property
+    def port(self):
+        return self.server.port
+
+    def add_shield(self, ip_address=None, name=None, **kwargs):
+        """
+        :param ip_address: address the shield connects from, can be given later with
+            ShieldHandle.set_address, e.g. once found with SSDP
+        :param kwargs: see ShieldStream
+        :return: ShieldHandle
+        """
+        return ShieldHandle(self, ShieldStream(name=name, **kwargs), ip_address)
+
+    def set_block_callback(self, block_callback):
+        self.loop_thread.call_soon(setattr, self.server, 'block_callback', block_callback)
+
+    def serve_forever(self, timeout=None):
+        """ Wait for the manager to be closed, the samples keep coming in the meantime. """
+        return self.loop_thread.closed.wait(timeout)
+
+    def close(self, timeout=5):
+        if self.loop_thread.closed.is_set():
+            return
+        self.loop_thread.call(self.server.close(), timeout)
+        self.loop_thread.stop(timeout)
+
+
+class ShieldHandle(object):
+    """
+    One shield of a WiFiShieldManager, same interface as openbci.wifi.WiFiShieldServer.
+    Closing it only forgets the shield, the manager keeps running.
+    """
+
+    def __init__(self, manager, stream, ip_address=None):
+        self.manager = manager
+        self.stream = stream
+        self.name = stream.name
+        self.ip_address = None
+        if ip_address is not None:
+            self.set_address(ip_address)
+
+    @property
+    def port(self):
+        return self.manager.port
+
+    @property
+    def handler(self):
+        return self.stream.handler
+
+    def _move(self, old, new):
+        server = self.manager.server
+        if old is not None and server.streams.get(old) is self.stream:
+            if new is None:
+                server.remove_shield(old)
+            else:
+                del server.streams[old]
+        if new is not None:
+            server.add_shield(new, name=self.name, stream=self.stream)
+
+    def set_address(self, ip_address):
+        """ Address the shield connects from, a port after the host is ignored. """
+        ip_address = ip_address.split(':')[0]
+        if ip_address != self.ip_address:
+            self.manager.loop_thread.call_soon(self._move, self.ip_address, ip_address)
+            self.ip_address = ip_address
+
+    def set_callback(self, callback):
+        self.manager.loop_thread.call_soon(self.stream.set_callback, callback)
+
+    def set_daisy(self, daisy):
+        self.manager.loop_thread.call_soon(self.stream.set_daisy, daisy)
+
+    def set_gains(self, gains):
+        self.manager.loop_thread.call_soon(self.stream.set_gains, gains)
+
+    def set_parser(self, parser):
+        self.manager.loop_thread.call_soon(self.stream.set_parser, parser)
+
+    def serve_forever(self, timeout=None):
+        return self.manager.serve_forever(timeout)
+
+    def close(self):
+        if self.ip_address is not None and not self.manager.loop_thread.closed.is_set():
+            self.manager.loop_thread.call_soon(self._move, self.ip_address, None)
+        self.ip_address = None
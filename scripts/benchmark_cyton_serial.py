@@ -0,0 +1,71 @@
+from __future__ import print_function
+import sys
+
+sys.path.append('..')  # help python find openbci relative to scripts folder
+import argparse
+import struct
+import timeit
+
+from openbci import cyton as bci
+from openbci.utils import sample_packet_real
+
+# Compare the chunked framing engine of OpenBCICyton against the former
+# byte-per-field reads, both fed from a pyserial "loop://" port.
+
+
+def read_sample_per_field(ser):
+    """ Previous approach: 14 reads and a dozen of struct.unpack per sample """
+    while struct.unpack('B', ser.read(1))[0] != bci.START_BYTE:
+        pass
+    packet_id = struct.unpack('B', ser.read(1))[0]
+    channel_data = []
+    for c in range(8):
+        literal_read = ser.read(3)
+        unpacked = struct.unpack('3B', literal_read)
+        pre_fix = b'\xFF' if unpacked[0] > 127 else b'\x00'
+        channel_data.append(struct.unpack('>i', pre_fix + literal_read)[0])
+    aux_data = []
+    for a in range(3):
+        aux_data.append(struct.unpack('>h', ser.read(2))[0])
+    struct.unpack('B', ser.read(1))
+    return bci.OpenBCISample(packet_id, channel_data, aux_data)
+
+
+# loop:// holds at most 4096 bytes, feed it by blocks and only time the reads
+BLOCK = 100
+
+
+def run(ser, read_sample, nb_samples):
+    block = bytearray()
+    for i in range(BLOCK):
+        block += sample_packet_real(i)
+    block = bytes(block)
+    elapsed = 0
+    for i in range(nb_samples // BLOCK):
+        ser.write(block)
+        start = timeit.default_timer()
+        for j in range(BLOCK):
+            read_sample()
+        elapsed += timeit.default_timer() - start
+    return (nb_samples // BLOCK) * BLOCK / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark Cyton serial framing on loop://")
+    parser.add_argument('-n', '--samples', default=20000, type=int)
+    parser.add_argument('-c', '--chunk-sizes', default=[0, 330, 1650], type=int, nargs='+',
+                        help="Chunk sizes to test, 0 reads whatever is waiting")
+    args = parser.parse_args()
+
+    board = bci.OpenBCICyton(port='loop://', timeout=1, log=False)
+    board.ser.reset_input_buffer()
+
+    rate = run(board.ser, lambda: read_sample_per_field(board.ser), args.samples)
+    print("per field reads:    %8.0f samples/s" % rate)
+
+    for chunk_size in args.chunk_sizes:
+        board.chunk_size = chunk_size
+        rate = run(board.ser, board._read_serial_binary, args.samples)
+        print("chunk size %5d:   %8.0f samples/s" % (chunk_size, rate))
+
+    board.disconnect()
@@ -0,0 +1,38 @@
+from __future__ import print_function
+import sys
+
+sys.path.append('..')  # help python find openbci relative to scripts folder
+import argparse
+import random
+import timeit
+
+from openbci.ganglion import decompressDeltas, decompressDeltasBlock
+
+# Decode throughput of the compressed Ganglion packets, one packet at a time as done for each
+# BLE notification, versus a whole block of packets at once. At 200Hz the Ganglion sends 100
+# compressed packets per second.
+
+
+def measure(function, nb_packets, repeat):
+    best = min(timeit.repeat(function, number=1, repeat=repeat))
+    return nb_packets / best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark Ganglion deltas decoding")
+    parser.add_argument('-n', '--packets', default=10000, type=int,
+                        help="Number of packets per block")
+    parser.add_argument('-r', '--repeat', default=5, type=int)
+    args = parser.parse_args()
+
+    for bits in [19, 18]:
+        packets = [bytes(bytearray(random.getrandbits(8) for _ in range(bits)))
+                   for _ in range(args.packets)]
+        data = b''.join(packets)
+
+        per_packet = measure(lambda: [decompressDeltas(packet, bits) for packet in packets],
+                             args.packets, args.repeat)
+        block = measure(lambda: decompressDeltasBlock(data, bits), args.packets, args.repeat)
+
+        print("%d bits, per packet: %10.0f packets/s" % (bits, per_packet))
+        print("%d bits, block:      %10.0f packets/s (x%.1f)" % (bits, block, block / per_packet))
@@ -0,0 +1,58 @@
+from __future__ import print_function
+import sys
+
+sys.path.append('..')  # help python find openbci relative to scripts folder
+import argparse
+import timeit
+
+from openbci.utils import (Constants, ParseRaw, sample_packet_real,
+                           sample_packet_standard_raw_aux, sample_packet_accel_time_synced,
+                           sample_packet_raw_aux_time_synced)
+
+# Decode throughput of ParseRaw, one packet at a time versus whole batches, as samples
+# (WiFi shield and Cyton) or as arrays. The WiFi shield sends up to 16000 packets per second.
+# Then the cost of one packet for each packet type (stop byte) decoded one at a time.
+
+MODES = [
+    ('standard accel (0xC0)', sample_packet_real),
+    ('standard raw aux (0xC1)', sample_packet_standard_raw_aux),
+    ('time synced accel (0xC4)', sample_packet_accel_time_synced),
+    ('time synced raw aux (0xC6)', sample_packet_raw_aux_time_synced),
+]
+
+
+def measure(function, nb_packets, repeat):
+    best = min(timeit.repeat(function, number=1, repeat=repeat))
+    return nb_packets / best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark ParseRaw decoding")
+    parser.add_argument('-n', '--packets', default=Constants.SAMPLE_RATE_16000, type=int,
+                        help="Number of packets per batch, default: one second at 16kHz")
+    parser.add_argument('-r', '--repeat', default=5, type=int)
+    args = parser.parse_args()
+
+    packets = [sample_packet_real(i % 256) for i in range(args.packets)]
+    data = b''.join(packets)
+    parse_raw = ParseRaw(gains=[24, 24, 24, 24, 24, 24, 24, 24], scaled_output=True)
+
+    per_packet = measure(lambda: [parse_raw.transform_raw_data_packet_to_sample(packet)
+                                  for packet in packets],
+                         args.packets, args.repeat)
+    samples = measure(lambda: parse_raw.transform_raw_data_packets_to_sample(packets),
+                      args.packets, args.repeat)
+    arrays = measure(lambda: parse_raw.transform_raw_data_packets_to_arrays(data),
+                     args.packets, args.repeat)
+
+    print("per packet:      %10.0f packets/s" % per_packet)
+    print("batch, samples:  %10.0f packets/s (x%.1f)" % (samples, samples / per_packet))
+    print("batch, arrays:   %10.0f packets/s (x%.1f)" % (arrays, arrays / per_packet))
+
+    print("\nper packet cost by type:")
+    for name, make_packet in MODES:
+        mode_packets = [make_packet(i % 256) for i in range(args.packets)]
+        rate = measure(lambda: [parse_raw.transform_raw_data_packet_to_sample(packet)
+                                for packet in mode_packets],
+                       args.packets, args.repeat)
+        print("  %-28s %6.2f us" % (name, 1e6 / rate))
@@ -0,0 +1,110 @@
+from __future__ import print_function
+import sys
+
+sys.path.append('..')  # help python find openbci relative to scripts folder
+import argparse
+import multiprocessing
+import socket
+import threading
+import time
+
+from openbci.utils import Constants, sample_packet
+from openbci import wifi
+
+if sys.version_info >= (3, 7):
+    from openbci.wifi_async import WiFiShieldManager
+else:
+    WiFiShieldManager = None
+
+# Ingest throughput of the WiFi shield servers. A stand-in shield, in a process of its own,
+# connects over TCP to the local server and streams raw Cyton packets at the given rate, in
+# bursts like the shield does (`latency`). Reported: samples received per second and the
+# share of one core used by the process receiving them.
+# With --shields N, N stand-ins stream at the same time to a single WiFiShieldManager, each
+# from its own loopback address 127.0.0.1, 127.0.0.2...
+
+
+def stand_in_shield(port, rate, seconds, latency, address='127.0.0.1'):
+    """ Sends `rate` packets per second for `seconds`, one burst every `latency` seconds. """
+    packets = b''.join(bytes(sample_packet(i % 256)) for i in range(256))
+    per_burst = max(1, int(rate * latency))
+    sock = socket.create_connection(('127.0.0.1', port), source_address=(address, 0))
+    sent = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        burst = bytearray()
+        while len(burst) < per_burst * Constants.RAW_PACKET_SIZE:
+            offset = (sent % 256) * Constants.RAW_PACKET_SIZE
+            burst += packets[offset:offset + Constants.RAW_PACKET_SIZE]
+            sent += 1
+        sock.sendall(burst)
+        # paced on the start time, not on the previous burst, so the rate does not drift
+        delay = start + float(sent) / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    sock.close()
+
+
+def measure(servers, serve, args):
+    """ One stand-in shield per server, `servers` share the port of the first one. """
+    received = [0]
+
+    def count(sample):
+        received[0] += 1
+
+    shields = []
+    for i, server in enumerate(servers):
+        server.set_callback(count)
+        shields.append(multiprocessing.Process(
+            target=stand_in_shield,
+            args=(servers[0].port, args.rate, args.seconds, args.latency, '127.0.0.%d' % (i + 1))))
+    cpu = time.process_time()
+    wall = time.time()
+    for shield in shields:
+        shield.start()
+    if serve is not None:
+        serve_thread = threading.Thread(target=serve)
+        serve_thread.daemon = True
+        serve_thread.start()
+    for shield in shields:
+        shield.join()
+    # last bursts still in flight
+    time.sleep(0.2)
+    wall = time.time() - wall
+    cpu = time.process_time() - cpu
+    return received[0] / args.seconds, cpu / wall
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the WiFi shield servers")
+    parser.add_argument('--rate', default=Constants.SAMPLE_RATE_16000, type=int,
+                        help="Packets per second sent by the stand-in shield")
+    parser.add_argument('-s', '--seconds', default=5., type=float)
+    parser.add_argument('-l', '--latency', default=0.01, type=float,
+                        help="Seconds between two bursts of the shield")
+    parser.add_argument('--shields', default=1, type=int,
+                        help="Number of shields streaming to a WiFiShieldManager at once")
+    args = parser.parse_args()
+
+    if args.shields > 1:
+        if WiFiShieldManager is None:
+            parser.error('--shields needs Python 3.7 or later')
+        manager = WiFiShieldManager('127.0.0.1')
+        handles = [manager.add_shield('127.0.0.%d' % (i + 1)) for i in range(args.shields)]
+        rate, core = measure(handles, None, args)
+        manager.close()
+        print("manager, %d shields: %8.0f samples/s, %5.1f%% of a core"
+              % (args.shields, rate, 100 * core))
+        sys.exit()
+
+    if wifi.ThreadedWiFiShieldServer is not None:
+        server = wifi.ThreadedWiFiShieldServer('127.0.0.1')
+        rate, core = measure([server], None, args)
+        server.close()
+        print("asyncio:  %8.0f samples/s, %5.1f%% of a core" % (rate, 100 * core))
+
+    if wifi.asyncore is not None:
+        server = wifi.WiFiShieldServer('127.0.0.1', 0)
+        rate, core = measure([server], server.serve_forever, args)
+        server.close()
+        print("asyncore: %8.0f samples/s, %5.1f%% of a core" % (rate, 100 * core))
@@ -4,6 +4,7 @@ import sys
 sys.path.append('..')  # help python find cyton.py relative to scripts folder
 from openbci import cyton as bci
 from openbci.plugins import StreamerTCPServer
+from openbci.utils import Constants, SampleGapDetector
 import time, timeit
 from threading import Thread
 
@@ -24,8 +25,8 @@ SERVER_IP = "localhost"
 
 DEBUG = False
 
-# check packet drop
-last_id = -1
+# check packet drop, interpolate skipped packets to stay sync
+gap_detector = SampleGapDetector(fill=Constants.GAP_FILL_INTERPOLATE)
 
 # counter for sampling rate
 nb_samples_in = -1
@@ -71,20 +72,20 @@ class Monitor(Thread):
 
 
 def streamData(sample):
+    # check packet skipped
+    lost = gap_detector.samples_lost
+    samples = gap_detector.process(sample)
+    if gap_detector.samples_lost != lost:
+        print("time", tick, ":", gap_detector.samples_lost - lost, "paquet(s) skipped!")
+    for s in samples:
+        streamSample(s)
+
+
+def streamSample(sample):
     global last_values
 
     global tick
 
-    # check packet skipped
-    global last_id
-    # TODO: duplicate packet if skipped to stay sync
-    if sample.id != last_id + 1:
-        print("time", tick, ": paquet skipped!")
-    if sample.id == 255:
-        last_id = -1
-    else:
-        last_id = sample.id
-
     # update counters
     global nb_samples_in, nb_samples_out
     nb_samples_in = nb_samples_in + 1
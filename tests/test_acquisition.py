@@ -0,0 +1,107 @@
+import threading
+from unittest import TestCase, main
+
+from openbci.utils import AcquisitionThread, Constants, DispatcherThread, SampleQueue
+
+
+class TestSampleQueue(TestCase):
+
+    def test_init_invalid(self):
+        with self.assertRaises(ValueError):
+            SampleQueue(maxsize=0)
+        with self.assertRaises(ValueError):
+            SampleQueue(policy='drop-all')
+
+    def test_put_get_all(self):
+        queue = SampleQueue(maxsize=10)
+
+        self.assertTrue(queue.put(0))
+        self.assertEqual(queue.put_many([1, 2, 3]), 3)
+
+        self.assertEqual(queue.qsize(), 4)
+        self.assertEqual(queue.high_water_mark, 4)
+        self.assertListEqual(queue.get_all(), [0, 1, 2, 3])
+        self.assertEqual(queue.qsize(), 0)
+        self.assertListEqual(queue.get_all(timeout=0.01), [])
+
+    def test_drop_newest(self):
+        queue = SampleQueue(maxsize=3, policy=Constants.QUEUE_POLICY_DROP_NEWEST)
+
+        self.assertEqual(queue.put_many([0, 1, 2, 3, 4]), 3)
+        self.assertFalse(queue.put(5))
+
+        self.assertEqual(queue.overflows, 3)
+        self.assertEqual(queue.high_water_mark, 3)
+        self.assertListEqual(queue.get_all(), [0, 1, 2])
+
+    def test_drop_oldest(self):
+        queue = SampleQueue(maxsize=3, policy=Constants.QUEUE_POLICY_DROP_OLDEST)
+
+        self.assertEqual(queue.put_many([0, 1, 2, 3, 4]), 5)
+
+        self.assertEqual(queue.overflows, 2)
+        self.assertListEqual(queue.get_all(), [2, 3, 4])
+
+    def test_block(self):
+        queue = SampleQueue(maxsize=2, policy=Constants.QUEUE_POLICY_BLOCK)
+        queue.put_many([0, 1])
+
+        # no room and nobody draining the queue
+        self.assertFalse(queue.put(2, timeout=0.01))
+        self.assertEqual(queue.overflows, 1)
+
+        consumer = threading.Timer(0.05, queue.get_all)
+        consumer.start()
+        self.assertTrue(queue.put(3, timeout=5))
+        consumer.join()
+        self.assertListEqual(queue.get_all(), [3])
+
+    def test_close(self):
+        queue = SampleQueue(maxsize=1)
+        queue.put(0)
+        queue.close()
+
+        self.assertFalse(queue.put(1))
+        self.assertListEqual(queue.get_all(), [0])
+        self.assertListEqual(queue.get_all(), [])
+
+
+class TestAcquisitionThreads(TestCase):
+
+    def test_acquisition_to_dispatcher(self):
+        blocks = [[0, 1], [], [2, 3, 4]]
+        queue = SampleQueue(maxsize=10)
+        received = []
+
+        def read():
+            if blocks:
+                return blocks.pop(0)
+            reader.stop()
+            return []
+
+        reader = AcquisitionThread(read, queue)
+        dispatcher = DispatcherThread(queue, [received.append])
+        reader.start()
+        dispatcher.start()
+        reader.join(5)
+        dispatcher.join(5)
+
+        self.assertListEqual(received, [0, 1, 2, 3, 4])
+        self.assertTrue(queue.closed)
+
+    def test_acquisition_error(self):
+        queue = SampleQueue(maxsize=10)
+
+        def read():
+            raise IOError('Device Stalled')
+
+        reader = AcquisitionThread(read, queue)
+        reader.start()
+        reader.join(5)
+
+        self.assertIsInstance(reader.error, IOError)
+        self.assertTrue(queue.closed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+import mock
+
+from openbci.utils import DeviceCache
+
+
+class TestDeviceCache(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'sub', 'devices.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_set_get_remove(self):
+        cache = DeviceCache('cyton', path=self.path)
+        self.assertIsNone(cache.get('DN0000A'))
+
+        cache.set('DN0000A', '/dev/ttyUSB0')
+        DeviceCache('ganglion', path=self.path).set('DN0000A', 'other section')
+
+        self.assertEqual(DeviceCache('cyton', path=self.path).get('DN0000A'), '/dev/ttyUSB0')
+        cache.remove('DN0000A')
+        self.assertDictEqual(cache.items(), {})
+        self.assertEqual(DeviceCache('ganglion', path=self.path).get('DN0000A'), 'other section')
+
+    def test_ttl(self):
+        cache = DeviceCache('wifi', path=self.path, ttl=10)
+        with mock.patch('time.time', return_value=1000.):
+            cache.set('shield', '192.168.4.1')
+        with mock.patch('time.time', return_value=1005.):
+            self.assertEqual(cache.get('shield'), '192.168.4.1')
+        with mock.patch('time.time', return_value=1011.):
+            self.assertIsNone(cache.get('shield'))
+
+    def test_latest(self):
+        cache = DeviceCache('ganglion', path=self.path)
+        self.assertIsNone(cache.latest())
+        for i, (key, value) in enumerate([('aa:01', 'Ganglion-0001'), ('aa:02', 'Ganglion-0002'),
+                                          ('aa:03', 'Ganglion-0001')]):
+            with mock.patch('time.time', return_value=1000. + i):
+                cache.set(key, value)
+        self.assertEqual(cache.latest(), ('aa:03', 'Ganglion-0001'))
+        self.assertEqual(cache.latest('Ganglion-0002'), ('aa:02', 'Ganglion-0002'))
+        self.assertIsNone(cache.latest('Ganglion-0003'))
+
+    def test_unreadable(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        cache = DeviceCache('cyton', path=self.path)
+        self.assertDictEqual(cache.items(), {})
+        cache.set('DN0000A', '/dev/ttyUSB0')
+        self.assertEqual(cache.get('DN0000A'), '/dev/ttyUSB0')
+
+
+if __name__ == '__main__':
+    main()
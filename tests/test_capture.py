@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+from openbci.utils import RawCapture, read_capture
+
+
+class TestRawCapture(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'capture.raw')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_write_read(self):
+        capture = RawCapture(self.path)
+        capture.write(b'\xa0\x01', timestamp=10.5)
+        capture.write(b'\xc0', timestamp=11.)
+        capture.close()
+
+        self.assertListEqual(capture.files, [self.path])
+        self.assertEqual(capture.bytes_captured, 3)
+        self.assertListEqual(list(read_capture(self.path)), [(10.5, b'\xa0\x01'), (11., b'\xc0')])
+
+    def test_rotation(self):
+        capture = RawCapture(self.path, max_bytes=40)
+        for i in range(5):
+            capture.write(bytes(bytearray([i] * 20)), timestamp=i)
+        capture.close()
+
+        # magic + 2 chunks go past 40 bytes
+        self.assertListEqual(capture.files, [self.path, self.path + '.1', self.path + '.2'])
+        chunks = list(read_capture(capture.files))
+        self.assertListEqual([timestamp for timestamp, data in chunks], [0, 1, 2, 3, 4])
+        self.assertEqual(chunks[4][1], b'\x04' * 20)
+
+    def test_existing_files(self):
+        previous = RawCapture(self.path, max_bytes=10)
+        for i in range(3):
+            previous.write(b'previous', timestamp=i)
+        previous.close()
+
+        # the previous capture is kept whole
+        with self.assertRaises(OSError):
+            RawCapture(self.path)
+        self.assertListEqual([timestamp for timestamp, data in read_capture(previous.files)],
+                             [0, 1, 2])
+
+        # files in the way of the rotation are skipped
+        other = os.path.join(self.folder, 'other.raw')
+        with open(other + '.1', 'wb') as f:
+            f.write(b'not a capture')
+        capture = RawCapture(other, max_bytes=10)
+        capture.write(b'0123456789', timestamp=10)
+        capture.write(b'0123456789', timestamp=11)
+        capture.close()
+        self.assertListEqual(capture.files, [other, other + '.2'])
+        self.assertListEqual([timestamp for timestamp, data in read_capture(capture.files)],
+                             [10, 11])
+
+    def test_write_after_close(self):
+        capture = RawCapture(self.path)
+        capture.write(b'0', timestamp=1)
+        capture.close()
+        # e.g. the reading thread still had the capture when it was stopped
+        capture.write(b'1', timestamp=2)
+        self.assertListEqual(list(read_capture(self.path)), [(1, b'0')])
+
+    def test_truncated(self):
+        capture = RawCapture(self.path)
+        capture.write(b'0123456789')
+        capture.close()
+        with open(self.path, 'rb+') as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        self.assertListEqual(list(read_capture(self.path)), [])
+
+        with open(self.path, 'wb') as f:
+            f.write(b'not a capture')
+        with self.assertRaises(ValueError):
+            list(read_capture(self.path))
+
+
+if __name__ == '__main__':
+    main()
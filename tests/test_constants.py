@@ -24,6 +24,13 @@ class TestConstants(TestCase):
 
     def test_cyton_variables(self):
         self.assertEqual(Constants.CYTON_ACCEL_SCALE_FACTOR_GAIN, 0.002 / (pow(2, 4)))
+        self.assertEqual(Constants.CYTON_BAUD_RATE_DEFAULT, 115200)
+        self.assertEqual(Constants.CYTON_BAUD_RATE_HIGH, 230400)
+        self.assertEqual(Constants.CYTON_BAUD_RATE_HYPER, 921600)
+        self.assertEqual(Constants.CYTON_COMMAND_BAUD_RATE_DEFAULT, b'\xf0\x05')
+        self.assertEqual(Constants.CYTON_COMMAND_BAUD_RATE_HIGH, b'\xf0\x06')
+        self.assertEqual(Constants.CYTON_COMMAND_BAUD_RATE_HYPER, b'\xf0\x0a')
+        self.assertEqual(Constants.CYTON_COMMAND_RADIO_SYSTEM_STATUS, b'\xf0\x07')
 
     def test_errors(self):
         self.assertEqual(Constants.ERROR_INVALID_BYTE_LENGTH, 'Invalid Packet Byte Length')
@@ -48,10 +55,22 @@ class TestConstants(TestCase):
         self.assertEqual(Constants.PROTOCOL_SERIAL, 'serial')
         self.assertEqual(Constants.PROTOCOL_WIFI, 'wifi')
 
+    def test_queue_policies(self):
+        self.assertEqual(Constants.QUEUE_POLICY_BLOCK, 'block')
+        self.assertEqual(Constants.QUEUE_POLICY_DROP_NEWEST, 'drop-newest')
+        self.assertEqual(Constants.QUEUE_POLICY_DROP_OLDEST, 'drop-oldest')
+
+    def test_gap_fill(self):
+        self.assertEqual(Constants.GAP_FILL_NAN, 'nan')
+        self.assertEqual(Constants.GAP_FILL_INTERPOLATE, 'interpolate')
+
     def test_raw(self):
         self.assertEqual(Constants.RAW_BYTE_START, 0xA0)
         self.assertEqual(Constants.RAW_BYTE_STOP, 0xC0)
         self.assertEqual(Constants.RAW_PACKET_ACCEL_NUMBER_AXIS, 3)
+        self.assertEqual(Constants.RAW_PACKET_ACCEL_AXIS_X, 7)
+        self.assertEqual(Constants.RAW_PACKET_ACCEL_AXIS_Y, 8)
+        self.assertEqual(Constants.RAW_PACKET_ACCEL_AXIS_Z, 9)
         self.assertEqual(Constants.RAW_PACKET_SIZE, 33)
         self.assertEqual(Constants.RAW_PACKET_POSITION_CHANNEL_DATA_START, 2)
         self.assertEqual(Constants.RAW_PACKET_POSITION_CHANNEL_DATA_STOP, 25)
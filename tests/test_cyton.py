@@ -1,5 +1,18 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
+
+import mock
+
+from openbci import cyton
 from openbci.cyton import OpenBCICyton
+from openbci.utils import (Constants, DeviceCache, read_capture, sample_packet,
+                           sample_packet_accel_time_sync_set, sample_packet_impedance,
+                           sample_packet_raw_aux_time_synced, sample_packet_standard_raw_aux)
 
 PORT = 'loop://'
 
@@ -17,6 +30,56 @@ class TestOpenBCICyton(unittest.TestCase):
         self.assertEqual(self.cyton.ser_read(), b'v',
                          "Expected initialization character")
 
+    def test_fast_connect(self):
+        board = OpenBCICyton(port=fake_board(), fast_connect=True, connect_timeout=2)
+        self.assertLess(board.time_to_ready, 2)
+        board.disconnect()
+
+        board = OpenBCICyton(port=PORT, fast_connect=True, connect_timeout=0.1)
+        # the loop only echoes the 'v' command
+        self.assertIsNone(board.time_to_ready)
+        board.disconnect()
+
+    def test_fast_connect_slow_reply(self):
+        received = bytearray()
+        # longer than the 0.5 s between two tries
+        board = OpenBCICyton(port=fake_board(delay=0.8, received=received), fast_connect=True,
+                             connect_timeout=3)
+        self.assertIsNotNone(board.time_to_ready)
+        time.sleep(0.6)
+        # the answer was coming, no other soft reset
+        self.assertNotIn(b"v", received)
+        board.disconnect()
+
+    def test_fast_connect_streaming(self):
+        # still streaming, e.g. the previous program reading the board was killed
+        stand_in = FakeStreamingBoard(streaming=True)
+        board = OpenBCICyton(port=stand_in.url, fast_connect=True, connect_timeout=2)
+        self.assertLess(board.time_to_ready, 2)
+        self.assertTrue(stand_in.received.startswith(b'sv'))
+        board.disconnect()
+
+    def test_set_baud_rate(self):
+        with self.assertRaises(ValueError):
+            self.cyton.set_baud_rate(9600)
+
+        dongle = FakeDongle()
+        board = OpenBCICyton(port=dongle.url, fast_connect=True)
+        self.assertTrue(board.set_baud_rate(Constants.CYTON_BAUD_RATE_HYPER, timeout=0.5))
+        self.assertEqual(board.baudrate, 921600)
+        self.assertEqual(board.ser.baudrate, 921600)
+        self.assertEqual(dongle.baud, 921600)
+        board.disconnect()
+
+    def test_set_baud_rate_fallback(self):
+        # the dongle switches but the link does not work at the higher speed
+        dongle = FakeDongle(link_ok_at=[115200])
+        board = OpenBCICyton(port=dongle.url, fast_connect=True)
+        self.assertFalse(board.set_baud_rate(Constants.CYTON_BAUD_RATE_HIGH, timeout=0.2))
+        self.assertEqual(board.baudrate, 115200)
+        self.assertEqual(board.ser.baudrate, 115200)
+        board.disconnect()
+
     def test_filter_toggles(self):
         self.test_init()
 
@@ -116,6 +179,445 @@ class TestOpenBCICyton(unittest.TestCase):
         self.cyton.set_channel(channel=16, toggle_position=1)
         self.assertEqual(self.cyton.ser_read(), b'I')
 
+    def test_reconnect(self):
+        dongle = FakeDongle()
+        board = OpenBCICyton(port=dongle.url, fast_connect=True)
+        board.set_channel(1, 0)
+        board.test_signal(2)
+        for byte in 'x2161000X':
+            board.ser_write(byte.encode())
+        board.set_channel(1, 1)
+        board.streaming = True
+
+        board.reconnect()
+        self.assertLess(board.time_to_reconnect, 1)
+        expected = b's' + b'v' + b'-x2161000X!' + b'b'
+        deadline = time.time() + 2
+        while not dongle.received.endswith(expected) and time.time() < deadline:
+            time.sleep(0.01)
+        # only the final settings, in one go after the soft reset
+        self.assertTrue(dongle.received.endswith(expected))
+        board.disconnect()
+
+    def test_read_serial_binary(self):
+        self.test_init()
+
+        packets = sample_packet(1) + sample_packet(2) + sample_packet(3)
+        # split the last packet across two reads
+        self.cyton.ser.write(bytes(packets[:80]))
+        self.assertEqual(self.cyton._read_serial_binary().id, 1)
+        self.assertEqual(self.cyton._read_serial_binary().id, 2)
+        self.cyton.ser.write(bytes(packets[80:]))
+        sample = self.cyton._read_serial_binary()
+        self.assertEqual(sample.id, 3)
+        self.assertEqual(len(sample.channel_data), 8)
+        self.assertEqual(len(sample.aux_data), 3)
+
+    def test_read_serial_binary_packet_types(self):
+        self.test_init()
+        self.cyton.ser.write(bytes(sample_packet(1) + sample_packet_impedance(2) +
+                                   sample_packet(3)))
+        sample = self.cyton._read_serial_binary()
+        self.assertEqual(sample.id, 1)
+        self.assertEqual(sample.protocol, Constants.PROTOCOL_SERIAL)
+        self.assertListEqual(sample.aux_data, sample.accel_data)
+        # no parser for impedance packets on the serial port
+        self.assertEqual(self.cyton._read_serial_binary().id, 3)
+
+    def test_read_serial_binary_raw_aux(self):
+        self.test_init()
+        self.cyton.ser.write(bytes(sample_packet_standard_raw_aux(1) +
+                                   sample_packet_raw_aux_time_synced(2)))
+        sample = self.cyton._read_serial_binary()
+        self.assertEqual(sample.id, 1)
+        # no accelerometer in these packets, the aux bytes are apart
+        self.assertListEqual(sample.aux_data, [0, 0, 0])
+        self.assertEqual(sample.aux_bytes, bytearray([0, 1, 2, 3, 4, 5]))
+        sample = self.cyton._read_serial_binary()
+        self.assertListEqual(sample.aux_data, [0, 0, 0])
+        self.assertEqual(sample.aux_bytes, bytearray([0, 1]))
+        self.assertEqual(sample.board_time, 1)
+
+    def test_read_serial_binary_daisy_packet_types(self):
+        self.test_init()
+        self.cyton.daisy = True
+
+        # each packet through its own parser, then the pairs are merged
+        self.cyton.ser.write(bytes(sample_packet(0) + sample_packet_raw_aux_time_synced(1) +
+                                   sample_packet_standard_raw_aux(2)))
+        sample = self.cyton._read_serial_binary()
+        self.assertEqual(sample.id, 1)
+        self.assertEqual(len(sample.channel_data), 16)
+        self.assertEqual(len(sample.aux_data), 3)
+        self.assertEqual(sample.aux_bytes, bytearray([0, 1]))
+        self.assertEqual(sample.board_time, 1)
+
+        # the even sample waited for the next read
+        self.cyton.ser.write(bytes(sample_packet(3)))
+        sample = self.cyton._read_serial_binary()
+        self.assertEqual(sample.id, 3)
+        self.assertEqual(len(sample.channel_data), 16)
+        self.assertEqual(self.cyton.daisy_unpaired, 0)
+
+    def test_read_serial_binary_daisy(self):
+        self.test_init()
+        self.cyton.daisy = True
+
+        # 4 is lost, 5 has no even sample before it, 6 waits for 7 in the next read
+        self.cyton.ser.write(bytes(b''.join(sample_packet(i) for i in [0, 1, 2, 3, 5, 6])))
+        self.assertEqual(self.cyton._read_serial_binary().id, 1)
+        sample = self.cyton._read_serial_binary()
+        self.assertEqual(sample.id, 3)
+        self.assertEqual(len(sample.channel_data), 16)
+        self.assertEqual(len(sample.aux_data), 3)
+        self.assertEqual(self.cyton.daisy_unpaired, 1)
+
+        self.cyton.ser.write(bytes(sample_packet(7)))
+        self.assertEqual(self.cyton._read_serial_binary().id, 7)
+        self.assertEqual(self.cyton.daisy_unpaired, 1)
+
+    def test_read_serial_binary_resync(self):
+        self.cyton.disconnect()
+        self.cyton = OpenBCICyton(port=PORT, resync=True)
+        self.cyton.ser.write(bytes(sample_packet(1) + sample_packet(2)[:20] + sample_packet(3)))
+        self.assertEqual(self.cyton._read_serial_binary().id, 1)
+        self.assertEqual(self.cyton._read_serial_binary().id, 3)
+        self.assertEqual(self.cyton.frames_recovered, 1)
+        # the loop also echoed the 'v' sent when connecting
+        self.assertEqual(self.cyton.bytes_skipped, 1 + 20)
+
+    def test_read_serial_binary_gaps(self):
+        self.cyton.disconnect()
+        self.cyton = OpenBCICyton(port=PORT, fill_gaps=Constants.GAP_FILL_NAN)
+        self.cyton.ser.write(bytes(sample_packet(254) + sample_packet(1)))
+
+        ids = [self.cyton._read_serial_binary().id for i in range(4)]
+        self.assertListEqual(ids, [254, 255, 0, 1])
+        self.assertEqual(self.cyton.gap_detector.samples_lost, 2)
+
+    def test_read_serial_cancelled(self):
+        self.test_init()
+        self.cyton.ser.timeout = 0.05
+        self.cyton.reconnect = mock.Mock()
+        self.cyton.streaming = True
+        # the read cancelled by the watchdog had already returned data
+        self.cyton._read_cancelled = True
+        self.cyton._reconnect_requested = True
+        self.cyton.ser.write(bytes(sample_packet(1)))
+        self.assertEqual(self.cyton._read_serial_binary().id, 1)
+        self.cyton.reconnect.assert_called_once_with()
+
+        with self.assertRaises(IOError):
+            self.cyton._read_serial(Constants.RAW_PACKET_SIZE)
+        self.cyton.streaming = False
+
+    def test_sync_clocks(self):
+        with self.assertRaises(RuntimeError):
+            self.cyton.sync_clocks()
+
+        self.test_init()
+        self.cyton.streaming = True
+        # the loop only echoes the command, no time sync set packet comes back
+        self.assertFalse(self.cyton.sync_clocks(timeout=0.05))
+        self.assertFalse(self.cyton.time_sync.pending)
+        self.assertEqual(self.cyton.ser_read(), b'<')
+
+        # the board answers, its packet is read while waiting as the acquisition thread would
+        write = self.cyton.ser.write
+
+        def answer():
+            write(bytes(sample_packet_accel_time_sync_set(1)))
+            self.cyton._read_serial_binary()
+
+        with mock.patch.object(self.cyton.ser, 'write',
+                               side_effect=lambda data: threading.Timer(0.01, answer).start()):
+            self.assertTrue(self.cyton.sync_clocks(timeout=2))
+        self.assertTrue(self.cyton.time_sync.synced)
+        self.cyton.streaming = False
+
+    def test_capture(self):
+        folder = tempfile.mkdtemp()
+        try:
+            data = bytes(sample_packet(1) + sample_packet(2))
+            path = os.path.join(folder, 'tee.raw')
+            self.cyton.start_capture(path)
+            self.cyton.ser.write(data)
+            self.assertEqual(self.cyton._read_serial_binary().id, 1)
+
+            capture_only = os.path.join(folder, 'capture_only.raw')
+            self.cyton.start_capture(capture_only, capture_only=True)
+            self.cyton.ser.write(data)
+            self.cyton._capture_serial()
+            self.cyton.stop_capture()
+
+            # the loop also echoed the 'v' sent when connecting
+            self.assertEqual(b''.join(chunk for timestamp, chunk in read_capture(path)),
+                             b'v' + data)
+            self.assertEqual(b''.join(chunk for timestamp, chunk in read_capture(capture_only)),
+                             data)
+        finally:
+            shutil.rmtree(folder)
+
+    def test_start_streaming_queue(self):
+        self.test_init()
+        # the acquisition thread should give up once the samples are read
+        self.cyton.ser.timeout = 0.5
+        self.cyton.ser.write(bytes(sample_packet(1) + sample_packet(2) + sample_packet(3)))
+        samples = []
+
+        def callback(sample):
+            samples.append(sample)
+            if len(samples) == 3:
+                self.cyton.stop()
+
+        self.cyton.start_streaming(callback, queue_size=10,
+                                   queue_policy=Constants.QUEUE_POLICY_DROP_OLDEST)
+
+        self.assertListEqual([sample.id for sample in samples], [1, 2, 3])
+        self.assertEqual(self.cyton.sample_queue.maxsize, 10)
+        self.assertEqual(self.cyton.sample_queue.overflows, 0)
+        self.assertGreater(self.cyton.sample_queue.high_water_mark, 0)
+
+    def test_start_streaming_queue_reconnect(self):
+        stand_in = FakeStreamingBoard(good_packets=20)
+        board = OpenBCICyton(port=stand_in.url, fast_connect=True)
+        board.watchdog.interval = 0.02
+        samples = []
+
+        def callback(sample):
+            samples.append(sample)
+            if len(samples) == 40 or board.watchdog.failures > 1:
+                board.stop()
+
+        timer = threading.Timer(5, board.stop)
+        timer.start()
+        with mock.patch.object(board, 'warn', wraps=board.warn) as warn:
+            # the watchdog notices the corrupt packets while the acquisition thread reads
+            board.start_streaming(callback, queue_size=100)
+        timer.cancel()
+
+        self.assertEqual(board.watchdog.failures, 1)
+        self.assertIsNotNone(board.time_to_reconnect)
+        self.assertNotIn(mock.call('No answer to the soft reset'), warn.call_args_list)
+        # the stream went on after the reconnection, from the acquisition thread
+        self.assertEqual(len(samples), 40)
+        self.assertListEqual([sample.id for sample in samples], list(range(40)))
+        self.assertFalse(board.streaming)
+        board.disconnect()
+
+    def test_start_streaming_queue_stalled(self):
+        self.test_init()
+        self.cyton.ser.timeout = 0.1
+        self.cyton.ser.write(bytes(sample_packet(1)))
+        samples = []
+
+        # the board stops sending, the acquisition thread gives up
+        self.cyton.start_streaming(samples.append, queue_size=10)
+
+        self.assertListEqual([sample.id for sample in samples], [1])
+        self.assertFalse(self.cyton.streaming)
+
+
+def fake_board(reply=b'OpenBCI V3 8-16 channel\n$$$', delay=0, received=None):
+    """
+    socket:// stand-in for a serial port, answers to the version command. With a `delay`, the
+    answer comes in two halves that long apart. What the host sends afterwards is added to
+    `received`.
+    """
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def serve():
+        connection, _ = server.accept()
+        command = connection.recv(1)
+        # the stop command might come first
+        while command == b's':
+            command = connection.recv(1)
+        if command == b'v':
+            connection.sendall(reply[:len(reply) // 2])
+            time.sleep(delay)
+            connection.sendall(reply[len(reply) // 2:])
+        if received is None:
+            connection.recv(1)
+        else:
+            connection.settimeout(0.5)
+            try:
+                while True:
+                    chunk = connection.recv(64)
+                    if not chunk:
+                        break
+                    received.extend(chunk)
+            except socket.timeout:
+                pass
+        connection.close()
+        server.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+    return 'socket://127.0.0.1:%d' % server.getsockname()[1]
+
+
+class FakeDongle(threading.Thread):
+    """ socket:// stand-in emulating the answers of the dongle firmware to radio commands. """
+
+    BAUD_RATES = {0x05: 115200, 0x06: 230400, 0x0A: 921600}
+
+    def __init__(self, link_ok_at=(115200, 230400, 921600)):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.baud = 115200
+        self.link_ok_at = link_ok_at
+        # everything sent by the host
+        self.received = bytearray()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.url = 'socket://127.0.0.1:%d' % self.server.getsockname()[1]
+        self.start()
+
+    def run(self):
+        connection, _ = self.server.accept()
+        data = bytearray()
+        while True:
+            chunk = connection.recv(64)
+            if not chunk:
+                break
+            data += chunk
+            self.received += chunk
+            while data:
+                if data[0] == ord('v'):
+                    reply, data = b'OpenBCI V3 8-16 channel\n$$$', data[1:]
+                elif data[0] == 0xF0 and len(data) > 1:
+                    reply, data = self.radio(data[1]), data[2:]
+                elif data[0] == 0xF0:
+                    break
+                else:
+                    reply, data = b'', data[1:]
+                if reply:
+                    connection.sendall(reply)
+        connection.close()
+        self.server.close()
+
+    def radio(self, code):
+        if self.baud not in self.link_ok_at:
+            # garbage at this speed
+            return b'\xff\xfe'
+        if code == 0x07:
+            return b'Success: System is Up$$$'
+        if code in self.BAUD_RATES:
+            reply = 'Success: Switch your baud rate to %d$$$' % self.BAUD_RATES[code]
+            self.baud = self.BAUD_RATES[code]
+            return reply.encode()
+        return b'Failure: unknown command$$$'
+
+
+class FakeStreamingBoard(threading.Thread):
+    """
+    socket:// stand-in of a board: streams packets between 'b' and 's', answers the soft reset
+    'v'. After `good_packets` packets, only corrupt ones are sent until the next soft reset.
+    """
+
+    def __init__(self, good_packets=None, streaming=False):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.good_packets = good_packets
+        self.streaming = streaming
+        self.resets = 0
+        # everything sent by the host
+        self.received = bytearray()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(1)
+        self.url = 'socket://127.0.0.1:%d' % self.server.getsockname()[1]
+        self.start()
+
+    def run(self):
+        connection, _ = self.server.accept()
+        connection.settimeout(0.002)
+        streaming = self.streaming
+        corrupt = False
+        sent = 0
+        while True:
+            try:
+                chunk = connection.recv(64)
+                if not chunk:
+                    break
+            except socket.timeout:
+                chunk = b''
+            except socket.error:
+                break
+            self.received += chunk
+            for byte in bytearray(chunk):
+                if byte == ord('b'):
+                    streaming = True
+                elif byte == ord('s'):
+                    streaming = False
+                elif byte == ord('v'):
+                    streaming = corrupt = False
+                    self.resets += 1
+                    connection.sendall(b'OpenBCI V3 8-16 channel\n$$$')
+            if streaming:
+                packet = sample_packet(sent % 256)
+                if self.good_packets is not None and sent >= self.good_packets and \
+                        self.resets < 2:
+                    corrupt = True
+                if corrupt:
+                    packet[-1] = 0
+                else:
+                    sent += 1
+                try:
+                    connection.sendall(bytes(packet))
+                except socket.error:
+                    break
+        connection.close()
+        self.server.close()
+
+
+class TestFindPort(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = DeviceCache('cyton', path=os.path.join(self.folder, 'devices.json'))
+        # find_port does not need a connected board
+        self.cyton = OpenBCICyton.__new__(OpenBCICyton)
+        self.cyton.baudrate = 115200
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_probe_ports(self):
+        board = fake_board()
+        self.assertEqual(self.cyton._probe_ports(['loop://', board, 'loop://'], 0.5), board)
+        self.assertIsNone(self.cyton._probe_ports(['loop://', fake_board(b'Hello$$$')], 0.5))
+
+    def test_find_port_cached(self):
+        board = fake_board()
+        candidates = [('loop://', 'DN0000A'), (board, 'DN0000B')]
+        with mock.patch.object(cyton, 'serial_port_candidates', return_value=candidates):
+            self.assertEqual(self.cyton.find_port(probe_timeout=0.5, cache=self.cache), board)
+            self.assertEqual(self.cache.items(), {'DN0000B': board})
+
+            # the dongle moved, its new port is tried first
+            moved = fake_board()
+            candidates[:] = [('loop://', 'DN0000A'), (moved, 'DN0000B')]
+            with mock.patch.object(OpenBCICyton, '_probe_ports',
+                                   side_effect=lambda ports, timeout: ports[0]) as probe:
+                self.assertEqual(self.cyton.find_port(cache=self.cache), moved)
+                probe.assert_called_once_with([moved], 2)
+
+        with mock.patch.object(cyton, 'serial_port_candidates', return_value=[('loop://', 'A')]):
+            with self.assertRaises(OSError):
+                self.cyton.find_port(probe_timeout=0.1, cache=self.cache)
+
+    def test_usb_device_key(self):
+        self.assertEqual(cyton.usb_device_key(
+            ('/dev/ttyUSB0', 'FT231X', 'USB VID:PID=0403:6015 SER=DN00ABCD')), 'DN00ABCD')
+        self.assertEqual(cyton.usb_device_key(
+            ('/dev/ttyUSB0', 'FT231X', 'USB VID:PID=403:6015')), '0403:6015')
+        self.assertEqual(cyton.usb_device_key(('COM3', 'n/a', 'n/a')), 'COM3')
+
 
 if __name__ == "__main__":
     unittest.main()
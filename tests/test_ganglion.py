@@ -0,0 +1,381 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+from unittest import TestCase, main
+
+import mock
+import numpy as np
+
+from openbci.ganglion import (GanglionDelegate, OpenBCIGanglion, SampleRing, decompressDeltas,
+                              decompressDeltas18Bit, decompressDeltas19Bit, decompressDeltasBlock,
+                              scale_fac_accel_G_per_count, scale_fac_uVolts_per_count)
+from openbci.utils import DeviceCache
+
+# data portion of compressed packets and the deltas decoded by the original shift by shift
+# implementation
+DELTAS_19_BIT = [
+    (bytearray([0] * 19), [[0, 0, 0, 0], [0, 0, 0, 0]]),
+    (bytearray([0xFF] * 19), [[-1, -1, -1, -1], [-1, -1, -1, -1]]),
+    (bytearray(range(1, 20)), [[2064, -474879, 134158, 32912], [329094, 13368, 123394, -454125]]),
+    (bytearray([0b10101010, 0b01010101] * 9 + [0x0F]),
+     [[-175443, 169322, 306004, -173403], [185642, 436566, -177483, -371441]])
+]
+DELTAS_18_BIT = [
+    (bytearray([0] * 18), [[0, 0, 0, 0], [0, 0, 0, 0]]),
+    (bytearray([0xFF] * 18), [[-1, -1, -1, -1], [-1, -1, -1, -1]]),
+    (bytearray(range(1, 19)), [[1032, 12352, -179839, -63479], [10284, 49360, 230340, 4370]]),
+    (bytearray([0b10101010, 0b01010101] * 9),
+     [[174422, 173402, 169322, 153002], [-174423, -173403, -169323, -153003]])
+]
+
+
+class TestDecompressDeltas(TestCase):
+
+    def test_decompress_deltas_19_bit(self):
+        for buffer, deltas in DELTAS_19_BIT:
+            self.assertListEqual(decompressDeltas19Bit(buffer), deltas)
+            self.assertListEqual(decompressDeltas(bytes(buffer), 19), deltas)
+        with self.assertRaises(ValueError):
+            decompressDeltas19Bit(bytearray(18))
+
+    def test_decompress_deltas_18_bit(self):
+        for buffer, deltas in DELTAS_18_BIT:
+            self.assertListEqual(decompressDeltas18Bit(buffer), deltas)
+        with self.assertRaises(ValueError):
+            decompressDeltas18Bit(bytearray(19))
+
+    def test_decompress_deltas_block(self):
+        for bits, vectors in [(19, DELTAS_19_BIT), (18, DELTAS_18_BIT)]:
+            data = b''.join(bytes(buffer) for buffer, deltas in vectors)
+            block = decompressDeltasBlock(data, bits)
+            self.assertEqual(block.shape, (len(vectors), 2, 4))
+            self.assertEqual(block.dtype, np.int32)
+            self.assertListEqual(block.tolist(), [deltas for buffer, deltas in vectors])
+
+        # same from an array of packets
+        packets = np.array([buffer for buffer, deltas in DELTAS_18_BIT], dtype=np.uint8)
+        self.assertListEqual(decompressDeltasBlock(packets, 18).tolist(),
+                             [deltas for buffer, deltas in DELTAS_18_BIT])
+        with self.assertRaises(ValueError):
+            decompressDeltasBlock(bytes(bytearray(20)), 19)
+
+    def test_decompress_deltas_random(self):
+        # block and single packet decoding agree
+        rng = np.random.RandomState(0)
+        for bits in [19, 18]:
+            packets = rng.randint(0, 256, size=(500, bits)).astype(np.uint8)
+            block = decompressDeltasBlock(packets, bits)
+            for packet, deltas in zip(packets, block.tolist()):
+                self.assertListEqual(decompressDeltas(bytearray(packet), bits), deltas)
+
+
+class TestGanglionDelegate(TestCase):
+
+    def test_parse_19_bit(self):
+        delegate = GanglionDelegate(scaling_output=False)
+        # raw packet: 4 channels of 24 bits then padding
+        delegate.parse(bytearray([0, 0, 0, 10, 0, 0, 20, 0, 0, 30, 0, 0, 40] + [0] * 7))
+        buffer, deltas = DELTAS_19_BIT[2]
+        delegate.parse(bytearray([101]) + buffer)
+
+        samples = delegate.getSamples()
+        self.assertListEqual([sample.id for sample in samples], [0, 1, 2])
+        self.assertListEqual(samples[0].channel_data, [10, 20, 30, 40])
+        first = [c - d for c, d in zip([10, 20, 30, 40], deltas[0])]
+        self.assertListEqual(samples[1].channel_data, first)
+        self.assertListEqual(samples[2].channel_data, [c - d for c, d in zip(first, deltas[1])])
+        self.assertListEqual(delegate.getSamples(), [])
+
+    def test_chain_validity(self):
+        delegate = GanglionDelegate(scaling_output=False)
+        buffer = DELTAS_19_BIT[2][0]
+        raw = bytearray([0, 0, 0, 10, 0, 0, 20, 0, 0, 30, 0, 0, 40] + [0] * 7)
+
+        # no raw packet yet, the deltas are applied to nothing
+        delegate.parse(bytearray([200]) + buffer)
+        delegate.parse(raw)
+        delegate.parse(bytearray([101]) + buffer)
+        # packets 2 and 3 lost
+        delegate.parse(bytearray([104]) + buffer)
+        delegate.parse(bytearray([105]) + buffer)
+        self.assertFalse(delegate.chain_valid)
+        # packets up to 100 lost too, the raw packet re-anchors the chain anyway
+        delegate.parse(raw)
+
+        samples = delegate.getSamples()
+        self.assertListEqual([sample.id for sample in samples], [199, 200, 0, 1, 2, 7, 8, 9, 10, 0])
+        self.assertListEqual([sample.valid for sample in samples],
+                             [False, False, True, True, True, False, False, False, False, True])
+        state = delegate.getChainState()
+        self.assertTrue(state['valid'])
+        self.assertEqual(state['breaks'], 2)
+        self.assertEqual(state['samples_invalid'], 6)
+        self.assertGreater(state['seconds_invalid'], 0)
+
+    def test_parse_18_bit_scaled(self):
+        delegate = GanglionDelegate()
+        buffer, deltas = DELTAS_18_BIT[2]
+        # accelerometer X in the last byte
+        delegate.parse(bytearray([11]) + buffer + bytearray([2]))
+
+        ids, channel_data, aux_data, imp_data, valid = delegate.getBlock()
+        self.assertListEqual(ids.tolist(), [21, 22])
+        self.assertEqual(channel_data.shape, (2, 4))
+        np.testing.assert_allclose(channel_data[0],
+                                   -np.array(deltas[0]) * scale_fac_uVolts_per_count)
+        np.testing.assert_allclose(aux_data, [[2 * scale_fac_accel_G_per_count, 0, 0]] * 2)
+
+    def test_ring_overflow(self):
+        ring = SampleRing(size=3)
+        ring.push([1, 2], np.ones((2, 4)), [0, 0, 0], [0] * 5)
+        ring.push([3, 4], np.ones((2, 4)) * 2, [1, 1, 1], [0] * 5)
+        self.assertEqual(len(ring), 3)
+
+        # overwritten samples are counted when the consumer comes
+        ids, channel_data, aux_data, imp_data, valid = ring.pop()
+        self.assertEqual(ring.overflows, 1)
+        self.assertListEqual(ids.tolist(), [2, 3, 4])
+        self.assertListEqual(channel_data[:, 0].tolist(), [1, 2, 2])
+        self.assertListEqual(aux_data[:, 0].tolist(), [0, 1, 1])
+        self.assertEqual(len(ring), 0)
+
+        # wraps around the end of the arrays
+        ring.push([5, 6], np.ones((2, 4)) * 3, [0, 0, 0], [0] * 5)
+        self.assertListEqual(ring.pop()[0].tolist(), [5, 6])
+        ring.push(list(range(10)), np.zeros((10, 4)), [0, 0, 0], [0] * 5)
+        self.assertListEqual(ring.pop()[0].tolist(), [7, 8, 9])
+        self.assertEqual(ring.overflows, 8)
+
+    def test_ring_threads(self):
+        ring = SampleRing(size=64)
+        nb_samples = 20000
+        received = []
+
+        def produce():
+            for i in range(0, nb_samples, 2):
+                ring.push([i, i + 1], np.array([[i] * 4, [i + 1] * 4]), [0, 0, 0], [0] * 5)
+
+        producer = threading.Thread(target=produce)
+        producer.start()
+        while producer.is_alive() or len(ring):
+            ids, channel_data, aux_data, imp_data, valid = ring.pop()
+            # each row is consistent, whatever was going on in the other thread
+            self.assertListEqual(channel_data[:, 0].tolist(), ids.tolist())
+            received.extend(ids.tolist())
+        producer.join()
+
+        self.assertEqual(len(received) + ring.overflows, nb_samples)
+        self.assertListEqual(received, sorted(set(received)))
+
+
+class TestOpenBCIGanglion(TestCase):
+
+    @mock.patch('openbci.ganglion.atexit')
+    @mock.patch.object(OpenBCIGanglion, 'connect')
+    def setUp(self, connect, atexit):
+        self.ganglion = OpenBCIGanglion(port='00:00:00:00:00:00', log=False, cache=mock.Mock())
+        self.ganglion.delegate = GanglionDelegate(scaling_output=False)
+        self.ganglion.gang = mock.Mock()
+        self.ganglion.streaming = True
+        self.ganglion.time_last_packet = timeit.default_timer()
+
+    def test_read_samples_burst(self):
+        notifications = [bytearray([101 + i]) + DELTAS_19_BIT[0][0] for i in range(3)]
+
+        def wait(delay):
+            if not notifications:
+                return False
+            self.ganglion.delegate.parse(notifications.pop(0))
+            return True
+
+        self.ganglion.gang.waitForNotifications.side_effect = wait
+        samples = self.ganglion._read_samples()
+
+        self.assertListEqual([sample.id for sample in samples], [1, 2, 3, 4, 5, 6])
+        delays = [call[0][0] for call in self.ganglion.gang.waitForNotifications.call_args_list]
+        # one wait, then the burst is drained without sleeping
+        self.assertGreater(delays[0], 0.1)
+        self.assertListEqual(delays[1:], [0, 0, 0])
+
+    def test_check_connection_packets_dropped(self):
+        self.ganglion.reconnect = mock.Mock()
+        self.ganglion.max_packets_to_skip = 5
+        self.ganglion.delegate.parse(bytearray([101]) + DELTAS_19_BIT[0][0])
+        self.ganglion.delegate.parse(bytearray([120]) + DELTAS_19_BIT[0][0])
+        self.ganglion.warn = mock.Mock()
+
+        self.ganglion._read_samples()
+        # the link is up, no reconnection
+        self.ganglion.reconnect.assert_not_called()
+        self.assertIn('18 packets dropped', self.ganglion.warn.call_args[0][0])
+
+    def test_read_samples_wait_until_timeout(self):
+        self.ganglion.gang.waitForNotifications.return_value = False
+        self.ganglion.time_last_packet = timeit.default_timer() - 1.8
+        self.assertListEqual(self.ganglion._read_samples(), [])
+        delay = self.ganglion.gang.waitForNotifications.call_args[0][0]
+        # the connection is checked when the 2s timeout elapses
+        self.assertLess(delay, 0.25)
+        self.assertGreaterEqual(delay, 1. / 200)
+
+
+class TestGanglionReconnect(TestCase):
+
+    @mock.patch('openbci.ganglion.atexit')
+    @mock.patch('openbci.ganglion.Peripheral')
+    def test_reconnect(self, peripheral, atexit):
+        ganglion = OpenBCIGanglion(port='00:00:00:00:00:00', log=False, cache=mock.Mock())
+        service = peripheral.return_value.getServiceByUUID.return_value
+        char_write = service.getCharacteristics.return_value[0]
+        ganglion.set_channel(2, 0)
+        ganglion.test_signal(1)
+        ganglion.set_channel(2, 1)
+        ganglion.init_streaming()
+        char_write.write.reset_mock()
+
+        ganglion.reconnect()
+        # BLE characteristics found once, for the first connection
+        self.assertEqual(peripheral.return_value.getServiceByUUID.call_count, 1)
+        self.assertEqual(peripheral.call_count, 2)
+        self.assertIs(char_write.peripheral, peripheral.return_value)
+        writes = [call[0][0] for call in char_write.write.call_args_list]
+        self.assertListEqual(writes, [b's', b' ', b'[@', b'b'])
+        self.assertLess(ganglion.time_to_reconnect, 1)
+
+    @mock.patch('openbci.ganglion.atexit')
+    @mock.patch('openbci.ganglion.Peripheral')
+    def test_start_streaming_queue_reconnect(self, peripheral, atexit):
+        ganglion = OpenBCIGanglion(port='00:00:00:00:00:00', log=False, cache=mock.Mock(),
+                                   timeout=0.1)
+        reconnect = ganglion.reconnect
+        ganglion.reconnect = mock.Mock(side_effect=reconnect)
+        connect = ganglion.connect
+
+        def slow_connect(fast=False):
+            # long enough for the main loop to notice that streaming is off
+            time.sleep(0.3)
+            connect(fast)
+
+        ganglion.connect = slow_connect
+        notifications = [bytearray([101 + i]) + DELTAS_19_BIT[0][0] for i in range(3)]
+
+        def wait(delay):
+            # silence until the link is reconnected, on the acquisition thread
+            if not ganglion.reconnect.called or not notifications:
+                return False
+            ganglion.delegate.parse(notifications.pop(0))
+            return True
+
+        peripheral.return_value.waitForNotifications.side_effect = wait
+        samples = []
+
+        def callback(sample):
+            samples.append(sample)
+            if len(samples) == 6:
+                ganglion.stop()
+
+        timer = threading.Timer(5, ganglion.stop)
+        timer.start()
+        ganglion.start_streaming(callback, queue_size=10)
+        timer.cancel()
+
+        self.assertEqual(ganglion.reconnect.call_count, 1)
+        self.assertListEqual([sample.id for sample in samples], [1, 2, 3, 4, 5, 6])
+        self.assertFalse(ganglion.streaming)
+
+
+class FakeScanner(object):
+    """ Reports the devices given, one after the other. """
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.reported = 0
+
+    def scan(self, timeout, on_device):
+        for mac, name in self.devices:
+            self.reported += 1
+            if on_device(mac, name):
+                return
+
+
+class TestGanglionFindPort(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = DeviceCache('ganglion', path=os.path.join(self.folder, 'devices.json'))
+        self.scanner = FakeScanner([('aa:00', None), ('aa:01', 'Ganglion-0001'),
+                                    ('aa:02', 'Ganglion-0002'), ('aa:03', 'Other')])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    @mock.patch('openbci.ganglion.atexit')
+    @mock.patch.object(OpenBCIGanglion, 'connect')
+    def test_find_port(self, connect, atexit):
+        ganglion = OpenBCIGanglion(cache=self.cache, scanner=self.scanner)
+        # the first Ganglion seen, without waiting for the end of the scan
+        self.assertEqual(ganglion.port, 'aa:01')
+        self.assertEqual(self.scanner.reported, 2)
+        self.assertEqual(self.cache.items(), {'aa:01': 'Ganglion-0001'})
+
+        ganglion.name = 'Ganglion-0002'
+        self.assertEqual(ganglion.find_port(), 'aa:02')
+        ganglion.name = 'Ganglion-0003'
+        with self.assertRaises(OSError):
+            ganglion.find_port()
+
+    @mock.patch('openbci.ganglion.atexit')
+    @mock.patch.object(OpenBCIGanglion, 'connect')
+    def test_connect_cached(self, connect, atexit):
+        self.cache.set('aa:02', 'Ganglion-0002')
+        ganglion = OpenBCIGanglion(cache=self.cache, scanner=self.scanner)
+        # connected directly, no scan
+        self.assertEqual(ganglion.port, 'aa:02')
+        self.assertEqual(self.scanner.reported, 0)
+        connect.assert_called_once_with()
+
+        # not around anymore, scanning then
+        connect.side_effect = [Exception('Failed to connect to peripheral'), None]
+        ganglion = OpenBCIGanglion(cache=self.cache, scanner=self.scanner)
+        self.assertEqual(ganglion.port, 'aa:01')
+        self.assertEqual(connect.call_count, 3)
+        self.assertEqual(self.cache.items(), {'aa:01': 'Ganglion-0001', 'aa:02': 'Ganglion-0002'})
+
+        # only the Ganglion named is tried
+        connect.reset_mock()
+        connect.side_effect = None
+        ganglion = OpenBCIGanglion(cache=self.cache, scanner=self.scanner, name='Ganglion-0002')
+        self.assertEqual(ganglion.port, 'aa:02')
+        connect.assert_called_once_with()
+
+    @mock.patch('openbci.ganglion.atexit')
+    @mock.patch.object(OpenBCIGanglion, 'connect')
+    def test_connect_cached_latest(self, connect, atexit):
+        with mock.patch('time.time', return_value=1000.):
+            self.cache.set('aa:01', 'Ganglion-0001')
+        with mock.patch('time.time', return_value=1001.):
+            self.cache.set('aa:02', 'Ganglion-0002')
+        ganglion = OpenBCIGanglion(port='aa:03', cache=mock.Mock(), scanner=self.scanner)
+        ganglion.cache = self.cache
+        connect.reset_mock()
+
+        # a single attempt, with the Ganglion seen last, the port is kept if it fails
+        connect.side_effect = Exception('Failed to connect to peripheral')
+        self.assertIsNone(ganglion.connect_cached())
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(ganglion.port, 'aa:03')
+
+        connect.side_effect = None
+        self.assertEqual(ganglion.connect_cached(), 'aa:02')
+        ganglion.name = 'Ganglion-0001'
+        self.assertEqual(ganglion.connect_cached(), 'aa:01')
+        ganglion.name = 'Ganglion-0003'
+        self.assertIsNone(ganglion.connect_cached())
+        self.assertEqual(ganglion.port, 'aa:01')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import math
+from unittest import TestCase, main
+
+from openbci.cyton import OpenBCISample
+from openbci.utils import Constants, SampleGapDetector
+
+
+def make_sample(sample_id, value=0.):
+    return OpenBCISample(sample_id, [value, 2 * value], [value])
+
+
+class TestSampleGapDetector(TestCase):
+
+    def test_init_invalid(self):
+        with self.assertRaises(ValueError):
+            SampleGapDetector(fill='zero')
+
+    def test_count_wraparound(self):
+        detector = SampleGapDetector()
+        samples = [make_sample(i) for i in [253, 254, 255, 0, 1, 3, 4]]
+
+        self.assertIs(detector.process_many(samples), samples)
+        self.assertEqual(detector.samples_received, 7)
+        self.assertEqual(detector.samples_lost, 1)
+        self.assertAlmostEqual(detector.loss_rate(), 1 / 8.)
+
+        detector.process(make_sample(250))
+        self.assertEqual(detector.samples_lost, 1 + 245)
+
+    def test_duplicate_and_reset(self):
+        detector = SampleGapDetector()
+        detector.process_many([make_sample(i) for i in [1, 1, 2]])
+        self.assertEqual(detector.duplicates, 1)
+        self.assertEqual(detector.samples_lost, 0)
+
+        detector.reset()
+        detector.process(make_sample(100))
+        self.assertEqual(detector.samples_lost, 0)
+
+    def test_window_loss_rate(self):
+        detector = SampleGapDetector(window=4)
+        detector.process_many([make_sample(i) for i in [0, 5, 6, 7, 8]])
+        # 4 received for 4 lost within the window
+        self.assertAlmostEqual(detector.window_loss_rate(), 0.5)
+        detector.process(make_sample(9))
+        self.assertEqual(detector.window_loss_rate(), 0.)
+        self.assertAlmostEqual(detector.loss_rate(), 4 / 10.)
+
+    def test_fill_nan(self):
+        detector = SampleGapDetector(fill=Constants.GAP_FILL_NAN)
+        samples = detector.process_many([make_sample(254, 1.), make_sample(1, 4.)])
+
+        self.assertListEqual([sample.id for sample in samples], [254, 255, 0, 1])
+        self.assertTrue(all(math.isnan(value) for value in samples[1].channel_data))
+        self.assertTrue(math.isnan(samples[2].aux_data[0]))
+        self.assertListEqual(samples[3].channel_data, [4., 8.])
+
+    def test_placeholders_marked(self):
+        detector = SampleGapDetector(fill=Constants.GAP_FILL_NAN)
+        samples = detector.process_many([make_sample(1, 1.), make_sample(3, 4.)])
+
+        self.assertListEqual([sample.valid for sample in samples], [True, False, True])
+        self.assertEqual(samples[1].sample_number, 2)
+        self.assertEqual(samples[2].sample_number, 3)
+
+    def test_placeholders_data(self):
+        for fill in [Constants.GAP_FILL_NAN, Constants.GAP_FILL_INTERPOLATE]:
+            detector = SampleGapDetector(fill=fill)
+            last = make_sample(1, 1.)
+            # no accelerometer data in the sample before the gap
+            last.accel_data = []
+            sample = make_sample(3, 4.)
+            samples = detector.process_many([last, sample])
+
+            placeholder = samples[1]
+            self.assertTrue(math.isnan(placeholder.accel_data[0]))
+            # nothing shared with the sample after the gap
+            placeholder.accel_data.append(0.)
+            self.assertListEqual(sample.aux_data, [4.])
+            self.assertListEqual(sample.accel_data, [4.])
+
+    def test_fill_interpolate_daisy(self):
+        detector = SampleGapDetector(fill=Constants.GAP_FILL_INTERPOLATE, step=2)
+        samples = detector.process_many([make_sample(1, 1.), make_sample(7, 4.)])
+
+        self.assertListEqual([sample.id for sample in samples], [1, 3, 5, 7])
+        self.assertListEqual([sample.channel_data for sample in samples],
+                             [[1., 2.], [2., 4.], [3., 6.], [4., 8.]])
+        self.assertListEqual(samples[1].aux_data, [2.])
+        # cyton samples have their accelerometer data in aux_data and accel_data
+        self.assertListEqual(samples[1].accel_data, [2.])
+
+    def test_max_fill(self):
+        detector = SampleGapDetector(fill=Constants.GAP_FILL_NAN, max_fill=2)
+        self.assertEqual(len(detector.process_many([make_sample(0), make_sample(10)])), 2)
+        self.assertEqual(detector.samples_lost, 9)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+from unittest import TestCase, main
+
+from openbci.utils import CYTON_COMMAND_LENGTHS, CommandJournal
+
+
+class TestCommandJournal(TestCase):
+
+    def test_last_command_per_setting(self):
+        journal = CommandJournal()
+        for command in [b'1', b'f', b'!', b'2', b'b', b's', b'-', b'g']:
+            journal.record(command)
+        # channel 1 back on, filters off, start and stop are not settings
+        self.assertListEqual(journal.commands(), [b'!', b'2', b'-', b'g'])
+
+    def test_commands_of_several_bytes(self):
+        journal = CommandJournal(CYTON_COMMAND_LENGTHS)
+        # sent one byte at a time, the channel number is not a channel toggle
+        for byte in bytearray(b'x1060110X3x2161000X'):
+            journal.record(bytearray([byte]))
+        journal.record(b'x1000000X~4')
+        self.assertListEqual(journal.commands(), [b'3', b'x2161000X', b'x1000000X', b'~4'])
+
+    def test_defaults_and_reset(self):
+        journal = CommandJournal(CYTON_COMMAND_LENGTHS)
+        journal.record(b'1x2161000X=')
+        journal.record(b'd')
+        self.assertListEqual(journal.commands(), [b'=', b'd'])
+        journal.record(b'v')
+        self.assertListEqual(journal.commands(), [])
+
+    def test_replay(self):
+        journal = CommandJournal()
+        journal.record(b'1234[')
+        writes = []
+        self.assertEqual(journal.replay(writes.append, chunk_size=2), b'1234[')
+        self.assertListEqual(writes, [b'12', b'34', b'['])
+
+        journal.clear()
+        writes = []
+        self.assertEqual(journal.replay(writes.append), b'')
+        self.assertListEqual(writes, [])
+
+
+if __name__ == '__main__':
+    main()
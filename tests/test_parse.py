@@ -3,13 +3,17 @@ import mock
 
 from openbci.utils import (Constants,
                            OpenBCISample,
+                           PacketFramer,
                            ParseRaw,
                            sample_packet,
+                           sample_packet_real,
                            sample_packet_standard_raw_aux,
                            sample_packet_accel_time_sync_set,
                            sample_packet_accel_time_synced,
                            sample_packet_raw_aux_time_sync_set,
                            sample_packet_raw_aux_time_synced,
+                           sample_packet_impedance,
+                           ClockSync,
                            RawDataToSample)
 
 
@@ -178,6 +182,72 @@ class TestParseRaw(TestCase):
         self.assertEqual(sample.stop_byte, 0xC0)
         self.assertTrue(sample.valid)
 
+    def test_parse_packet_standard_raw_aux(self):
+        parser = ParseRaw(gains=[24, 24, 24, 24, 24, 24, 24, 24], scaled_output=False)
+
+        sample = parser.transform_raw_data_packet_to_sample(sample_packet_standard_raw_aux(3))
+
+        self.assertTrue(sample.valid)
+        self.assertEqual(sample.packet_type, Constants.RAW_PACKET_TYPE_STANDARD_RAW_AUX)
+        self.assertEqual(sample.sample_number, 3)
+        self.assertEqual(sample.id, 3)
+        self.assertListEqual(sample.channel_data, [1, 2, 3, 4, 5, 6, 7, 8])
+        self.assertEqual(sample.aux_data, bytearray([0, 1, 2, 3, 4, 5]))
+        self.assertEqual(sample.stop_byte, 0xC1)
+
+    def test_parse_packet_time_synced_accel(self):
+        parser = ParseRaw(gains=[24, 24, 24, 24, 24, 24, 24, 24], scaled_output=False)
+        parser.raw_data_to_sample.time_offset = 1000
+
+        samples = [parser.transform_raw_data_packet_to_sample(sample_packet_accel_time_synced(i))
+                   for i in [6, 7, 8, 9]]
+
+        self.assertTrue(all(sample.valid for sample in samples))
+        self.assertListEqual([sample.board_time for sample in samples], [1, 1, 1, 1])
+        self.assertEqual(samples[0].timestamp, 1001)
+        self.assertEqual(samples[0].aux_data, bytearray([0, 1]))
+        self.assertListEqual(samples[0].channel_data, [1, 2, 3, 4, 5, 6, 7, 8])
+        # X, Y then Z: the accelerometer data is complete with the last one
+        self.assertListEqual([sample.accel_data for sample in samples], [[], [], [], [1, 1, 1]])
+
+        sample = parser.transform_raw_data_packet_to_sample(sample_packet_accel_time_sync_set(7))
+        self.assertTrue(sample.valid)
+        self.assertEqual(sample.packet_type, Constants.RAW_PACKET_TYPE_ACCEL_TIME_SYNC_SET)
+
+    def test_parse_packet_time_synced_raw_aux(self):
+        parser = ParseRaw(gains=[24, 24, 24, 24, 24, 24, 24, 24], scaled_output=False)
+
+        for data in [sample_packet_raw_aux_time_sync_set(5), sample_packet_raw_aux_time_synced(5)]:
+            sample = parser.transform_raw_data_packet_to_sample(data)
+            self.assertTrue(sample.valid)
+            self.assertIsNone(sample.error)
+            self.assertEqual(sample.board_time, 1)
+            self.assertEqual(sample.aux_data, bytearray([0, 1]))
+            self.assertEqual(sample.sample_number, 5)
+            self.assertGreater(sample.timestamp, 0)
+
+    def test_parse_packet_time_synced_clock_sync(self):
+        parser = ParseRaw(gains=[24, 24, 24, 24, 24, 24, 24, 24], scaled_output=False)
+        time_sync = ClockSync()
+        parser.raw_data_to_sample.time_sync = time_sync
+
+        # not synced yet, and no sync pending: a synced packet is not an answer
+        now = mock.patch('openbci.utils.time_sync.host_time_ms', return_value=500.)
+        with now:
+            parser.transform_raw_data_packet_to_sample(sample_packet_accel_time_synced(1))
+            self.assertFalse(time_sync.synced)
+            time_sync.start(host_time=490.)
+            sample = parser.transform_raw_data_packet_to_sample(
+                sample_packet_raw_aux_time_sync_set(2))
+
+        self.assertTrue(time_sync.synced)
+        self.assertFalse(time_sync.pending)
+        self.assertEqual(time_sync.last_round_trip, 10)
+        # board time 1 ms, received by the board in the middle of the round trip
+        self.assertEqual(sample.timestamp, 495)
+        sample = parser.transform_raw_data_packet_to_sample(sample_packet_accel_time_synced(3))
+        self.assertEqual(sample.timestamp, 495)
+
     @mock.patch.object(ParseRaw, 'parse_packet_standard_accel')
     def test_transform_raw_data_packet_to_sample_accel(self, mock_parse_packet_standard_accel):
         data = sample_packet(0)
@@ -234,6 +304,48 @@ class TestParseRaw(TestCase):
 
         mock_parse_packet_time_synced_raw_aux.assert_called_once()
 
+    def test_get_ads1299_scale_factors_cached(self):
+        parser = ParseRaw(gains=[24, 24, 24, 24, 24, 24, 24, 24], micro_volts=True)
+
+        scale_factors = parser.get_ads1299_scale_factors([24, 24])
+        self.assertListEqual(scale_factors, parser.scale_factors[:2])
+        self.assertAlmostEqual(scale_factors[0], 4.5 / 24 / (pow(2, 23) - 1) * 1000000.)
+        self.assertNotEqual(parser.get_ads1299_scale_factors([24, 24], micro_volts=False),
+                            scale_factors)
+
+        # a modified list does not change the cache
+        scale_factors[0] = 0
+        self.assertNotEqual(parser.get_ads1299_scale_factors([24, 24])[0], 0)
+
+    def test_packet_parsers(self):
+        parser = ParseRaw()
+        self.assertEqual(len(parser.packet_parsers), 16)
+
+        sample = parser.transform_raw_data_packet_to_sample(sample_packet_impedance(1))
+        self.assertFalse(sample.valid)
+        self.assertEqual(sample.error, 'This module does not support packet type %d'
+                         % Constants.RAW_PACKET_TYPE_IMPEDANCE)
+        self.assertEqual(sample.packet_type, Constants.RAW_PACKET_TYPE_IMPEDANCE)
+
+    def test_transform_raw_data_packets_to_sample_batch(self):
+        datas = [sample_packet_real(0), sample_packet_impedance(1), sample_packet_real(2),
+                 sample_packet_real(3)[:20]]
+
+        parser = ParseRaw(gains=[24, 24, 24, 24, 24, 24, 24, 24], scaled_output=True)
+        samples = parser.transform_raw_data_packets_to_sample(datas)
+
+        self.assertEqual(len(samples), len(datas))
+        self.assertListEqual([sample.valid for sample in samples], [True, False, True, False])
+        for i in [0, 2]:
+            expected = parser.transform_raw_data_packet_to_sample(datas[i])
+            self.assertEqual(samples[i].sample_number, i)
+            self.assertEqual(samples[i].packet_type, expected.packet_type)
+            self.assertEqual(samples[i].stop_byte, expected.stop_byte)
+            for actual, value in zip(samples[i].channel_data, expected.channel_data):
+                self.assertAlmostEqual(actual, value)
+            for actual, value in zip(samples[i].accel_data, expected.accel_data):
+                self.assertAlmostEqual(actual, value)
+
     def test_transform_raw_data_packets_to_sample(self):
         datas = [sample_packet(0), sample_packet(1), sample_packet(2)]
 
@@ -246,6 +358,52 @@ class TestParseRaw(TestCase):
         for i in range(len(samples)):
             self.assertEqual(samples[i].sample_number, i)
 
+    def test_transform_raw_data_packets_to_sample_views(self):
+        datas = [sample_packet_real(0), sample_packet_real(1), sample_packet_real(2)]
+        views = [memoryview(bytearray(data)) for data in datas]
+
+        parser = ParseRaw(gains=[24, 24, 24, 24, 24, 24, 24, 24], scaled_output=True)
+
+        samples = parser.transform_raw_data_packets_to_sample(views)
+        expected = parser.transform_raw_data_packets_to_sample(datas)
+
+        self.assertEqual(len(samples), len(datas))
+        for actual, value in zip(samples, expected):
+            self.assertEqual(actual.sample_number, value.sample_number)
+            self.assertListEqual(actual.channel_data, value.channel_data)
+            self.assertListEqual(actual.accel_data, value.accel_data)
+
+    def test_transform_raw_data_packets_to_arrays(self):
+        datas = [sample_packet_real(0), sample_packet(1), sample_packet_real(2)]
+
+        parser = ParseRaw(gains=[24, 24, 24, 24, 24, 24, 24, 24], scaled_output=True)
+
+        sample_numbers, channel_data, accel_data = \
+            parser.transform_raw_data_packets_to_arrays(datas)
+
+        self.assertEqual(channel_data.shape, (3, Constants.NUMBER_OF_CHANNELS_CYTON))
+        self.assertEqual(accel_data.shape, (3, Constants.RAW_PACKET_ACCEL_NUMBER_AXIS))
+        for i in range(len(datas)):
+            parser.raw_data_to_sample.raw_data_packet = datas[i]
+            self.assertEqual(sample_numbers[i], i)
+            self.assertListEqual(channel_data[i].tolist(),
+                                 parser.get_channel_data_array(parser.raw_data_to_sample))
+            self.assertListEqual(accel_data[i].tolist(),
+                                 parser.get_data_array_accel(parser.raw_data_to_sample))
+
+    def test_transform_raw_data_packets_to_arrays_counts(self):
+        data = sample_packet_real(0) + sample_packet_real(1)
+
+        parser = ParseRaw(gains=[24, 24, 24, 24, 24, 24, 24, 24], scaled_output=False)
+
+        sample_numbers, channel_data, accel_data = \
+            parser.transform_raw_data_packets_to_arrays(data)
+
+        self.assertListEqual(channel_data[0].tolist(),
+                             [-7343552, -7348236, -7328842, -7356481,
+                              8388607, 8388607, -7068364, 2143869])
+        self.assertListEqual(accel_data[1].tolist(), [224, 224, 3952])
+
     def test_make_daisy_sample_object_wifi(self):
         parser = ParseRaw(gains=[24, 24, 24, 24, 24, 24, 24, 24])
         # Make the lower sample(channels 1 - 8)
@@ -311,5 +469,107 @@ class TestParseRaw(TestCase):
         self.assertListEqual(daisy_sample.accel_data, [0, 1, 2])
 
 
+class TestPacketFramer(TestCase):
+
+    def test_feed_whole_packets(self):
+        framer = PacketFramer()
+
+        packets = framer.feed(sample_packet(0) + sample_packet(1) + sample_packet(2))
+
+        self.assertEqual(len(packets), 3)
+        for i in range(3):
+            self.assertEqual(bytes(packets[i]), bytes(sample_packet(i)))
+        self.assertEqual(framer.buffered(), 0)
+        self.assertEqual(framer.packets_framed, 3)
+
+    def test_feed_carries_partial_packet(self):
+        framer = PacketFramer()
+        data = sample_packet(7) + sample_packet(8)
+
+        self.assertEqual(framer.feed(data[:20]), [])
+        self.assertEqual(framer.buffered(), 20)
+
+        packets = framer.feed(data[20:50])
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(packets[0][Constants.RAW_PACKET_POSITION_SAMPLE_NUMBER], 7)
+
+        packets = framer.feed(data[50:])
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(packets[0][Constants.RAW_PACKET_POSITION_SAMPLE_NUMBER], 8)
+
+    def test_feed_skips_bytes_before_start(self):
+        framer = PacketFramer()
+
+        packets = framer.feed(bytearray([0x01, 0x02, 0x03]) + sample_packet(3))
+
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(framer.bytes_skipped, 3)
+
+    def test_feed_drops_invalid_stop_byte(self):
+        framer = PacketFramer()
+        bad_packet = sample_packet(4)
+        bad_packet[Constants.RAW_PACKET_POSITION_STOP_BYTE] = 0x00
+
+        packets = framer.feed(bad_packet + sample_packet(5))
+
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(packets[0][Constants.RAW_PACKET_POSITION_SAMPLE_NUMBER], 5)
+        self.assertEqual(framer.packets_invalid, 1)
+
+    def test_feed_resync(self):
+        # packet 4 lost its last 13 bytes, packet 5 starts where its stop byte was expected
+        data = sample_packet(3) + sample_packet(4)[:20] + sample_packet(5) + sample_packet(6)
+
+        framer = PacketFramer()
+        ids = [p[Constants.RAW_PACKET_POSITION_SAMPLE_NUMBER] for p in framer.feed(data)]
+        self.assertListEqual(ids, [3, 6])
+
+        framer = PacketFramer(resync=True)
+        ids = [p[Constants.RAW_PACKET_POSITION_SAMPLE_NUMBER] for p in framer.feed(data)]
+        self.assertListEqual(ids, [3, 5, 6])
+        self.assertEqual(framer.packets_invalid, 1)
+        self.assertEqual(framer.frames_recovered, 1)
+        self.assertEqual(framer.bytes_skipped, 20)
+
+    def test_feed_resync_implausible(self):
+        framer = PacketFramer(resync=True)
+        # a frame inside the channel data of the corrupt packet, with the wrong sample number
+        fake = sample_packet(200)
+        corrupt = sample_packet(4)[:3] + fake[:-1]
+        packets = framer.feed(sample_packet(3) + corrupt)
+        self.assertEqual(len(packets), 1)
+
+        # the fake frame is followed by garbage, not by another frame
+        packets = framer.feed(fake[-1:] + bytearray(40) + sample_packet(4) + sample_packet(5))
+        ids = [p[Constants.RAW_PACKET_POSITION_SAMPLE_NUMBER] for p in packets]
+        self.assertListEqual(ids, [4, 5])
+        self.assertEqual(framer.frames_recovered, 0)
+
+    def test_reset_while_resyncing(self):
+        framer = PacketFramer(resync=True)
+        packets = framer.feed(sample_packet(3) + sample_packet(4)[:20] + sample_packet(5)[:20])
+        self.assertEqual(len(packets), 1)
+        self.assertTrue(framer._resyncing)
+
+        framer.reset()
+        self.assertFalse(framer._resyncing)
+        self.assertEqual(framer._corrupt_left, 0)
+
+        packets = framer.feed(sample_packet(7) + sample_packet(8))
+        ids = [p[Constants.RAW_PACKET_POSITION_SAMPLE_NUMBER] for p in packets]
+        self.assertListEqual(ids, [7, 8])
+        self.assertEqual(framer.frames_recovered, 0)
+
+    def test_feed_grows_buffer(self):
+        framer = PacketFramer(buffer_size=Constants.RAW_PACKET_SIZE)
+        data = bytearray()
+        for i in range(10):
+            data += sample_packet(i)
+
+        packets = framer.feed(data)
+
+        self.assertEqual(len(packets), 10)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,90 @@
+import socket
+import threading
+import time
+import unittest
+
+from openbci.utils import ssdp
+
+SERVICE = 'urn:schemas-upnp-org:device:Basic:1'
+
+
+def ssdp_answer(location):
+    return ('HTTP/1.1 200 OK\r\n'
+            'CACHE-CONTROL: max-age=120\r\n'
+            'LOCATION: %s\r\n'
+            'ST: %s\r\n'
+            'USN: uuid:%s\r\n\r\n' % (location, SERVICE, location)).encode()
+
+
+class SSDPResponder(object):
+    """ Stand-in of the devices of the network, answers every search sent to `group`. """
+
+    def __init__(self, locations, delay=0.):
+        self.locations = locations
+        self.delay = delay
+        self.searches = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.group = self.sock.getsockname()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(1024)
+            except socket.error:
+                return
+            if not data.startswith(b'M-SEARCH'):
+                continue
+            self.searches += 1
+            for location in self.locations:
+                time.sleep(self.delay)
+                # devices usually answer more than once
+                self.sock.sendto(ssdp_answer(location), address)
+                self.sock.sendto(ssdp_answer(location), address)
+            self.sock.sendto(b'garbage', address)
+
+    def close(self):
+        self.sock.close()
+
+
+class TestDiscover(unittest.TestCase):
+
+    def setUp(self):
+        self.responder = SSDPResponder(['http://127.0.0.1/a.xml', 'http://127.0.0.1/b.xml'])
+
+    def tearDown(self):
+        self.responder.close()
+
+    def test_discover(self):
+        found = []
+        default_timeout = socket.getdefaulttimeout()
+        start = time.time()
+        responses = ssdp.discover(SERVICE, timeout=0.3, wifi_found_cb=found.append,
+                                  group=self.responder.group)
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        self.assertEqual(sorted(response.location for response in responses),
+                         ['http://127.0.0.1/a.xml', 'http://127.0.0.1/b.xml'])
+        # once per location
+        self.assertEqual([response.location for response in found],
+                         ['http://127.0.0.1/a.xml', 'http://127.0.0.1/b.xml'])
+        self.assertEqual(socket.getdefaulttimeout(), default_timeout)
+
+    def test_early_exit(self):
+        start = time.time()
+        responses = ssdp.discover(SERVICE, timeout=5, wifi_found_cb=lambda response: True,
+                                  group=self.responder.group)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(len(responses), 1)
+
+        stop = threading.Event()
+        threading.Timer(0.1, stop.set).start()
+        start = time.time()
+        ssdp.discover(SERVICE, timeout=5, stop=stop, group=self.responder.group)
+        self.assertLess(time.time() - start, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+from unittest import TestCase, main
+
+from openbci.utils import ClockSync
+
+
+class TestClockSync(TestCase):
+
+    def test_offset_and_drift(self):
+        sync = ClockSync()
+        self.assertFalse(sync.synced)
+        # host clock 1000 ms ahead, gaining 1 ms every 10 s of board time
+        for board_time in range(0, 60000, 5000):
+            sync.add_point(board_time, 1000 + board_time * 1.0001)
+
+        self.assertTrue(sync.synced)
+        self.assertAlmostEqual(sync.offset, 1000, places=6)
+        self.assertAlmostEqual(sync.drift, 0.0001, places=9)
+        self.assertAlmostEqual(sync.to_host(100000), 101010, places=6)
+
+    def test_window(self):
+        sync = ClockSync(window=2)
+        sync.add_point(0, 500)
+        sync.add_point(1000, 1500)
+        self.assertAlmostEqual(sync.to_host(2000), 2500)
+        # the first point leaves the regression, the offset changed
+        sync.add_point(2000, 2510)
+        self.assertEqual(sync.state()['points'], 2)
+        self.assertAlmostEqual(sync.drift, 0.01)
+        self.assertAlmostEqual(sync.to_host(3000), 3520)
+
+    def test_exchange(self):
+        sync = ClockSync(max_round_trip=20)
+        self.assertFalse(sync.sync_set(100, host_time=10))
+
+        sync.start(host_time=1000)
+        self.assertTrue(sync.pending)
+        self.assertTrue(sync.sync_set(100, host_time=1010))
+        self.assertFalse(sync.pending)
+        # board got the command in the middle of the round trip
+        self.assertEqual(sync.to_host(100), 1005)
+
+        # confirmed early, the packet itself came late
+        sync.start(host_time=2000)
+        sync.confirm(host_time=2002)
+        self.assertTrue(sync.sync_set(1101, host_time=2030))
+        self.assertEqual(sync.last_round_trip, 2)
+
+        sync.start(host_time=3000)
+        self.assertFalse(sync.sync_set(2100, host_time=3050))
+        self.assertEqual(sync.state()['rejected'], 1)
+        self.assertEqual(sync.state()['exchanges'], 3)
+
+    def test_reset(self):
+        sync = ClockSync()
+        sync.add_point(0, 10)
+        sync.reset()
+        self.assertFalse(sync.synced)
+        self.assertFalse(sync.wait(0))
+        sync.add_point(5000, 5020)
+        self.assertEqual(sync.to_host(5000), 5020)
+
+
+if __name__ == '__main__':
+    main()
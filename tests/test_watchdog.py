@@ -0,0 +1,90 @@
+import threading
+import time
+from unittest import TestCase, main
+
+from openbci.utils import ConnectionWatchdog
+
+
+class TestConnectionWatchdog(TestCase):
+
+    def test_check_healthy(self):
+        watchdog = ConnectionWatchdog(None, stall_timeout=1, max_drop_rate=0.5)
+        watchdog.packets_received(10)
+        watchdog.packets_dropped(2)
+        watchdog.bytes_skipped(100)
+
+        self.assertIsNone(watchdog.check())
+        state = watchdog.state()
+        self.assertEqual(state['packets_received'], 10)
+        self.assertEqual(state['packets_dropped'], 2)
+        self.assertEqual(state['bytes_skipped'], 100)
+        self.assertEqual(state['consecutive_dropped'], 2)
+        self.assertEqual(state['failures'], 0)
+
+    def test_check_consecutive_dropped(self):
+        watchdog = ConnectionWatchdog(None, max_packets_to_skip=3)
+        watchdog.packets_dropped(3)
+        self.assertIsNone(watchdog.check())
+        watchdog.packets_dropped()
+        self.assertIn('in a row', watchdog.check())
+        # a valid packet resets the count
+        watchdog.packets_received()
+        self.assertIsNone(watchdog.check())
+
+    def test_check_rates(self):
+        watchdog = ConnectionWatchdog(None, max_drop_rate=0.2)
+        watchdog.packets_received(7)
+        watchdog.packets_dropped(3)
+        self.assertIn('Drop rate', watchdog.check())
+
+        watchdog = ConnectionWatchdog(None, max_bytes_to_skip=500)
+        watchdog.bytes_skipped(501)
+        self.assertIn('bytes skipped', watchdog.check())
+        # new window
+        watchdog.rearm()
+        self.assertIsNone(watchdog.check())
+
+    def test_check_rates_new_window(self):
+        watchdog = ConnectionWatchdog(None, max_drop_rate=0.2, rate_window=0.05)
+        watchdog.packets_received(1000)
+        time.sleep(0.06)
+        # a new window starts
+        self.assertIsNone(watchdog.check())
+        # the packets of the previous window still count
+        watchdog.packets_dropped()
+        self.assertIsNone(watchdog.check())
+
+        # too few packets since the rearm to judge
+        watchdog.rearm()
+        watchdog.packets_dropped()
+        self.assertIsNone(watchdog.check())
+
+    def test_stall(self):
+        lost = threading.Event()
+        reasons = []
+
+        def on_failure(reason):
+            reasons.append(reason)
+            lost.set()
+
+        watchdog = ConnectionWatchdog(on_failure, interval=0.01, stall_timeout=0.05)
+        watchdog.start()
+        self.assertTrue(lost.wait(5))
+        watchdog.stop()
+
+        self.assertIn('No data', reasons[0])
+        self.assertGreaterEqual(watchdog.failures, 1)
+        self.assertFalse(watchdog.state()['running'])
+
+    def test_inactive(self):
+        failures = []
+        watchdog = ConnectionWatchdog(failures.append, is_active=lambda: False, interval=0.01,
+                                      stall_timeout=0.01)
+        watchdog.start()
+        time.sleep(0.1)
+        watchdog.stop()
+        self.assertListEqual(failures, [])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,27 @@
-from unittest import TestCase, main, skip
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from unittest import TestCase, main, skip, skipIf
 import mock
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
 from openbci import OpenBCIWiFi
+from openbci import wifi
+from openbci.utils import DeviceCache, sample_packet, ssdp
+from test_ssdp import SSDPResponder
+
+DESCRIPTION = '''<?xml version="1.0"?>
+<root><URLBase>http://%s/</URLBase><device><serialNumber>%s</serialNumber></device></root>'''
 
 
 class TestOpenBCIWiFi(TestCase):
@@ -41,5 +61,190 @@ class TestOpenBCIWiFi(TestCase):
         mock_on_shield_found.assert_called_with(expected_ip_address)
 
 
+@skipIf(wifi.asyncore is None, 'no asyncore')
+class TestWiFiShieldHandler(TestCase):
+
+    def setUp(self):
+        self.shield, sock = socket.socketpair()
+        self.samples = []
+        self.handler = wifi.WiFiShieldHandler(sock, callback=self.samples.append)
+
+    def tearDown(self):
+        self.handler.close()
+        self.shield.close()
+
+    def read(self, data):
+        self.shield.sendall(bytes(data))
+        self.handler.handle_read()
+        return [sample.sample_number for sample in self.samples]
+
+    def test_packets_split_across_reads(self):
+        data = sample_packet(1) + sample_packet(2) + sample_packet(3)
+        self.assertEqual(self.read(data[:20]), [])
+        self.assertEqual(self.read(data[20:50]), [1])
+        self.assertEqual(self.read(data[50:]), [1, 2, 3])
+        self.assertEqual(self.handler.decoder.framer.bytes_skipped, 0)
+        self.assertTrue(all(sample.valid for sample in self.samples))
+
+    def test_resync(self):
+        # garbage, then a packet cut short by the next one
+        data = b'\x01\x02' + sample_packet(1) + sample_packet(2)[:10] + sample_packet(3) + \
+            sample_packet(4)
+        self.assertEqual(self.read(data), [1, 3, 4])
+        self.assertEqual(self.handler.decoder.framer.packets_invalid, 1)
+        self.assertEqual(self.handler.decoder.framer.frames_recovered, 1)
+
+    def test_json_lines(self):
+        self.handler.decoder.high_speed = False
+        line = json.dumps({'chunk': [{'sampleNumber': 1}, {'sampleNumber': 2}]}).encode()
+        self.shield.sendall(line[:10])
+        self.handler.handle_read()
+        self.assertEqual(self.samples, [])
+        self.shield.sendall(line[10:] + b'\r\n')
+        self.handler.handle_read()
+        self.assertEqual(self.samples, [{'sampleNumber': 1}, {'sampleNumber': 2}])
+
+
+class ShieldStandIn(BaseHTTPRequestHandler):
+    """ HTTP API of the WiFi shield, enough to connect and send commands. """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def reply(self, content):
+        body = json.dumps(content).encode() if not isinstance(content, bytes) else content
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path in self.server.descriptions:
+            name, ip_address, delay = self.server.descriptions[self.path]
+            time.sleep(delay)
+            self.reply((DESCRIPTION % (ip_address, name)).encode())
+        elif self.path == '/board':
+            self.reply({'board_connected': True, 'board_type': 'daisy', 'num_channels': 16})
+        else:
+            self.reply({})
+
+    def do_POST(self):
+        content = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        if self.path == '/tcp':
+            self.reply({'connected': True})
+        else:
+            self.server.commands.append(content['command'])
+            self.reply(b'Success')
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ShieldTestCase(TestCase):
+    """ A shield stand-in on localhost, `self.shield` connected to it. """
+
+    def setUp(self):
+        self.http = ThreadingHTTPServer(('127.0.0.1', 0), ShieldStandIn)
+        self.http.connections = 0
+        self.http.commands = []
+        self.http.descriptions = {}
+        self.address = '127.0.0.1:%d' % self.http.server_port
+        self.thread = threading.Thread(target=self.http.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.folder = tempfile.mkdtemp()
+        self.cache = DeviceCache('wifi', path=os.path.join(self.folder, 'devices.json'))
+        self.shield = self.make_shield(ip_address=self.address)
+
+    def make_shield(self, **kwargs):
+        with mock.patch('openbci.wifi.atexit'):
+            return OpenBCIWiFi(local_ip_address='127.0.0.1', log=False, num_channels=16,
+                               cache=self.cache, **kwargs)
+
+    def tearDown(self):
+        self.shield.disconnect()
+        self.shield.local_wifi_server.close()
+        self.http.shutdown()
+        self.http.server_close()
+        shutil.rmtree(self.folder)
+
+
+class TestOpenBCIWiFiCommands(ShieldTestCase):
+
+    def test_keep_alive(self):
+        self.assertEqual(self.shield.board_type, 'daisy')
+        self.shield.set_channel(1, 0)
+        self.shield.set_channel(2, 0)
+        self.assertEqual(self.http.commands, ['1', '2'])
+        # /board, /tcp and both commands over a single connection
+        self.assertEqual(self.http.connections, 1)
+        self.assertEqual(self.shield.command_requests, 2)
+        self.assertEqual(len(self.shield.command_latencies), 2)
+
+    def test_batch(self):
+        with self.shield.batch_commands():
+            for channel in range(1, 17):
+                self.shield.set_channel_settings(channel, gain=8)
+            self.assertEqual(self.http.commands, [])
+        self.assertEqual(len(self.http.commands), 6)
+        self.assertEqual(''.join(self.http.commands)[:18], 'x1040110Xx2040110X')
+        self.assertTrue(all(len(command) <= wifi.COMMAND_MAX_LENGTH
+                            for command in self.http.commands))
+        self.assertEqual(self.shield.commands_sent, 16)
+        self.assertEqual(self.shield.command_requests, 6)
+        self.assertEqual(self.shield.gains, [8] * 16)
+
+        self.shield.wifi_write_many(['~4', 'b'])
+        self.assertEqual(self.http.commands[-1], '~4b')
+
+
+class TestFindWiFiShield(ShieldTestCase):
+
+    def test_find_wifi_shield(self):
+        self.http.descriptions = {
+            '/slow.xml': ('OpenBCI-0001', '10.0.0.1', 3),
+            '/fast.xml': ('OpenBCI-0002', '10.0.0.2', 0)
+        }
+        url = 'http://%s%%s' % self.address
+        responder = SSDPResponder([url % '/slow.xml', url % '/fast.xml'])
+        self.shield.timeout = 5
+        found = mock.Mock()
+        start = time.time()
+        try:
+            with mock.patch.object(ssdp, 'SSDP_GROUP', responder.group):
+                ip_address = self.shield.find_wifi_shield(shield_name='OpenBCI-0002',
+                                                          wifi_shield_cb=found)
+        finally:
+            responder.close()
+        # did not wait for the search to time out, nor for the other description
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(ip_address, '10.0.0.2')
+        found.assert_called_once_with('10.0.0.2')
+        self.assertEqual(self.cache.items(), {'OpenBCI-0002': '10.0.0.2'})
+
+    def test_connect_cached(self):
+        self.cache.set('OpenBCI-0003', self.address)
+        with mock.patch.object(OpenBCIWiFi, 'find_wifi_shield') as find_wifi_shield:
+            shield = self.make_shield(shield_name='OpenBCI-0003')
+            shield.local_wifi_server.close()
+            self.assertEqual(shield.ip_address, self.address)
+            self.assertEqual(shield.board_type, 'daisy')
+            self.assertFalse(find_wifi_shield.called)
+
+            # gone, searching then
+            self.cache.set('OpenBCI-0003', '127.0.0.1:1')
+            shield = self.make_shield(shield_name='OpenBCI-0003', ssdp_attempts=1)
+            shield.local_wifi_server.close()
+            find_wifi_shield.assert_called_once_with(shield_name='OpenBCI-0003',
+                                                     wifi_shield_cb=shield.on_shield_found)
+            self.assertIsNone(shield.ip_address)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,8 @@
+import sys
+import unittest
+
+# the asyncio servers, and their tests, use a syntax Python 2 and 3.4 cannot even compile
+if sys.version_info < (3, 7):
+    raise unittest.SkipTest('The asyncio WiFi shield servers need Python 3.7')
+
+from wifi_async_cases import *  # noqa: F401,F403
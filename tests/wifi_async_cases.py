@@ -0,0 +1,178 @@
+# Test cases of test_wifi_async.py, apart since older Pythons cannot compile them
+import asyncio
+import socket
+import threading
+import time
+import unittest
+
+from openbci.utils import ParseRaw, sample_packet
+from openbci.wifi_async import (MultiShieldServer, ThreadedWiFiShieldServer,
+                                WiFiShieldIngestServer, WiFiShieldManager)
+
+
+def connect_from(address, port):
+    """ Socket connected to the server on localhost from `address`, one of 127.0.0.0/8. """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((address, 0))
+    sock.connect(('127.0.0.1', port))
+    return sock
+
+
+class TestWiFiShieldIngestServer(unittest.TestCase):
+
+    def test_samples(self):
+        received = []
+
+        async def run():
+            server = await WiFiShieldIngestServer('127.0.0.1', callback=received.append).start()
+            samples = server.samples()
+            first = asyncio.ensure_future(samples.__anext__())
+            # let the iterator register before the shield sends anything
+            await asyncio.sleep(0)
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            data = sample_packet(1) + sample_packet(2) + sample_packet(3)
+            # a packet split between two writes
+            writer.write(bytes(data[:40]))
+            await writer.drain()
+            await asyncio.sleep(0.05)
+            writer.write(bytes(data[40:]))
+            await writer.drain()
+            numbers = [(await first).sample_number]
+            while len(numbers) < 3:
+                numbers.append((await samples.__anext__()).sample_number)
+            writer.close()
+            await server.close()
+            rest = [sample async for sample in samples]
+            return numbers, rest, server
+
+        numbers, rest, server = asyncio.run(run())
+        self.assertEqual(numbers, [1, 2, 3])
+        self.assertEqual(rest, [])
+        self.assertEqual([sample.sample_number for sample in received], [1, 2, 3])
+        self.assertEqual(server.samples_received, 3)
+
+
+class TestThreadedWiFiShieldServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadedWiFiShieldServer('127.0.0.1')
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_callback(self):
+        received = []
+        done = threading.Event()
+
+        def callback(sample):
+            received.append(sample.sample_number)
+            if len(received) == 3:
+                done.set()
+
+        self.server.set_callback(callback)
+        shield = socket.create_connection(('127.0.0.1', self.server.port))
+        shield.sendall(bytes(b'\x00' + sample_packet(1) + sample_packet(2)))
+        shield.sendall(bytes(sample_packet(3)))
+        self.assertTrue(done.wait(2))
+        shield.close()
+        self.assertEqual(received, [1, 2, 3])
+        self.assertEqual(self.server.handler.decoder.framer.bytes_skipped, 1)
+
+    def test_close(self):
+        self.assertFalse(self.server.serve_forever(0.01))
+        self.server.close()
+        self.assertTrue(self.server.serve_forever(1))
+
+
+class TestMultiShieldServer(unittest.TestCase):
+
+    def test_routing(self):
+        async def run():
+            server = MultiShieldServer('127.0.0.1', block_interval=0.02)
+            server.add_shield('127.0.0.1', name='left', gains=[24] * 8)
+            server.add_shield('127.0.0.2', name='right', gains=[1] * 8)
+            await server.start()
+            blocks = server.blocks()
+            loop = asyncio.get_running_loop()
+            left = connect_from('127.0.0.1', server.port)
+            right = connect_from('127.0.0.2', server.port)
+            unknown = connect_from('127.0.0.3', server.port)
+            # the same packets from both shields
+            data = bytes(sample_packet(1) + sample_packet(2))
+            await loop.sock_sendall(left, data)
+            await loop.sock_sendall(right, data)
+            received = {'left': [], 'right': []}
+            while len(received['left']) < 2 or len(received['right']) < 2:
+                block = await asyncio.wait_for(blocks.__anext__(), 2)
+                self.assertLessEqual(block.start, block.end)
+                self.assertEqual(sorted(block.samples), ['left', 'right'])
+                for name, samples in block.samples.items():
+                    received[name].extend(samples)
+            for sock in (left, right, unknown):
+                sock.close()
+            await server.close()
+            return server, received
+
+        server, received = asyncio.run(run())
+        self.assertEqual([sample.sample_number for sample in received['left']], [1, 2])
+        self.assertEqual([sample.sample_number for sample in received['right']], [1, 2])
+        # each shield with its own gains
+        ratios = [a / b for a, b in zip(received['left'][0].channel_data,
+                                        received['right'][0].channel_data) if b]
+        self.assertTrue(ratios)
+        for ratio in ratios:
+            self.assertAlmostEqual(ratio, 1 / 24.)
+        self.assertEqual(server.connections_refused, 1)
+
+
+class TestWiFiShieldManager(unittest.TestCase):
+
+    def test_shields(self):
+        blocks = []
+        manager = WiFiShieldManager('127.0.0.1', block_interval=0.02,
+                                    block_callback=blocks.append)
+        try:
+            first = manager.add_shield(name='first')
+            second = manager.add_shield('127.0.0.2')
+            self.assertEqual(first.port, second.port)
+            first.set_address('127.0.0.1:8080')
+            self.assertEqual(first.ip_address, '127.0.0.1')
+            done = threading.Event()
+            received = []
+
+            def callback(sample):
+                received.append(sample.sample_number)
+                if len(received) == 2:
+                    done.set()
+
+            first.set_callback(callback)
+            second.set_parser(ParseRaw(gains=[24] * 8))
+            sockets = [connect_from('127.0.0.1', manager.port),
+                       connect_from('127.0.0.2', manager.port)]
+            sockets[0].sendall(bytes(sample_packet(1) + sample_packet(2)))
+            sockets[1].sendall(bytes(sample_packet(7)))
+            self.assertTrue(done.wait(2))
+            self.assertEqual(received, [1, 2])
+            # a block with the samples of both shields, or one block each
+            deadline = time.time() + 2
+            while sum(len(samples) for block in blocks
+                      for samples in block.samples.values()) < 3 and time.time() < deadline:
+                time.sleep(0.01)
+            numbers = dict((name, []) for name in ['first', '127.0.0.2'])
+            for block in blocks:
+                for name, samples in block.samples.items():
+                    numbers[name].extend(sample.sample_number for sample in samples)
+            self.assertEqual(numbers, {'first': [1, 2], '127.0.0.2': [7]})
+
+            second.close()
+            for sock in sockets:
+                sock.close()
+            time.sleep(0.05)
+            self.assertEqual(list(manager.server.streams), ['127.0.0.1'])
+        finally:
+            manager.close()
+        self.assertTrue(manager.serve_forever(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,9 +30,11 @@ if __name__ == '__main__':
                              "( ex /dev/ttyUSB0 or /dev/tty.usbserial-* ). " +
                              "For Ganglion, MAC address of the board. For both, AUTO to attempt auto-detection.")
     parser.set_defaults(port="AUTO")
-    # baud rate is not currently used
     parser.add_argument('-b', '--baud', default=115200, type=int,
-                        help="Baud rate (not currently used)")
+                        help="Baud rate to open the serial port with (cyton board)")
+    parser.add_argument('--high-baud', dest='high_baud', type=int, choices=[230400, 921600],
+                        help="Switch the dongle to this baud rate once connected, "
+                             "keeps the current one if the link cannot be verified (cyton board)")
     parser.add_argument('--no-filtering', dest='filtering',
                         action='store_false',
                         help="Disable notch filtering")
@@ -124,6 +126,8 @@ if __name__ == '__main__':
                                  filter_data=args.filtering,
                                  scaled_output=True,
                                  log=args.log)
+        if args.high_baud:
+            board.set_baud_rate(args.high_baud)
     elif args.board == "ganglion":
         board = bci.OpenBCIGanglion(port=args.port,
                                     filter_data=args.filtering,